@@ -0,0 +1,174 @@
+# admission.py
+"""
+Допуск личных сообщений в конвейер (handle_private).
+
+  - у каждого пользователя token bucket: ADMIT_BURST сообщений подряд, дальше
+    ADMIT_RATE_PER_MIN в минуту. Сверх темпа — отказ с короткой подсказкой
+    (не чаще одной на период пополнения, чтобы не кормить флуд ответами);
+  - альбом расходует один токен: решение по первому файлу распространяется
+    на весь media_group_id;
+  - общий бюджет: одновременно в конвейере не больше ADMIT_MAX_INFLIGHT
+    сообщений, остальные ждут в очереди до ADMIT_QUEUE_MAX мест и не дольше
+    ADMIT_QUEUE_TIMEOUT_S; не влезли — сбрасываем (shed).
+"""
+import asyncio
+from collections import deque
+from typing import Any, Dict
+
+import clock
+from config import (
+    ADMIT_RATE_PER_MIN, ADMIT_BURST, ADMIT_MAX_INFLIGHT, ADMIT_QUEUE_MAX, ADMIT_QUEUE_TIMEOUT_S,
+)
+
+GROUP_TTL_S = 120.0     # сколько помним решение по альбому
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts", "notified_ts")
+
+    def __init__(self, rate_per_s: float, burst: float, now: float):
+        self.rate = rate_per_s
+        self.burst = burst
+        self.tokens = burst
+        self.ts = now
+        self.notified_ts = None
+
+    def refill(self, now: float):
+        if now > self.ts:
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def wait_s(self, cost: float = 1.0) -> float:
+        return max(0.0, (cost - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class Admission:
+    ADMIT = "admit"
+    RATE = "rate"           # превышен личный темп
+
+    def __init__(self, rate_per_min: float = ADMIT_RATE_PER_MIN, burst: int = ADMIT_BURST,
+                 max_inflight: int = ADMIT_MAX_INFLIGHT, queue_max: int = ADMIT_QUEUE_MAX,
+                 queue_timeout_s: float = ADMIT_QUEUE_TIMEOUT_S):
+        self.rate = float(rate_per_min) / 60.0
+        self.burst = float(max(1, burst))
+        self.max_inflight = int(max(1, max_inflight))
+        self.queue_max = int(queue_max)
+        self.queue_timeout_s = float(queue_timeout_s)
+        self._buckets: Dict[Any, TokenBucket] = {}
+        self._groups: Dict[Any, tuple] = {}      # media_group_id -> (verdict, ts)
+        self._inflight = 0
+        self._waiters: deque = deque()
+        self._last_sweep = 0.0
+        # счётчики
+        self.admitted = 0
+        self.shed_rate = 0
+        self.shed_overload = 0
+        self.queued = 0
+        self.max_wait_s = 0.0
+
+    # ---- личный темп ----
+    def _sweep(self, now: float):
+        """Полные вёдра ничем не отличаются от новых — выбрасываем, память = активные пользователи."""
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        full_after = self.burst / self.rate if self.rate > 0 else float("inf")
+        for uid in [u for u, b in self._buckets.items() if now - b.ts >= full_after]:
+            del self._buckets[uid]
+        for g in [g for g, (_, ts) in self._groups.items() if now - ts > GROUP_TTL_S]:
+            del self._groups[g]
+
+    def check_rate(self, user_id, group=None, now: float | None = None) -> str:
+        now = clock.monotonic() if now is None else now
+        self._sweep(now)
+        if group is not None and group in self._groups:
+            verdict = self._groups[group][0]
+        else:
+            b = self._buckets.get(user_id)
+            if b is None:
+                b = self._buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+            verdict = self.ADMIT if b.take(now) else self.RATE
+            if group is not None:
+                self._groups[group] = (verdict, now)
+        if verdict == self.RATE:
+            self.shed_rate += 1
+        return verdict
+
+    def should_notify(self, user_id, now: float | None = None) -> float | None:
+        """Через сколько секунд можно снова писать — если пользователю ещё не отвечали
+        в этом периоде; иначе None (молча отбрасываем)."""
+        now = clock.monotonic() if now is None else now
+        b = self._buckets.get(user_id)
+        if b is None:
+            return None
+        period = 1.0 / self.rate if self.rate > 0 else 60.0
+        if b.notified_ts is not None and now - b.notified_ts < period:
+            return None
+        b.notified_ts = now
+        return b.wait_s()
+
+    # ---- общий бюджет ----
+    async def acquire(self) -> bool:
+        """Место в конвейере; False — перегрузка (очередь полна или ждали слишком долго)."""
+        if self._inflight < self.max_inflight and not self._waiters:
+            self._inflight += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue_max:
+            self.shed_overload += 1
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self.queued += 1
+        t0 = clock.monotonic()
+        # ждём по часам процесса (clock.py): под VirtualClock таймаут очереди тоже виртуальный
+        granted = asyncio.Event()
+        fut.add_done_callback(lambda _: granted.set())
+        try:
+            if not await clock.wait(granted, self.queue_timeout_s):
+                if fut.done() and not fut.cancelled():
+                    # место отдали в последний момент — возвращаем его дальше по очереди
+                    self.release()
+                else:
+                    fut.cancel()
+                self.shed_overload += 1
+                return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            else:
+                fut.cancel()
+            raise
+        finally:
+            try:
+                self._waiters.remove(fut)
+            except ValueError:
+                pass
+        self.max_wait_s = max(self.max_wait_s, clock.monotonic() - t0)
+        self.admitted += 1
+        return True
+
+    def release(self):
+        # место переходит первому живому ожидающему, не освобождаясь (без гонки «вперёд очереди»)
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._inflight = max(0, self._inflight - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"admitted": self.admitted, "shed_rate": self.shed_rate, "shed_overload": self.shed_overload,
+                "queued": self.queued, "waiting": len(self._waiters), "inflight": self._inflight,
+                "max_wait_s": self.max_wait_s, "users": len(self._buckets)}
+
+
+# один на процесс
+admission = Admission()
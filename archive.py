@@ -0,0 +1,206 @@
+# archive.py
+"""
+Долгий архив истории доставок: append-only JSONL, сжатый gzip, по файлу на день (UTC).
+
+  archive/history/2025-01-31.jsonl.gz   — строки {"uid", "ts", "size", "dur", "speed"}
+
+В живом state остаётся только горячее окно (HISTORY_MAX_DAYS / HISTORY_MAX_PER_USER),
+а каждая запись истории параллельно уходит сюда (HistoryStore.sink -> append).
+Запись буферизуется в памяти и сбрасывается вместе с сохранением state (в потоке
+записи); каждый сброс дописывает в файл дня новый gzip-member — gzip такие файлы
+читает как один поток.
+
+Читатели — генераторы: файл за файлом, строка за строкой, память не зависит
+от объёма архива (уникальные — через ReachCounter/HLL, перцентили — по
+логарифмической гистограмме).
+"""
+import gzip
+import json
+import math
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sketch import ReachCounter
+
+SUFFIX = ".jsonl.gz"
+
+
+def day_of(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).date().isoformat()
+
+
+def _finite(v):
+    return v if v is not None and not (isinstance(v, float) and (math.isnan(v) or math.isinf(v))) else None
+
+
+class LogHistogram:
+    """Приблизительные перцентили в O(1) памяти: корзины по степеням 2^(1/8) (~9% ширины)."""
+    __slots__ = ("bins", "count", "zeros")
+    STEP = 8
+
+    def __init__(self):
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+        self.zeros = 0
+
+    def add(self, v: float):
+        self.count += 1
+        if v <= 0:
+            self.zeros += 1
+            return
+        b = math.floor(math.log2(v) * self.STEP)
+        self.bins[b] = self.bins.get(b, 0) + 1
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen > rank:
+                return 2 ** ((b + 0.5) / self.STEP)   # середина корзины
+        return 2 ** ((max(self.bins) + 0.5) / self.STEP)
+
+
+class _Summary:
+    __slots__ = ("count", "total", "min", "max", "hist")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.hist = LogHistogram()
+
+    def add(self, v):
+        if v is None:
+            return
+        self.count += 1
+        self.total += v
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = v if self.max is None else max(self.max, v)
+        self.hist.add(v)
+
+    def result(self) -> Dict[str, Any]:
+        if not self.count:
+            return {}
+        return {"count": self.count, "mean": self.total / self.count, "min": self.min, "max": self.max,
+                "p50": self.hist.quantile(0.5), "p90": self.hist.quantile(0.9), "p99": self.hist.quantile(0.99)}
+
+
+class HistoryArchive:
+    def __init__(self, root: str):
+        self.dir = os.path.join(root, "history")
+        self._buf: List[tuple] = []
+        self._buf_lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self.written = 0
+
+    # ---- запись ----
+    def append(self, uid, ts: int, size_b: int, duration_s, speed_bps):
+        rec = (int(uid), int(ts), int(size_b or 0), _finite(duration_s), _finite(speed_bps))
+        with self._buf_lock:
+            self._buf.append(rec)
+
+    def pending(self) -> int:
+        return len(self._buf)
+
+    def flush(self) -> int:
+        """Дописать буфер в файлы дней. Вызывается из потока записи state."""
+        with self._buf_lock:
+            rows, self._buf = self._buf, []
+        if not rows:
+            return 0
+        by_day: Dict[str, List[str]] = {}
+        for uid, ts, size, dur, speed in rows:
+            by_day.setdefault(day_of(ts), []).append(json.dumps(
+                {"uid": uid, "ts": ts, "size": size, "dur": dur, "speed": speed}, separators=(",", ":")))
+        try:
+            with self._io_lock:
+                os.makedirs(self.dir, exist_ok=True)
+                for day, lines in by_day.items():
+                    with gzip.open(os.path.join(self.dir, day + SUFFIX), "ab", compresslevel=6) as f:
+                        f.write(("\n".join(lines) + "\n").encode("utf-8"))
+        except Exception:
+            # не потеряем: вернём в начало буфера, допишем в следующий раз
+            with self._buf_lock:
+                self._buf[:0] = rows
+            raise
+        self.written += len(rows)
+        return len(rows)
+
+    # ---- чтение ----
+    def days(self, start: str | None = None, end: str | None = None) -> List[str]:
+        """Дни (YYYY-MM-DD), для которых есть файлы, в пределах [start, end]."""
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            return []
+        out = sorted(n[:-len(SUFFIX)] for n in names if n.endswith(SUFFIX))
+        return [d for d in out if (start is None or d >= start) and (end is None or d <= end)]
+
+    def iter_records(self, start_ts: float | None = None, end_ts: float | None = None) -> Iterator[Dict[str, Any]]:
+        """Записи с start_ts <= ts < end_ts по возрастанию дня (внутри дня — в порядке записи)."""
+        start = day_of(start_ts) if start_ts is not None else None
+        end = day_of(end_ts) if end_ts is not None else None
+        for day in self.days(start, end):
+            path = os.path.join(self.dir, day + SUFFIX)
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue
+                        ts = rec.get("ts", 0)
+                        if (start_ts is None or ts >= start_ts) and (end_ts is None or ts < end_ts):
+                            yield rec
+            except (EOFError, OSError, zlib.error):
+                # хвостовой member дописывается прямо сейчас (или файл повреждён) — берём, что прочли
+                continue
+
+    def reach_stats(self, start_ts=None, end_ts=None) -> Dict[str, Any]:
+        """Уникальные пользователи за период: всего, по дням и по часам (UTC); уникальные — оценка."""
+        total = ReachCounter()
+        per_day: Dict[str, ReachCounter] = {}
+        per_hour = [ReachCounter() for _ in range(24)]
+        messages = 0
+        for rec in self.iter_records(start_ts, end_ts):
+            uid, ts = rec["uid"], rec["ts"]
+            messages += 1
+            total.add(uid)
+            day = day_of(ts)
+            c = per_day.get(day)
+            if c is None:
+                c = per_day[day] = ReachCounter()
+            c.add(uid)
+            per_hour[(ts // 3600) % 24].add(uid)
+        return {
+            "messages": messages,
+            "total_unique_users": len(total),
+            "per_day_counts": [(d, len(c)) for d, c in sorted(per_day.items(), reverse=True)],
+            "per_hour_counts": [(h, len(c)) for h, c in enumerate(per_hour) if len(c)],
+        }
+
+    def delivery_stats(self, start_ts=None, end_ts=None) -> Dict[str, Any]:
+        sizes, durs, speeds = _Summary(), _Summary(), _Summary()
+        for rec in self.iter_records(start_ts, end_ts):
+            sizes.add(rec.get("size"))
+            durs.add(rec.get("dur"))
+            speeds.add(rec.get("speed"))
+        return {"sizes": sizes.result(), "times": durs.result(), "speeds_bps": speeds.result()}
+
+
+def parse_range(args) -> Tuple[float | None, float | None]:
+    """["2025-01-01", "2025-01-31"] -> [начало первого дня, конец последнего) в epoch UTC."""
+    def _day(s: str) -> float:
+        return datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    start = _day(args[0]) if len(args) > 0 else None
+    end = _day(args[1]) + 86400 if len(args) > 1 else None
+    return start, end
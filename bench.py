@@ -0,0 +1,272 @@
+# bench.py
+"""
+Стресс-тесты и микробенчмарки без Telegram.
+
+    python bench.py            # все
+    python bench.py keyed      # только выбранные
+"""
+import asyncio
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from telegram.ext import SimpleUpdateProcessor
+
+from concurrency import KeyedUpdateProcessor, KeyedLocks
+
+
+# ========= keyed: параллельная обработка апдейтов =========
+def _fake_updates(users: int, per_user: int, albums: int, seed: int = 1):
+    rnd = random.Random(seed)
+    ups = []
+    for i in range(users * per_user):
+        uid = rnd.randrange(users)
+        mgid = f"mg{uid}" if uid < albums else None
+        ups.append(SimpleNamespace(
+            update_id=i,
+            effective_user=SimpleNamespace(id=uid),
+            effective_chat=SimpleNamespace(id=uid),
+            effective_message=SimpleNamespace(media_group_id=mgid),
+        ))
+    return ups
+
+
+async def _drive(processor, updates, api_s: float, slow_uid: int, slow_s: float):
+    """Гоняем апдейты через процессор так же, как Application: по задаче на апдейт."""
+    seen = {}
+    violations = 0
+    active = set()
+
+    async def handler(u):
+        nonlocal violations
+        uid = u.effective_user.id
+        if uid in active:          # два апдейта одного пользователя одновременно
+            violations += 1
+        active.add(uid)
+        try:
+            # имитация вызовов API; один пользователь «тормозит» (альбом, зависший запрос)
+            await asyncio.sleep(slow_s if uid == slow_uid else api_s)
+            seen.setdefault(uid, []).append(u.update_id)
+        finally:
+            active.discard(uid)
+
+    await processor.initialize()
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(processor.process_update(u, handler(u))) for u in updates]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t0
+    await processor.shutdown()
+    order_ok = all(ids == sorted(ids) for ids in seen.values())
+    return elapsed, violations, order_ok
+
+
+def bench_keyed(users: int = 200, per_user: int = 5, api_s: float = 0.01, slow_s: float = 0.5):
+    updates = _fake_updates(users, per_user, albums=users // 10)
+    print(f"keyed: {len(updates)} апдейтов, {users} пользователей, API {api_s*1000:.0f} ms, "
+          f"один медленный пользователь {slow_s*1000:.0f} ms")
+    seq_updates = updates[: max(1, len(updates) // 10)]   # последовательный режим медленный — берём 10%
+    t_seq, v_seq, ok_seq = asyncio.run(_drive(SimpleUpdateProcessor(1), seq_updates, api_s, 0, slow_s))
+    rate_seq = len(seq_updates) / t_seq
+    print(f"  последовательно: {rate_seq:8.1f} апд/с  (на {len(seq_updates)} апдейтах, {t_seq:.2f}s)")
+    for n in (8, 64):
+        t, v, ok = asyncio.run(_drive(KeyedUpdateProcessor(n), updates, api_s, 0, slow_s))
+        rate = len(updates) / t
+        print(f"  keyed x{n:<3}       {rate:8.1f} апд/с  ({t:.2f}s; x{rate / rate_seq:.1f}; "
+              f"пересечений по пользователю: {v}; порядок {'ok' if ok else 'НАРУШЕН'})")
+
+
+def bench_keyed_locks(n: int = 200_000):
+    async def run():
+        locks = KeyedLocks()
+        t0 = time.perf_counter()
+        for i in range(n):
+            async with locks.acquire(("user", i % 1000), ("mg", i % 37)):
+                pass
+        return time.perf_counter() - t0, len(locks)
+    t, left = asyncio.run(run())
+    print(f"keyed_locks: {n} захватов по 2 ключа — {t / n * 1e6:.2f} us/захват; записей после: {left}")
+
+
+# ========= neardup: MinHash/LSH на синтетической спам-волне =========
+_WORDS = ("скидка акция бесплатно заработок канал подписка переходи ссылка бонус промокод "
+          "сегодня только успей выигрыш приз деньги быстро легко дом работа удалённо "
+          "погода город новости вечер утро фото кот собака парк концерт билет друзья").split()
+
+
+def _spam_corpus(templates: int, variants: int, legit: int, seed: int = 7):
+    """Шаблоны спама с вариациями (замена слов, опечатки, хвосты) + случайные «нормальные» тексты."""
+    rnd = random.Random(seed)
+    docs = []
+    for t in range(templates):
+        base = [rnd.choice(_WORDS) for _ in range(rnd.randint(12, 30))] + [f"t.me/spam{t}"]
+        for _ in range(variants):
+            words = list(base)
+            for _ in range(rnd.randint(0, 2)):                 # замена слова
+                words[rnd.randrange(len(words))] = rnd.choice(_WORDS)
+            text = " ".join(words)
+            if rnd.random() < 0.5:                             # опечатка
+                i = rnd.randrange(len(text))
+                text = text[:i] + rnd.choice("абвгдеё") + text[i + 1:]
+            if rnd.random() < 0.3:                             # хвост
+                text += " " + "!" * rnd.randint(1, 3)
+            docs.append((f"s{t}", text))
+    for i in range(legit):
+        docs.append((f"l{i}", " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(6, 40)))))
+    rnd.shuffle(docs)
+    return docs
+
+
+def bench_neardup(templates: int = 200, variants: int = 25, legit: int = 5000):
+    from neardup import NearDupIndex
+    docs = _spam_corpus(templates, variants, legit)
+    idx = NearDupIndex(window_s=1e9, max_docs=len(docs) + 1)
+    assigned = []
+    t0 = time.perf_counter()
+    for label, text in docs:
+        cluster, _, _ = idx.add(text, now=0.0)
+        assigned.append((label, cluster))
+    elapsed = time.perf_counter() - t0
+    # качество по парам внутри шаблона: сколько вариаций попало в самый большой кластер шаблона
+    by_label: dict = {}
+    for label, cluster in assigned:
+        by_label.setdefault(label, []).append(cluster)
+    spam = [c for l, c in by_label.items() if l.startswith("s")]
+    recall = sum(max(c.count(x) for x in set(c)) for c in spam) / sum(len(c) for c in spam)
+    spam_clusters = {x for c in spam for x in c}
+    false_joins = sum(1 for l, c in by_label.items() if l.startswith("l") and c[0] in spam_clusters)
+    st = idx.stats()
+    print(f"neardup: {len(docs)} текстов ({templates}x{variants} спама + {legit} обычных): "
+          f"{elapsed / len(docs) * 1e6:.0f} us/текст; кластеров {st['clusters']}, крупнейший {st['largest']}")
+    print(f"  волна схлопнулась на {recall:.1%}; обычных текстов, ошибочно прилипших к спаму: {false_joins}")
+    decisions_before = len(docs) - legit
+    decisions_after = len(spam_clusters)
+    print(f"  решений модерации по спаму: {decisions_before} -> ~{decisions_after}")
+
+    # окно времени: память держится на уровне «последних window_s»
+    idx = NearDupIndex(window_s=60, max_docs=10**9)
+    for i, (_, text) in enumerate(docs):
+        idx.add(text, now=i * 0.1)          # 10 сообщений/с, окно 60 c => ~600 документов
+    print(f"  окно 60 c при 10 сообщ./с: документов в индексе {len(idx)}, корзин {idx.stats()['buckets']}")
+
+
+# ========= chart: прореживание ряда перед matplotlib =========
+def bench_chart(sizes=(1_000, 10_000, 100_000), points: int = 1000):
+    import math
+    import tracemalloc
+    from datetime import datetime, timezone
+    import weather
+    from downsample import lttb, minmax
+
+    now = datetime.now(timezone.utc)
+    print(f"chart: рендер графика за 24 ч; бюджет {points} точек")
+    for n in sizes:
+        rnd = random.Random(n)
+        t0 = now.timestamp() - 86400
+        hist = [{"ts": t0 + i * 86400 / n, "temp_c": 12 + 6 * math.sin(i / n * 6.28) + rnd.gauss(0, 0.3)
+                 + (8 if i == n // 3 else 0)}   # одиночный пик — должен остаться на графике
+                for i in range(n)]
+        peak = max(r["temp_c"] for r in hist)
+        for label, pts in (("raw", n), ("lttb", points)):
+            tracemalloc.start()
+            t = time.perf_counter()
+            buf = weather._render_temp_charts([(hist, 10, 20, "bench")], points=pts)
+            elapsed = time.perf_counter() - t
+            peak_mem = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            _, ys = weather._chart_series(hist, now, timezone.utc, pts)
+            print(f"  {n:>7} сэмплов, {label:<4}: {elapsed * 1000:7.1f} ms, пик памяти {peak_mem / 1024:8.0f} KB, "
+                  f"png {len(buf[0].getvalue()) // 1024} KB, пик сохранён: {'да' if max(ys) == peak else 'НЕТ'}")
+        xs = [r["ts"] for r in hist]
+        ys = [r["temp_c"] for r in hist]
+        for name, fn in (("lttb", lttb), ("minmax", minmax)):
+            t = time.perf_counter()
+            fn(xs, ys, points)
+            print(f"           {name:<6} само прореживание: {(time.perf_counter() - t) * 1000:6.1f} ms")
+
+
+# ========= models: payload/pending на dataclass со __slots__ против dict =========
+def _legacy_entry(i: int):
+    """Запись pending в прежнем виде: dict-ы, payload обёрнут в {"type", "data"}."""
+    if i % 3 == 0:
+        p = {"type": "text", "text": f"текст заявки номер {i}"}
+    else:
+        p = {"type": "photo", "file_id": f"AgACAgIAAxkBAAI{i:08d}", "file_size": 50_000 + i, "caption": ""}
+    return {"user_id": 100_000 + i, "payload": {"type": p["type"], "data": p}, "ts": 1_700_000_000.0 + i}
+
+
+async def _legacy_publish(bot, chat_id, payload):
+    t = payload.get("type")
+    d = (payload.get("data") or {}) if t != "media_group" else {}
+    if t == "text":
+        await bot.send_message(chat_id=chat_id, text=d.get("text", ""))
+    elif t == "photo":
+        await bot.send_photo(chat_id=chat_id, photo=d.get("file_id"), caption=d.get("caption", ""))
+    elif t == "video":
+        await bot.send_video(chat_id=chat_id, video=d.get("file_id"), caption=d.get("caption", ""))
+    elif t == "document":
+        await bot.send_document(chat_id=chat_id, document=d.get("file_id"), caption=d.get("caption", ""))
+
+
+def bench_models(n: int = 50_000):
+    import gc
+    import tracemalloc
+    from models import decode_entry, encode_entry
+    from publish import publish_payload
+
+    print(f"models: {n} записей pending")
+    legacy = [_legacy_entry(i) for i in range(n)]
+
+    def _mem(build):
+        gc.collect()
+        tracemalloc.start()
+        objs = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return objs, size
+
+    _, dict_mem = _mem(lambda: [_legacy_entry(i) for i in range(n)])
+    # строки — свои, как при разборе сообщений (не общие с legacy)
+    models, model_mem = _mem(lambda: [decode_entry(_legacy_entry(i)) for i in range(n)])
+    print(f"  память: dict {dict_mem / n:6.0f} B/запись, модели {model_mem / n:6.0f} B/запись "
+          f"({(1 - model_mem / dict_mem) * 100:+.0f}% экономии)")
+
+    t = time.perf_counter()
+    dense = [encode_entry(e) for e in models]
+    enc = time.perf_counter() - t
+    t = time.perf_counter()
+    [decode_entry(d) for d in dense]
+    dec = time.perf_counter() - t
+    print(f"  кодеки: encode {enc / n * 1e6:5.2f} us, decode {dec / n * 1e6:5.2f} us на запись")
+
+    class _Bot:
+        async def send_message(self, **kw): pass
+        async def send_photo(self, **kw): pass
+
+    bot = _Bot()
+
+    async def _run(fn, payloads):
+        t = time.perf_counter()
+        for p in payloads:
+            await fn(bot, 1, p)
+        return time.perf_counter() - t
+
+    old = asyncio.run(_run(_legacy_publish, [e["payload"] for e in legacy]))
+    new = asyncio.run(_run(publish_payload, [e.payload for e in models]))
+    print(f"  публикация (без сети): ветвление по dict {old / n * 1e6:5.2f} us, "
+          f"таблица по классу {new / n * 1e6:5.2f} us на вызов")
+
+
+BENCHES = {
+    "keyed": bench_keyed,
+    "keyed_locks": bench_keyed_locks,
+    "neardup": bench_neardup,
+    "chart": bench_chart,
+    "models": bench_models,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
@@ -0,0 +1,401 @@
+# broadcast.py
+"""
+Рассылки: ежедневные сообщения и отбивка — во все каналы BROADCAST_CHANNEL_IDS
+и подписчикам (/subscribe в личке).
+
+Получатели — отсортированные chat_id (каналы и группы отрицательные, идут первыми).
+Рассылка в state["broadcast"]["jobs"] хранит не список получателей, а курсор —
+последний обработанный chat_id: после перезапуска продолжаем с id > cursor, уже
+получившим не шлём повторно (кроме окна из BROADCAST_CONCURRENCY отправок, которые
+были в полёте в момент падения). Курсор и счётчики пишутся каждые
+BROADCAST_CHECKPOINT_EVERY получателей и при штатной остановке.
+
+Темп: общий — не больше BROADCAST_RATE_PER_S отправок в секунду (равномерно, без
+всплесков); в один чат — не чаще раза в BROADCAST_USER_INTERVAL_S / BROADCAST_CHAT_INTERVAL_S;
+RetryAfter от Telegram ставит на паузу всю рассылку (и в попытки не считается —
+тому же получателю шлём после паузы). Заблокировавшие бота
+(Forbidden, «chat not found») сразу выписываются из подписчиков; каналы из конфига
+не выписываются — только попадают в отчёт.
+
+Прогресс и скорость — одно сообщение в модчате, редактируется раз в
+BROADCAST_REPORT_EVERY_S. Одновременно идёт одна рассылка, остальные — в очереди.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import clock
+from config import (
+    MOD_GROUP_ID, BROADCAST_CHANNEL_IDS, BROADCAST_RATE_PER_S, BROADCAST_CONCURRENCY,
+    BROADCAST_USER_INTERVAL_S, BROADCAST_CHAT_INTERVAL_S, BROADCAST_CHECKPOINT_EVERY,
+    BROADCAST_REPORT_EVERY_S, BROADCAST_JOB_TTL_S,
+)
+from state import save_state, BROADCAST_DONE_KEEP
+
+log = logging.getLogger("broadcast")
+
+SEND_ATTEMPTS = 3
+LAST_SENT_MAX = 20000      # память «когда слали в чат» — для поштучного лимита
+
+
+def section(state) -> Dict[str, Any]:
+    b = state.setdefault("broadcast", {})
+    b.setdefault("subscribers", {})
+    b.setdefault("jobs", {})
+    b.setdefault("done", [])
+    return b
+
+
+def recipients(state) -> List[int]:
+    """Все получатели по возрастанию chat_id: каналы из конфига + подписчики."""
+    ids = set(BROADCAST_CHANNEL_IDS)
+    for uid in section(state)["subscribers"]:
+        try:
+            ids.add(int(uid))
+        except ValueError:
+            pass
+    return sorted(ids)
+
+
+def _retry_after_s(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+class Broadcaster:
+    """Один на процесс: переживает тёплый перезапуск транспорта (бот берётся из текущего app)."""
+
+    def __init__(self, rate_per_s: float = BROADCAST_RATE_PER_S, concurrency: int = BROADCAST_CONCURRENCY,
+                 user_interval_s: float = BROADCAST_USER_INTERVAL_S, chat_interval_s: float = BROADCAST_CHAT_INTERVAL_S,
+                 checkpoint_every: int = BROADCAST_CHECKPOINT_EVERY, report_every_s: float = BROADCAST_REPORT_EVERY_S):
+        self.interval = 1.0 / max(0.1, rate_per_s)
+        self.concurrency = max(1, int(concurrency))
+        self.user_interval_s = float(user_interval_s)
+        self.chat_interval_s = float(chat_interval_s)
+        self.checkpoint_every = max(1, int(checkpoint_every))
+        self.report_every_s = float(report_every_s)
+        self.app = None
+        self.state = None
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._stop_evt = asyncio.Event()    # будит паузу RetryAfter при остановке
+        self._cancel: set = set()          # id рассылок, снятых /broadcast_stop
+        self._next_slot = 0.0              # monotonic: когда можно следующую отправку
+        self._paused_until = 0.0
+        self._last_sent: Dict[int, float] = {}
+        # счётчики процесса
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    def bind(self, app, state=None):
+        self.app = app
+        if state is not None:
+            self.state = state
+            if not self.running():
+                self._stopping = False   # новый запуск main() в том же процессе — снова можно рассылать
+                self._stop_evt.clear()
+
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def kick(self):
+        """Запускаем обработку очереди, если она есть и ещё не идёт."""
+        if self._stopping or self.app is None or self.state is None or self.running():
+            return
+        if section(self.state)["jobs"]:
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, app, state, kind: str, text: str, **extra) -> Dict[str, Any]:
+        self.bind(app, state)
+        job = {"id": os.urandom(3).hex(), "kind": kind, "text": text, "created": clock.time(),
+               "cursor": None, "sent": 0, "blocked": 0, "failed": 0, "elapsed": 0.0, "report_mid": None}
+        job.update(extra)
+        section(state)["jobs"][job["id"]] = job
+        save_state(state, "broadcast")
+        self.kick()
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        jobs = section(self.state)["jobs"] if self.state is not None else {}
+        if job_id not in jobs:
+            return False
+        self._cancel.add(job_id)
+        if not self.running():
+            self._finish(jobs[job_id], "cancelled")
+        return True
+
+    async def stop(self, timeout: float):
+        """Штатная остановка: дописываем текущее окно, сохраняем курсор."""
+        self._stopping = True
+        self._stop_evt.set()
+        if not self.running():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+        except Exception:
+            pass
+
+    # ---- темп ----
+    async def _slot(self, chat_id: int) -> bool:
+        """Ждём своей очереди; False — остановка пришла во время паузы RetryAfter (не шлём)."""
+        now = time.monotonic()
+        t = max(now, self._next_slot, self._paused_until)
+        self._next_slot = t + self.interval
+        per_chat = self.chat_interval_s if chat_id < 0 else self.user_interval_s
+        t = max(t, self._last_sent.get(chat_id, -1e9) + per_chat)
+        if t > now:
+            if self._paused_until <= now:
+                await asyncio.sleep(t - now)
+            else:
+                try:
+                    await asyncio.wait_for(self._stop_evt.wait(), t - now)
+                except asyncio.TimeoutError:
+                    pass
+        return not (self._stopping and self._paused_until > time.monotonic())
+
+    def _remember(self, chat_id: int):
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        if len(self._last_sent) > LAST_SENT_MAX:
+            horizon = now - max(self.chat_interval_s, self.user_interval_s)
+            self._last_sent = {c: t for c, t in self._last_sent.items() if t > horizon}
+
+    async def _send(self, job, chat_id: int) -> str:
+        """-> sent / blocked / failed; pending — упёрлись в RetryAfter во время остановки
+        (получатель не обслужен, курсор за него не двигаем)."""
+        attempt = 0
+        while attempt < SEND_ATTEMPTS:
+            if not await self._slot(chat_id):
+                return "pending"
+            try:
+                await self.app.bot.send_message(chat_id=chat_id, text=job["text"])
+                self._remember(chat_id)
+                return "sent"
+            except RetryAfter as e:
+                # не попытка: ждём паузу и шлём тому же получателю
+                self.retry_after += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + _retry_after_s(e))
+                if self._stopping:
+                    return "pending"
+                continue
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                log.warning("broadcast %s to %s: %s", job["id"], chat_id, e)
+                return "failed"
+            except NetworkError as e:
+                log.warning("broadcast %s to %s (attempt %d): %s", job["id"], chat_id, attempt + 1, e)
+                await asyncio.sleep(1.0 + attempt)
+                attempt += 1
+            except Exception:
+                log.exception("broadcast %s to %s failed", job["id"], chat_id)
+                return "failed"
+        return "failed"
+
+    # ---- выполнение ----
+    async def _run(self):
+        try:
+            while not self._stopping:
+                jobs = section(self.state)["jobs"]
+                if not jobs:
+                    break
+                job = next(iter(jobs.values()))
+                if job["id"] in self._cancel:
+                    self._finish(job, "cancelled")
+                elif clock.time() - (job.get("created") or 0) > BROADCAST_JOB_TTL_S:
+                    self._finish(job, "expired")
+                else:
+                    await self._run_job(job)
+        except Exception:
+            log.exception("broadcast loop failed")
+        finally:
+            save_state(self.state, "broadcast")
+
+    async def _run_job(self, job):
+        state = self.state
+        subs = section(state)["subscribers"]
+        channels = set(BROADCAST_CHANNEL_IDS)
+        cursor = job.get("cursor")
+        ahead = set(job.get("ahead") or ())   # обслуженные за курсором (остановка на RetryAfter)
+        targets = [c for c in recipients(state) if (cursor is None or c > cursor) and c not in ahead]
+        done_before = job["sent"] + job["blocked"] + job["failed"]
+        job["total"] = done_before + len(targets)
+        started = time.monotonic()
+        elapsed0 = job.get("elapsed") or 0.0
+        since_checkpoint = 0
+        last_report = 0.0
+        bumper_seen = False
+        await self._report(job, elapsed0, "идёт")
+
+        for i in range(0, len(targets), self.concurrency):
+            if self._stopping or job["id"] in self._cancel:
+                break
+            window = [c for c in targets[i:i + self.concurrency] if c in channels or str(c) in subs]
+            results = await asyncio.gather(*(self._send(job, c) for c in window))
+            pending = [c for c, r in zip(window, results) if r == "pending"]
+            for chat_id, r in zip(window, results):
+                if r == "pending":
+                    continue
+                job[r] += 1
+                if r == "sent":
+                    self.sent += 1
+                    if job.get("bumper_version") is not None and chat_id > 0:
+                        bumper_seen |= self._count_reach(job, chat_id)
+                elif r == "blocked":
+                    self.blocked += 1
+                    if subs.pop(str(chat_id), None) is None:
+                        log.warning("broadcast: channel %s rejects the bot", chat_id)
+                else:
+                    self.failed += 1
+            if pending:
+                # остановка на паузе RetryAfter: курсор — до первого необслуженного, остальное после перезапуска;
+                # уже обслуженных за курсором (они учтены в счётчиках и охвате) запоминаем поимённо — не повторяем
+                first = targets.index(pending[0])
+                if first > 0:
+                    job["cursor"] = targets[first - 1]
+                cur = job.get("cursor")
+                done = {c for c, r in zip(window, results) if r != "pending"} | ahead
+                job["ahead"] = sorted(c for c in done if cur is None or c > cur)
+                job["elapsed"] = elapsed0 + time.monotonic() - started
+                break
+            job["cursor"] = targets[min(i + self.concurrency, len(targets)) - 1]
+            job["elapsed"] = elapsed0 + time.monotonic() - started
+            since_checkpoint += self.concurrency
+            if since_checkpoint >= self.checkpoint_every:
+                since_checkpoint = 0
+                save_state(state, "broadcast", *(["bumper"] if bumper_seen else []))
+            if time.monotonic() - last_report >= self.report_every_s:
+                last_report = time.monotonic()
+                await self._report(job, job["elapsed"], "идёт")
+
+        if bumper_seen:
+            save_state(state, "bumper")
+        if job["id"] in self._cancel:
+            self._finish(job, "cancelled")
+        elif self._stopping and job.get("cursor") != (targets[-1] if targets else cursor):
+            save_state(state, "broadcast")
+            await self._report(job, job["elapsed"], "приостановлена — продолжится после перезапуска")
+            return
+        else:
+            self._finish(job, "done")
+        await self._report(job, job.get("elapsed") or 0.0, job["outcome"])
+
+    def _count_reach(self, job, chat_id: int) -> bool:
+        bumper = self.state.get("bumper") or {}
+        if str(bumper.get("version", 0)) != str(job["bumper_version"]):
+            return False   # отбивку сменили во время рассылки — охват старой версии не трогаем
+        from moderation import bumper_reach
+        return bool(bumper_reach(bumper).add(int(chat_id)))
+
+    def _finish(self, job, outcome: str):
+        b = section(self.state)
+        b["jobs"].pop(job["id"], None)
+        self._cancel.discard(job["id"])
+        job["outcome"] = outcome
+        b["done"] = (b["done"] + [{k: job.get(k) for k in ("id", "kind", "created", "total", "sent", "blocked",
+                                                           "failed", "elapsed", "outcome")}])[-BROADCAST_DONE_KEEP:]
+        save_state(self.state, "broadcast")
+
+    async def _report(self, job, elapsed: float, status: str):
+        text = format_job(job, elapsed, status)
+        bot = self.app.bot
+        try:
+            if job.get("report_mid"):
+                await bot.edit_message_text(chat_id=MOD_GROUP_ID, message_id=job["report_mid"], text=text)
+            else:
+                m = await bot.send_message(chat_id=MOD_GROUP_ID, text=text)
+                job["report_mid"] = m.message_id
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sent": self.sent, "blocked": self.blocked, "failed": self.failed,
+                "retry_after": self.retry_after, "running": self.running()}
+
+
+def format_job(job, elapsed: float, status: str) -> str:
+    done = job["sent"] + job["blocked"] + job["failed"]
+    total = job.get("total") or done
+    rate = done / elapsed if elapsed > 0 else 0.0
+    left = f", осталось ~{(total - done) / rate / 60:.1f} мин" if rate > 0 and total > done else ""
+    return (f"Рассылка {job['kind']} #{job['id']}: {status}\n"
+            f"{done}/{total}: доставлено {job['sent']}, заблокировали {job['blocked']}, ошибок {job['failed']}\n"
+            f"{rate:.1f} сообщ/с за {elapsed:.0f} с{left}")
+
+
+# один на процесс
+broadcaster = Broadcaster()
+
+
+# ===== Команды =====
+async def cmd_subscribe(update, context, state):
+    if update.effective_chat.type != "private": return
+    subs = section(state)["subscribers"]
+    uid = str(update.effective_user.id)
+    if uid in subs:
+        await update.message.reply_text("Вы уже подписаны на рассылку. Отписаться: /unsubscribe")
+        return
+    subs[uid] = int(clock.time())
+    save_state(state, "broadcast")
+    await update.message.reply_text("Подписка оформлена: утренние и вечерние сообщения будут приходить сюда. Отписаться: /unsubscribe")
+
+async def cmd_unsubscribe(update, context, state):
+    if update.effective_chat.type != "private": return
+    if section(state)["subscribers"].pop(str(update.effective_user.id), None) is None:
+        await update.message.reply_text("Вы не подписаны на рассылку.")
+        return
+    save_state(state, "broadcast")
+    await update.message.reply_text("Вы отписаны от рассылки.")
+
+async def cmd_broadcast(update, context, state):
+    """/broadcast <текст> — разослать; /broadcast bumper — разослать текущую отбивку."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    from moderation import is_admin
+    if not await is_admin(context, update.effective_user.id): return
+    args = list(context.args or [])
+    if args == ["bumper"]:
+        b = state["bumper"]
+        if not b.get("text"):
+            await update.message.reply_text("Текст отбивки не задан (/bumper_set).")
+            return
+        job = broadcaster.submit(context.application, state, "bumper", b["text"], bumper_version=b.get("version", 0))
+    elif args:
+        job = broadcaster.submit(context.application, state, "manual", " ".join(args))
+    else:
+        await update.message.reply_text("Формат: /broadcast <текст> | /broadcast bumper")
+        return
+    n = len(recipients(state))
+    await update.message.reply_text(f"Рассылка #{job['id']} поставлена в очередь: {n} получателей.")
+
+async def cmd_broadcast_status(update, context, state):
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    b = section(state)
+    lines = [f"Получателей: {len(recipients(state))} (каналов {len(BROADCAST_CHANNEL_IDS)}, подписчиков {len(b['subscribers'])})"]
+    for job in b["jobs"].values():
+        lines.append(format_job(job, job.get("elapsed") or 0.0, "в работе" if broadcaster.running() else "в очереди"))
+    for d in b["done"][-3:]:
+        lines.append(f"#{d['id']} {d['kind']}: {d['outcome']}, {d['sent']}/{d.get('total') or 0}, "
+                     f"заблокировали {d['blocked']}, {d.get('elapsed') or 0:.0f} с")
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+async def cmd_broadcast_stop(update, context, state):
+    """/broadcast_stop [id] — снять рассылку (по умолчанию текущую)."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    from moderation import is_admin
+    if not await is_admin(context, update.effective_user.id): return
+    jobs = section(state)["jobs"]
+    job_id = context.args[0] if context.args else next(iter(jobs), None)
+    if job_id is None or not broadcaster.cancel(job_id):
+        await update.message.reply_text("Такой рассылки нет.")
+        return
+    await update.message.reply_text(f"Рассылка #{job_id} снята.")
@@ -0,0 +1,140 @@
+# clock.py
+"""
+Часы процесса: настенное время, монотонное время и ожидание.
+
+По умолчанию — системные. Всё, что живёт сутками (prune в state, TTL кэшей и
+очереди модерации, погода, ежедневные сообщения, планировщик, допуск и темп
+модчата), берёт время отсюда, а не из time/datetime напрямую, поэтому soak.py
+может подставить VirtualClock и прогнать неделю работы за секунды.
+
+Реальными остаются только замеры собственной работы (latency, задержка записи
+state, темп рассылок — они меряют, сколько заняло на самом деле).
+"""
+import asyncio
+import heapq
+import time as _time
+from datetime import datetime, timezone
+
+
+class SystemClock:
+    def time(self) -> float:
+        return _time.time()
+
+    def monotonic(self) -> float:
+        return _time.monotonic()
+
+    def now(self, tz=timezone.utc) -> datetime:
+        return datetime.now(tz)
+
+    async def sleep(self, delay: float):
+        await asyncio.sleep(delay)
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> bool:
+        """Ждём событие не дольше timeout; True — событие наступило."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class VirtualClock(SystemClock):
+    """Время стоит, пока его не двигают (advance_to): спящие задачи будятся по порядку
+    сроков, и каждой даём доработать до следующего ожидания."""
+
+    SETTLE_ROUNDS = 8     # проходов event loop после пробуждения (цепочки await внутри задач)
+
+    def __init__(self, start: float | None = None):
+        self._wall0 = _time.time() if start is None else float(start)
+        self._t = 0.0
+        self._timers = []     # heap: (срок, seq, future)
+        self._seq = 0
+
+    def time(self) -> float:
+        return self._wall0 + self._t
+
+    def monotonic(self) -> float:
+        return self._t
+
+    def now(self, tz=timezone.utc) -> datetime:
+        return datetime.fromtimestamp(self.time(), tz)
+
+    async def sleep(self, delay: float):
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._timers, (self._t + max(0.0, float(delay)), self._seq, fut))
+        try:
+            await fut
+        finally:
+            if not fut.done():
+                fut.cancel()   # снятый таймер выкинем, когда дойдём до него
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> bool:
+        if event.is_set():
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            done, _ = await asyncio.wait({waiter, sleeper}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            sleeper.cancel()
+        return waiter in done
+
+    def pending(self) -> int:
+        return sum(1 for _, _, f in self._timers if not f.done())
+
+    async def settle(self):
+        for _ in range(self.SETTLE_ROUNDS):
+            await asyncio.sleep(0)
+
+    async def advance_to(self, t: float):
+        """Двигаем время до t (секунд от старта), по дороге будим всех, чей срок наступил."""
+        while True:
+            await self.settle()
+            timers = self._timers
+            while timers and timers[0][2].done():
+                heapq.heappop(timers)
+            if not timers or timers[0][0] > t:
+                break
+            due, _, fut = heapq.heappop(timers)
+            self._t = max(self._t, due)
+            fut.set_result(None)
+        self._t = max(self._t, t)
+
+    async def advance(self, dt: float):
+        await self.advance_to(self._t + dt)
+
+
+_clock = SystemClock()
+
+
+def set_clock(c) -> SystemClock:
+    """Подменить часы процесса; возвращает прежние."""
+    global _clock
+    prev, _clock = _clock, c
+    return prev
+
+
+def get_clock():
+    return _clock
+
+
+def time() -> float:
+    return _clock.time()
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
+
+def now(tz=timezone.utc) -> datetime:
+    return _clock.now(tz)
+
+
+async def sleep(delay: float):
+    await _clock.sleep(delay)
+
+
+async def wait(event: asyncio.Event, timeout: float) -> bool:
+    return await _clock.wait(event, timeout)
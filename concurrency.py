@@ -0,0 +1,104 @@
+# concurrency.py
+"""
+Параллельная обработка апдейтов с блокировками по ключу.
+
+Апдейты одного пользователя (и одного альбома, media_group_id) идут строго
+по очереди, разные пользователи — параллельно. Медленный пользователь (альбом,
+зависший вызов API) больше не задерживает остальных.
+
+Два уровня ограничения:
+  - внешний семафор PTB (max_concurrent_updates) — сколько апдейтов может
+    одновременно ждать/выполняться; берём с запасом;
+  - внутренний (max_running) — сколько обработчиков реально выполняется.
+    Берётся уже ПОСЛЕ блокировки по ключу, чтобы апдейты, стоящие в очереди
+    за своим же пользователем, не занимали рабочие слоты.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, Hashable, List
+
+from telegram.ext import BaseUpdateProcessor
+
+import latency
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда её никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List] = {}   # key -> [lock, users]
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def acquire(self, *keys: Hashable):
+        # сортируем, чтобы две задачи с пересекающимися ключами не взяли их крест-накрест
+        keys = sorted(set(k for k in keys if k is not None), key=repr)
+        joined = []   # ключи, где мы учтены в users (записи не удалять)
+        held = []     # ключи, чью блокировку взяли именно мы
+        try:
+            for k in keys:
+                ent = self._locks.get(k)
+                if ent is None:
+                    ent = self._locks[k] = [asyncio.Lock(), 0]
+                ent[1] += 1
+                joined.append(k)
+                await ent[0].acquire()
+                # отменённая в ожидании задача сюда не дойдёт и чужую блокировку не отпустит
+                held.append(k)
+            yield
+        finally:
+            for k in reversed(held):
+                self._locks[k][0].release()
+            for k in reversed(joined):
+                ent = self._locks[k]
+                ent[1] -= 1
+                if ent[1] == 0:
+                    del self._locks[k]
+
+
+# общий реестр: им пользуются и процессор апдейтов, и отложенные задачи (флеш альбома)
+keyed_locks = KeyedLocks()
+
+
+def update_keys(update: Any) -> List[Hashable]:
+    keys: List[Hashable] = []
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        keys.append(("user", user.id))
+    msg = getattr(update, "effective_message", None)
+    mgid = getattr(msg, "media_group_id", None) if msg is not None else None
+    if mgid:
+        keys.append(("mg", mgid))
+    if not keys:
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            keys.append(("chat", chat.id))
+    return keys
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_running: int, max_queued: int | None = None, locks: KeyedLocks = keyed_locks):
+        super().__init__(max(max_running, max_queued or 4 * max_running))
+        self.locks = locks
+        self._running = asyncio.Semaphore(max_running)
+        self.processed = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # отметки задержки (latency.py): пришёл -> начал (после блокировки и слота) -> закончил
+        timing = latency.received()
+        async with self.locks.acquire(*update_keys(update)):
+            async with self._running:
+                latency.started(timing)
+                try:
+                    await coroutine
+                finally:
+                    latency.finished(timing)
+        self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
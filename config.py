@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -19,6 +20,128 @@ WEATHER_LON = float(os.getenv("WEATHER_LON", "30.35667"))
 WEATHER_CITY_LABEL = os.getenv("WEATHER_CITY_LABEL", "СПб")
 WEATHER_MIN_C = float(os.getenv("WEATHER_MIN_C", "10"))
 WEATHER_MAX_C = float(os.getenv("WEATHER_MAX_C", "20"))
+# как часто тикает weather_job (секунды); реальный опрос API всё равно не чаще MIN_FETCH_SECONDS
+WEATHER_TICK_S = float(os.getenv("WEATHER_TICK_S", "0.1"))
+
+# несколько районов: JSON-список [{"id", "label", "area", "lat", "lon", "min_c", "max_c"}, ...];
+# по умолчанию — один район из WEATHER_* выше. Заголовок канала берётся из первого
+def _weather_locations():
+    default = {"id": "main", "label": WEATHER_CITY_LABEL, "area": "Купчино",
+               "lat": WEATHER_LAT, "lon": WEATHER_LON, "min_c": WEATHER_MIN_C, "max_c": WEATHER_MAX_C}
+    try:
+        raw = json.loads(os.getenv("WEATHER_LOCATIONS", "") or "[]")
+    except ValueError:
+        raw = []
+    locs = []
+    for i, loc in enumerate(raw if isinstance(raw, list) else []):
+        if not isinstance(loc, dict) or "lat" not in loc or "lon" not in loc:
+            continue
+        d = dict(default, id=f"loc{i}")
+        d.update(loc)
+        d["label"] = loc.get("label") or loc.get("title") or d["id"]
+        d["area"] = loc.get("area") or loc.get("title") or d["label"]
+        d["lat"], d["lon"] = float(d["lat"]), float(d["lon"])
+        d["min_c"], d["max_c"] = float(d["min_c"]), float(d["max_c"])
+        locs.append(d)
+    return locs or [default]
+
+WEATHER_LOCATIONS = _weather_locations()
+# между запросами разных районов в одном опросе — пауза (квота API)
+WEATHER_STAGGER_S = float(os.getenv("WEATHER_STAGGER_S", "0.5"))
+
+# дедупликация сводок (dedup_receipts): срок жизни ключа, лимит ключей, Bloom спереди
+DEDUP_TTL_S = float(os.getenv("DEDUP_TTL_S", str(2 * 86400)))
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "50000"))
+DEDUP_BLOOM = os.getenv("DEDUP_BLOOM", "true").lower() == "true"
+DEDUP_BLOOM_FP_RATE = float(os.getenv("DEDUP_BLOOM_FP_RATE", "0.01"))
+
+# охват отбивки: точное множество до порога, дальше HyperLogLog (2^p регистров)
+REACH_EXACT_MAX = int(os.getenv("REACH_EXACT_MAX", "5000"))
+REACH_HLL_P = int(os.getenv("REACH_HLL_P", "12"))
+
+# допуск личных сообщений: личный темп (token bucket) и общий бюджет конвейера с очередью
+ADMIT_RATE_PER_MIN = float(os.getenv("ADMIT_RATE_PER_MIN", "10"))
+ADMIT_BURST = int(os.getenv("ADMIT_BURST", "5"))
+ADMIT_MAX_INFLIGHT = int(os.getenv("ADMIT_MAX_INFLIGHT", "16"))
+ADMIT_QUEUE_MAX = int(os.getenv("ADMIT_QUEUE_MAX", "64"))
+ADMIT_QUEUE_TIMEOUT_S = float(os.getenv("ADMIT_QUEUE_TIMEOUT_S", "30"))
+
+# индекс контента: повторы по file_unique_id / хэшу текста отсекаются до любых вызовов API
+CONTENT_TTL_S = float(os.getenv("CONTENT_TTL_S", str(7 * 86400)))
+CONTENT_MIN_CHARS = int(os.getenv("CONTENT_MIN_CHARS", "30"))   # тексты короче не адресуем
+CONTENT_MAX_KEYS = int(os.getenv("CONTENT_MAX_KEYS", "100000"))
+CONTENT_DUP_NOTICE = os.getenv("CONTENT_DUP_NOTICE", "true").lower() == "true"
+
+# почти-дубли текста (MinHash/LSH): окно, лимит документов, порог похожести (Жаккар),
+# размер подписи / число LSH-полос, длина шингла; тексты короче MIN_CHARS не кластеризуем
+NEARDUP_WINDOW_S = float(os.getenv("NEARDUP_WINDOW_S", "3600"))
+NEARDUP_MAX_DOCS = int(os.getenv("NEARDUP_MAX_DOCS", "20000"))
+NEARDUP_THRESHOLD = float(os.getenv("NEARDUP_THRESHOLD", "0.6"))
+NEARDUP_PERM = int(os.getenv("NEARDUP_PERM", "64"))
+NEARDUP_BANDS = int(os.getenv("NEARDUP_BANDS", "16"))
+NEARDUP_SHINGLE = int(os.getenv("NEARDUP_SHINGLE", "5"))
+NEARDUP_MAX_CANDIDATES = int(os.getenv("NEARDUP_MAX_CANDIDATES", "32"))
+NEARDUP_MIN_CHARS = int(os.getenv("NEARDUP_MIN_CHARS", "30"))
+
+# охват по дням/часам (rollups.py): сколько дней хранить и за сколько дней считать «по часам»
+ROLLUP_DAYS = int(os.getenv("ROLLUP_DAYS", "180"))
+ROLLUP_HOURS_WINDOW_DAYS = int(os.getenv("ROLLUP_HOURS_WINDOW_DAYS", "30"))
+
+# очередь модерации: срок жизни записи и параллельность массовой публикации
+MODQ_TTL_S = float(os.getenv("MODQ_TTL_S", str(3 * 86400)))
+MODQ_EXPIRE_EVERY_S = float(os.getenv("MODQ_EXPIRE_EVERY_S", "3600"))   # как часто снимать просроченное
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "20"))
+PUBLISH_CONCURRENCY = int(os.getenv("PUBLISH_CONCURRENCY", "4"))
+
+# супервизор: сколько ждём дозавершения обработчиков при остановке/перезапуске транспорта;
+# отложенные задачи, которым до запуска меньше SHUTDOWN_FIRE_WITHIN_S (флеш альбомов,
+# дайджест), при остановке выполняются досрочно, а не теряются
+DRAIN_TIMEOUT_S = float(os.getenv("DRAIN_TIMEOUT_S", "20"))
+SHUTDOWN_FIRE_WITHIN_S = float(os.getenv("SHUTDOWN_FIRE_WITHIN_S", "120"))
+RESTART_MAX_BACKOFF_S = float(os.getenv("RESTART_MAX_BACKOFF_S", "60"))
+
+# параллельная обработка апдейтов: сколько обработчиков выполняется одновременно
+# (апдейты одного пользователя/альбома всё равно идут по очереди)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# модчат: режим дайджеста при всплеске (сообщений в минуту: включить / выключить)
+RELAY_DIGEST_ON_PER_MIN = float(os.getenv("RELAY_DIGEST_ON_PER_MIN", "30"))
+RELAY_DIGEST_OFF_PER_MIN = float(os.getenv("RELAY_DIGEST_OFF_PER_MIN", "15"))
+RELAY_WINDOW_S = float(os.getenv("RELAY_WINDOW_S", "60"))
+RELAY_DIGEST_INTERVAL_S = float(os.getenv("RELAY_DIGEST_INTERVAL_S", "60"))
+
+# трассировка заявок (приём -> модчат -> решение -> канал -> сводка): сколько
+# завершённых трасс держим для перцентилей и /slow
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "1000"))
+
+# разложение задержки доставки (latency.py): сколько значений на отрезок держим для перцентилей;
+# доставка дольше LATENCY_MAX_PLAUSIBLE_S — апдейт ждал, пока бот не работал: скорость не считаем
+LATENCY_RING_SIZE = int(os.getenv("LATENCY_RING_SIZE", "2000"))
+LATENCY_MAX_PLAUSIBLE_S = float(os.getenv("LATENCY_MAX_PLAUSIBLE_S", "120"))
+
+# /export: размер одного документа (сжатого) — с запасом до лимита Bot API на загрузку (50 MB)
+EXPORT_CHUNK_MB = float(os.getenv("EXPORT_CHUNK_MB", "45"))
+
+# сводки доставки пользователю: доставки одного автора, пришедшие подряд, объединяются
+# в одну сводку; окно подстраивается под темп автора (RECEIPT_WINDOW_MIN_S..MAX_S)
+RECEIPT_WINDOW_MIN_S = float(os.getenv("RECEIPT_WINDOW_MIN_S", "0"))
+RECEIPT_WINDOW_MAX_S = float(os.getenv("RECEIPT_WINDOW_MAX_S", "20"))
+RECEIPT_MAX_BATCH = int(os.getenv("RECEIPT_MAX_BATCH", "10"))
+
+# рассылки (broadcast.py): ежедневные и отбивка — в каналы BROADCAST_CHANNEL_IDS (через запятую,
+# по умолчанию UNCHECK_CHANNEL_ID) и подписчикам (/subscribe). Общий темп — BROADCAST_RATE_PER_S
+# (лимит Bot API ~30/с), в один чат — не чаще раза в BROADCAST_USER_INTERVAL_S (личка) /
+# BROADCAST_CHAT_INTERVAL_S (каналы и группы, ~20/мин); прогресс — в state раз в
+# BROADCAST_CHECKPOINT_EVERY получателей; прерванная рассылка старше BROADCAST_JOB_TTL_S не продолжается
+BROADCAST_CHANNEL_IDS = [int(x) for x in os.getenv("BROADCAST_CHANNEL_IDS", str(UNCHECK_CHANNEL_ID)).split(",")
+                         if x.strip() and int(x) != 0]
+BROADCAST_RATE_PER_S = float(os.getenv("BROADCAST_RATE_PER_S", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_USER_INTERVAL_S = float(os.getenv("BROADCAST_USER_INTERVAL_S", "1"))
+BROADCAST_CHAT_INTERVAL_S = float(os.getenv("BROADCAST_CHAT_INTERVAL_S", "3"))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "200"))
+BROADCAST_REPORT_EVERY_S = float(os.getenv("BROADCAST_REPORT_EVERY_S", "15"))
+BROADCAST_JOB_TTL_S = float(os.getenv("BROADCAST_JOB_TTL_S", str(6 * 3600)))
 
 # Ежедневные сообщения
 DAILY_ENABLE = os.getenv("DAILY_ENABLE", "false").lower() == "true"
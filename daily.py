@@ -1,12 +1,14 @@
 import random
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 from zoneinfo import ZoneInfo
 from telegram.ext import ContextTypes
 from telegram import Update
 
-from config import UNCHECK_CHANNEL_ID, TIMEZONE, DAILY_MORNING, DAILY_EVENING
+import clock
+from config import TIMEZONE, DAILY_MORNING, DAILY_EVENING
 from state import save_state
+from broadcast import broadcaster
 
 log = logging.getLogger("daily")
 
@@ -88,7 +90,7 @@ def _parse_hhmm(s: str):
 
 def _seconds_until_next(hh: int, mm: int, tz: str):
     z = ZoneInfo(tz)
-    now = datetime.now(z)
+    now = clock.now(z)
     target = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
     if target <= now:
         target += timedelta(days=1)
@@ -100,7 +102,8 @@ async def morning_job(context: ContextTypes.DEFAULT_TYPE):
     pool = d.get("morning_pool") or MORNING_TEMPLATES
     msg = random.choice(pool)
     try:
-        await context.bot.send_message(chat_id=UNCHECK_CHANNEL_ID, text=msg)
+        # в каналы и подписчикам — через движок рассылок (темп, докачка после рестарта)
+        broadcaster.submit(context.application, state, "morning", msg)
     except Exception:
         log.exception("morning_job send fail")
 
@@ -110,7 +113,8 @@ async def evening_job(context: ContextTypes.DEFAULT_TYPE):
     pool = d.get("evening_pool") or EVENING_TEMPLATES
     msg = random.choice(pool)
     try:
-        await context.bot.send_message(chat_id=UNCHECK_CHANNEL_ID, text=msg)
+        # в каналы и подписчикам — через движок рассылок (темп, докачка после рестарта)
+        broadcaster.submit(context.application, state, "evening", msg)
     except Exception:
         log.exception("evening_job send fail")
 
@@ -127,14 +131,14 @@ async def cmd_daily_on(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = context.application.bot_data["state"]
     d = state.setdefault("daily", {})
     d["enabled"] = True
-    save_state(state)
+    save_state(state, "daily")
     await update.message.reply_text("Ежедневные сообщения: включены.")
 
 async def cmd_daily_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = context.application.bot_data["state"]
     d = state.setdefault("daily", {})
     d["enabled"] = False
-    save_state(state)
+    save_state(state, "daily")
     await update.message.reply_text("Ежедневные сообщения: выключены.")
 
 async def cmd_daily_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -166,5 +170,5 @@ async def cmd_daily_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pool = d.get(key) or (MORNING_TEMPLATES if key == "morning_pool" else EVENING_TEMPLATES)
     pool = list(pool) + [text]
     d[key] = pool
-    save_state(state)
+    save_state(state, "daily")
     await update.message.reply_text("Шаблон добавлен.")
\ No newline at end of file
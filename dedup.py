@@ -0,0 +1,225 @@
+# dedup.py
+"""
+Ограниченный TTL/LRU-набор ключей (dedup_receipts и т.п.) с опциональным
+Bloom-фильтром спереди.
+
+  - у каждого ключа свой срок жизни (expiry, epoch);
+  - при попадании ключ «освежается» и уходит в конец, поэтому порядок
+    OrderedDict совпадает с порядком истечения: очистка снимает только префикс;
+  - при превышении max_keys вытесняем самые старые (LRU);
+  - на диск: список ключей + base64-массив expiry, без True на каждый ключ.
+"""
+import base64
+import hashlib
+import sys
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict
+
+import clock
+from config import DEDUP_TTL_S, DEDUP_MAX_KEYS, DEDUP_BLOOM, DEDUP_BLOOM_FP_RATE
+
+
+class BloomFilter:
+    """Классический Bloom на bytearray; k хэшей из одного blake2b (double hashing)."""
+    __slots__ = ("m", "k", "bits", "count")
+
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        import math
+        capacity = max(1, int(capacity))
+        m = int(-capacity * math.log(fp_rate) / (math.log(2) ** 2))
+        self.m = max(64, m)
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        h = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        m = self.m
+        for i in range(self.k):
+            yield (h1 + i * h2) % m
+
+    def add(self, key: str):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class TTLCache:
+    """key -> value с per-key expiry и ограничением по числу ключей."""
+    __slots__ = ("ttl", "max_keys", "_d", "hits", "misses", "expired", "evicted")
+
+    def __init__(self, ttl: float = DEDUP_TTL_S, max_keys: int = DEDUP_MAX_KEYS):
+        self.ttl = float(ttl)
+        self.max_keys = int(max_keys)
+        # key -> (expiry, value); кортежи не мутируются, поэтому copy() — это копия OrderedDict
+        self._d: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key) -> bool:
+        rec = self._d.get(key)
+        return rec is not None and rec[0] > clock.time()
+
+    def get(self, key, default=None, now: float | None = None):
+        now = clock.time() if now is None else now
+        rec = self._d.get(key)
+        if rec is None or rec[0] <= now:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._d[key] = (now + self.ttl, rec[1])
+        self._d.move_to_end(key)
+        return rec[1]
+
+    def peek(self, key, default=None, now: float | None = None):
+        """Как get, но срок ключа не продлеваем."""
+        now = clock.time() if now is None else now
+        rec = self._d.get(key)
+        if rec is None or rec[0] <= now:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return rec[1]
+
+    def put(self, key, value: Any = True, now: float | None = None):
+        now = clock.time() if now is None else now
+        known = key in self._d
+        self._d[key] = (now + self.ttl, value)
+        if known:
+            self._d.move_to_end(key)
+        else:
+            self._on_insert(key)
+        while len(self._d) > self.max_keys:
+            self._d.popitem(last=False)
+            self.evicted += 1
+
+    def pop(self, key, default=None):
+        rec = self._d.pop(key, None)
+        return default if rec is None else rec[1]
+
+    def _on_insert(self, key):
+        pass
+
+    def prune(self, now: float | None = None) -> int:
+        """Снимаем просроченный префикс; возвращаем число удалённых."""
+        now = clock.time() if now is None else now
+        d = self._d
+        n = 0
+        while d:
+            key, rec = next(iter(d.items()))
+            if rec[0] > now:
+                break
+            d.popitem(last=False)
+            n += 1
+        self.expired += n
+        return n
+
+    def copy(self) -> "TTLCache":
+        """Снимок для фоновой записи (только данные, без Bloom и счётчиков)."""
+        c = TTLCache(self.ttl, self.max_keys)
+        c._d = self._d.copy()
+        return c
+
+    def stats(self) -> Dict[str, Any]:
+        return {"keys": len(self._d), "hits": self.hits, "misses": self.misses,
+                "expired": self.expired, "evicted": self.evicted}
+
+    # ---- сериализация ----
+    def to_dense(self) -> Dict[str, Any]:
+        exp = array("q", (int(rec[0]) for rec in self._d.values()))
+        if sys.byteorder != "little":
+            exp.byteswap()
+        out = {"ttl": self.ttl, "keys": list(self._d), "exp": base64.b64encode(exp.tobytes()).decode("ascii")}
+        if any(rec[1] is not True for rec in self._d.values()):
+            out["vals"] = [rec[1] for rec in self._d.values()]
+        return out
+
+    @classmethod
+    def from_dense(cls, d, **kw) -> "TTLCache":
+        c = cls(**kw)
+        if not isinstance(d, dict):
+            return c
+        now = clock.time()
+        if "keys" in d and "exp" in d:
+            exp = array("q")
+            exp.frombytes(base64.b64decode(d.get("exp") or ""))
+            if sys.byteorder != "little":
+                exp.byteswap()
+            vals = d.get("vals")
+            for i, (key, e) in enumerate(zip(d.get("keys") or [], exp)):
+                if e > now:
+                    c._d[key] = (float(e), vals[i] if vals and i < len(vals) else True)
+                    c._on_insert(key)
+        else:
+            # старый формат {key: True} — без timestamp, даём полный срок жизни
+            for key, v in d.items():
+                c._d[key] = (now + c.ttl, v)
+                c._on_insert(key)
+        while len(c._d) > c.max_keys:
+            c._d.popitem(last=False)
+        return c
+
+
+class DedupCache(TTLCache):
+    """TTLCache для «уже видели ключ?» + Bloom-фильтр для быстрых отрицательных ответов."""
+    __slots__ = ("bloom", "bloom_negatives", "bloom_passed_misses")
+
+    def __init__(self, ttl: float = DEDUP_TTL_S, max_keys: int = DEDUP_MAX_KEYS, bloom: bool = DEDUP_BLOOM):
+        super().__init__(ttl, max_keys)
+        self.bloom = BloomFilter(max_keys, DEDUP_BLOOM_FP_RATE) if bloom else None
+        self.bloom_negatives = 0
+        # Bloom сказал «возможно», а живого ключа нет: ложные срабатывания вместе с ключами,
+        # которые истекли или вытеснены (Bloom их не забывает до пересборки) — различить нельзя
+        self.bloom_passed_misses = 0
+
+    def _on_insert(self, key):
+        if self.bloom is not None:
+            self.bloom.add(key)
+
+    def _rebuild_bloom(self):
+        self.bloom = BloomFilter(self.max_keys, DEDUP_BLOOM_FP_RATE)
+        for key in self._d:
+            self.bloom.add(key)
+
+    def seen(self, key: str, now: float | None = None) -> bool:
+        if self.bloom is not None and key not in self.bloom:
+            self.bloom_negatives += 1
+            self.misses += 1
+            return False
+        hit = self.get(key, None, now) is not None
+        if not hit and self.bloom is not None:
+            self.bloom_passed_misses += 1
+        return hit
+
+    def check_and_add(self, key: str, now: float | None = None) -> bool:
+        """True — ключ уже был (дубль); иначе запоминаем и возвращаем False."""
+        if self.seen(key, now):
+            return True
+        self.put(key, True, now)
+        return False
+
+    def prune(self, now: float | None = None) -> int:
+        n = super().prune(now)
+        # Bloom не умеет удалять: когда вставок накопилось вдвое больше живых ключей — пересобираем
+        if self.bloom is not None and self.bloom.count > 2 * max(len(self._d), self.max_keys // 4):
+            self._rebuild_bloom()
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        st = super().stats()
+        st.update(bloom=self.bloom is not None, bloom_negatives=self.bloom_negatives,
+                  bloom_passed_misses=self.bloom_passed_misses)
+        return st
@@ -0,0 +1,77 @@
+# downsample.py
+"""
+Прореживание рядов перед графиком: фиксированный бюджет точек вместо всех сэмплов.
+
+  lttb    — Largest-Triangle-Three-Buckets: из каждой корзины берём точку,
+            дающую наибольший треугольник с соседями; форма и пики сохраняются;
+  minmax  — в каждой корзине min и max (в исходном порядке): ни один экстремум
+            не теряется, точек — до 2 на корзину.
+
+На вход — xs (возрастают) и ys одинаковой длины; на выход — новые списки.
+Если точек и так не больше бюджета, ряд возвращается как есть.
+"""
+from typing import List, Sequence, Tuple
+
+
+def lttb(xs: Sequence[float], ys: Sequence[float], n: int) -> Tuple[List[float], List[float]]:
+    size = len(xs)
+    if n >= size or n < 3:
+        return list(xs), list(ys)
+    out_x = [xs[0]]
+    out_y = [ys[0]]
+    every = (size - 2) / (n - 2)
+    a = 0
+    for i in range(n - 2):
+        # среднее следующей корзины — третья вершина треугольника
+        nxt_lo = int((i + 1) * every) + 1
+        nxt_hi = min(int((i + 2) * every) + 1, size)
+        cnt = nxt_hi - nxt_lo
+        avg_x = sum(xs[nxt_lo:nxt_hi]) / cnt
+        avg_y = sum(ys[nxt_lo:nxt_hi]) / cnt
+
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = lo, -1.0
+        dx = avg_x - ax
+        dy = avg_y - ay
+        for j in range(lo, hi):
+            # удвоенная площадь; константа не влияет на выбор
+            area = abs(dx * (ys[j] - ay) - (xs[j] - ax) * dy)
+            if area > best_area:
+                best, best_area = j, area
+        out_x.append(xs[best])
+        out_y.append(ys[best])
+        a = best
+    out_x.append(xs[-1])
+    out_y.append(ys[-1])
+    return out_x, out_y
+
+
+def minmax(xs: Sequence[float], ys: Sequence[float], n: int) -> Tuple[List[float], List[float]]:
+    size = len(xs)
+    if n >= size or n < 2:
+        return list(xs), list(ys)
+    buckets = max(1, n // 2)
+    every = size / buckets
+    out_x: List[float] = []
+    out_y: List[float] = []
+    for b in range(buckets):
+        lo = int(b * every)
+        hi = min(int((b + 1) * every), size)
+        if lo >= hi:
+            continue
+        seg = ys[lo:hi]
+        i_min = lo + min(range(len(seg)), key=seg.__getitem__)
+        i_max = lo + max(range(len(seg)), key=seg.__getitem__)
+        for j in sorted({i_min, i_max}):
+            out_x.append(xs[j])
+            out_y.append(ys[j])
+    return out_x, out_y
+
+
+METHODS = {"lttb": lttb, "minmax": minmax}
+
+
+def downsample(xs, ys, n: int, method: str = "lttb") -> Tuple[List[float], List[float]]:
+    return METHODS[method](xs, ys, n)
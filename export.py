@@ -0,0 +1,240 @@
+# export.py
+"""
+/export — сырые данные доставок документами в модчат.
+
+Конвейер из генераторов, память не зависит от объёма:
+  источник (строки-dict) -> кодировщик (CSV/JSONL, построчно) -> нарезка на
+  gzip-файлы во временном каталоге (не больше EXPORT_CHUNK_MB сжатых байт каждый)
+  -> загрузка по одному, по порядку.
+
+Источники:
+  history — горячая история из state (копия колонок, как для фоновой записи);
+  archive — долгий архив (archive.py), файл за файлом с диска;
+  users   — сводка по пользователям из горячей истории.
+Каждый кусок — самостоятельный файл (CSV — со своей строкой заголовка).
+
+Сжатие и чтение идут в потоке, загрузка — фоновой задачей: обработка апдейтов
+не ждёт. Одновременно — один экспорт.
+"""
+import asyncio
+import csv
+import gzip
+import heapq
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+from config import MOD_GROUP_ID, EXPORT_CHUNK_MB
+from state import copy_value, get_archive
+from archive import parse_range
+from history import DeliveryLog
+from utils import fmt_size, compute_stats
+
+log = logging.getLogger("export")
+
+FIELDS = {
+    "history": ["uid", "username", "full_name", "ts", "time_utc", "size", "dur", "speed"],
+    "archive": ["uid", "ts", "time_utc", "size", "dur", "speed"],
+    "users": ["uid", "username", "full_name", "messages", "bytes", "first_utc", "last_utc",
+              "dur_median", "speed_mean", "speed_median"],
+}
+FORMATS = ("csv", "jsonl")
+CHECK_EVERY = 512          # как часто (строк) сверяем размер куска
+
+
+def _iso(ts) -> str | None:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M:%S") if ts is not None else None
+
+
+# ---- источники ----
+def history_rows(store, start_ts=None, end_ts=None) -> Iterator[Dict[str, Any]]:
+    """Все доставки горячей истории по возрастанию ts (слияние колонок пользователей)."""
+    def _user(uid, dlog):
+        username, full_name = store.user(uid)
+        for ts, size, dur, speed in dlog.rows():
+            if (start_ts is None or ts >= start_ts) and (end_ts is None or ts < end_ts):
+                yield ts, uid, username, full_name, size, dur, speed
+    for ts, uid, username, full_name, size, dur, speed in heapq.merge(
+            *(_user(uid, dlog) for uid, dlog in store.items()), key=lambda r: r[0]):
+        yield {"uid": uid, "username": username, "full_name": full_name, "ts": ts, "time_utc": _iso(ts),
+               "size": size, "dur": dur, "speed": speed}
+
+
+def archive_rows(arch, start_ts=None, end_ts=None) -> Iterator[Dict[str, Any]]:
+    arch.flush()   # чтобы попало и то, что ещё в буфере
+    for rec in arch.iter_records(start_ts, end_ts):
+        rec["time_utc"] = _iso(rec.get("ts"))
+        yield rec
+
+
+def _in_range(dlog, start_ts, end_ts) -> DeliveryLog:
+    """Доставки пользователя в [start_ts, end_ts) — отдельным журналом (по нему и считаем сводку)."""
+    if start_ts is None and end_ts is None:
+        return dlog
+    part = DeliveryLog()
+    for ts, size, dur, speed in dlog.rows():
+        if (start_ts is None or ts >= start_ts) and (end_ts is None or ts < end_ts):
+            part.append(ts, size, dur, speed)
+    return part
+
+
+def user_rows(store, start_ts=None, end_ts=None) -> Iterator[Dict[str, Any]]:
+    for uid, dlog in store.items():
+        dlog = _in_range(dlog, start_ts, end_ts)
+        if not len(dlog):
+            continue
+        username, full_name = store.user(uid)
+        st = compute_stats(dlog)
+        yield {"uid": uid, "username": username, "full_name": full_name, "messages": len(dlog),
+               "bytes": dlog.total_bytes(), "first_utc": _iso(dlog.ts[0]), "last_utc": _iso(dlog.ts[-1]),
+               "dur_median": st["times"].get("median"), "speed_mean": st["speeds_bps"].get("mean"),
+               "speed_median": st["speeds_bps"].get("median")}
+
+
+# ---- кодирование и нарезка ----
+def encode(rows: Iterable[Dict[str, Any]], fmt: str, fields: List[str]) -> Iterator[bytes]:
+    if fmt == "jsonl":
+        for r in rows:
+            yield (json.dumps({k: r.get(k) for k in fields}, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        return
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    for r in rows:
+        w.writerow(["" if r.get(k) is None else r.get(k) for k in fields])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+
+
+def csv_header(fields: List[str]) -> bytes:
+    return (",".join(fields) + "\n").encode("utf-8")
+
+
+def chunk_files(lines: Iterable[bytes], tmpdir: str, base: str, ext: str, header: bytes = b"",
+                limit_bytes: int = int(EXPORT_CHUNK_MB * 1024 * 1024)) -> Iterator[Dict[str, Any]]:
+    """Пишем строки в gzip-файлы не больше limit_bytes (сжатых) каждый;
+    отдаём {"path", "rows", "raw", "size"} по мере готовности."""
+    n = 0
+    out = None
+
+    def _open():
+        nonlocal n
+        n += 1
+        path = os.path.join(tmpdir, f"{base}.part{n:03d}{ext}")
+        raw = open(path, "wb")
+        gz = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+        if header:
+            gz.write(header)
+        return {"path": path, "raw_f": raw, "gz": gz, "rows": 0, "raw": len(header)}
+
+    def _close(o):
+        o["gz"].close()
+        o["raw_f"].close()
+        return {"path": o["path"], "rows": o["rows"], "raw": o["raw"], "size": os.path.getsize(o["path"])}
+
+    for line in lines:
+        if out is None:
+            out = _open()
+        out["gz"].write(line)
+        out["rows"] += 1
+        out["raw"] += len(line)
+        # сжатое отстаёт от записанного на буфер компрессора — сверяем с запасом
+        if out["rows"] % CHECK_EVERY == 0 and out["raw_f"].tell() + 256 * 1024 >= limit_bytes:
+            yield _close(out)
+            out = None
+    if out is not None:
+        yield _close(out)
+
+
+# ---- фоновая выгрузка ----
+_running = False
+
+
+async def run_export(bot, chat_id: int, make_lines: Callable[[], Iterable[bytes]], base: str, ext: str,
+                     header: bytes = b"", limit_bytes: int | None = None) -> Dict[str, Any]:
+    """Куски готовим в потоке по одному и сразу загружаем; на диске — не больше одного куска."""
+    tmpdir = tempfile.mkdtemp(prefix="export-")
+    total = {"parts": 0, "rows": 0, "raw": 0, "size": 0}
+    try:
+        kw = {"limit_bytes": limit_bytes} if limit_bytes else {}
+        chunks = chunk_files(make_lines(), tmpdir, base, ext, header, **kw)   # генератор: работа — в next()
+        while True:
+            part = await asyncio.to_thread(next, chunks, None)
+            if part is None:
+                break
+            total["parts"] += 1
+            for k in ("rows", "raw", "size"):
+                total[k] += part[k]
+            with open(part["path"], "rb") as f:
+                await bot.send_document(chat_id=chat_id, document=f, filename=os.path.basename(part["path"]),
+                                        caption=f"Часть {total['parts']}: {part['rows']} строк")
+            os.remove(part["path"])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return total
+
+
+async def _export_task(bot, chat_id, make_lines, base, ext, header):
+    global _running
+    try:
+        t = await run_export(bot, chat_id, make_lines, base, ext, header)
+        text = (f"Экспорт {base}: {t['rows']} строк, {t['parts']} файл(ов), "
+                f"{fmt_size(t['raw'])} -> {fmt_size(t['size'])} сжато." if t["parts"] else f"Экспорт {base}: данных нет.")
+    except Exception as e:
+        log.exception("export failed")
+        text = f"Экспорт {base} прерван: {e}"
+    finally:
+        _running = False
+    try:
+        await bot.send_message(chat_id=chat_id, text=text)
+    except Exception:
+        pass
+
+
+async def cmd_export(update, context, state):
+    """/export [history|archive|users] [csv|jsonl] [YYYY-MM-DD [YYYY-MM-DD]]"""
+    global _running
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    from moderation import is_admin
+    if not await is_admin(context, update.effective_user.id): return
+    args = list(context.args or [])
+    arch = get_archive()
+    kind = args.pop(0) if args and args[0] in FIELDS else ("archive" if arch is not None else "history")
+    fmt = args.pop(0) if args and args[0] in FORMATS else "csv"
+    try:
+        start, end = parse_range(args)
+    except Exception:
+        await update.message.reply_text("Формат: /export [history|archive|users] [csv|jsonl] [YYYY-MM-DD [YYYY-MM-DD]]")
+        return
+    if kind == "archive" and arch is None:
+        await update.message.reply_text("Архив истории выключен (ARCHIVE_ENABLE=false).")
+        return
+    if _running:
+        await update.message.reply_text("Экспорт уже идёт — дождитесь окончания.")
+        return
+
+    fields = FIELDS[kind]
+    if kind == "archive":
+        source = lambda: archive_rows(arch, start, end)
+    else:
+        # горячая история меняется на event loop — читаем копию колонок
+        store = copy_value("history", state["history"])
+        rows = history_rows if kind == "history" else user_rows
+        source = lambda: rows(store, start, end)
+    make_lines = lambda: encode(source(), fmt, fields)
+    header = csv_header(fields) if fmt == "csv" else b""
+    base = f"{kind}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}"
+
+    _running = True   # до ответа: пока он уходит, второй /export не должен пройти проверку
+    try:
+        await update.message.reply_text(f"Готовлю экспорт {kind} ({fmt}, gzip); файлы придут сюда по мере готовности.")
+    except Exception:
+        _running = False   # задача не запустится — не оставляем /export запертым
+        raise
+    # загрузка — фоновой задачей, обработчик сразу освобождается
+    context.application.create_task(_export_task(context.bot, update.effective_chat.id, make_lines, base, f".{fmt}.gz", header))
@@ -1,73 +1,110 @@
+import hashlib
 import math
 from datetime import timezone
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyParameters
 from telegram.ext import ContextTypes
-from config import MOD_GROUP_ID, UNCHECK_CHANNEL_ID, APPROVED_CHANNEL_ID, MEDIA_GROUP_WAIT, TIMEZONE
+from config import (MOD_GROUP_ID, UNCHECK_CHANNEL_ID, MEDIA_GROUP_WAIT, TIMEZONE, RELAY_DIGEST_INTERVAL_S,
+                    CONTENT_DUP_NOTICE, CONTENT_MIN_CHARS, NEARDUP_MIN_CHARS)
 from state import save_state
 from utils import fmt_size, human_speed, compute_stats, now_utc
-from energy import EnergyInput, estimate_energy
-from moderation import decision_keyboard, upsert_control_message
+from receipts import receipts, format_receipt
+from moderation import decision_keyboard, upsert_control_message, bumper_reach, apply_decisions
+from concurrency import keyed_locks
+from relay import mod_relay
+from neardup import near_index
+from admission import admission, Admission
+from tracing import tracer
+import latency
+from models import from_message, album_item, encode_item, decode_item, AlbumPayload, PendingMember
+from publish import publish_payload
 def get_scheduler(context):
-    # если есть «родной» PTB JobQueue — используй его, иначе наш фолбэк из bot_data
-    jq = getattr(context, "job_queue", None)
-    return jq if jq is not None else context.application.bot_data.get("scheduler")
+    # наш планировщик из bot_data живёт дольше Application (переживает тёплый перезапуск,
+    # при остановке досрочно выполняет короткие отложенные задачи); PTB JobQueue — фолбэк
+    sched = context.application.bot_data.get("scheduler")
+    return sched if sched is not None else context.job_queue
 # ====== Вспомогательные ======
-def payload_size_bytes(payload) -> int:
-    t = payload.get('type')
-    try:
-        if t == 'text':
-            return len((payload.get('text') or "").encode("utf-8"))
-        if t in ('photo','video','document'):
-            return int(payload.get('file_size') or 0)
-        if t == 'media_group':
-            return sum(int(it.get('file_size') or 0) for it in payload.get('items', []))
-    except Exception:
-        pass
-    return 0
-
 def dedup_key(chat_id, msg_id):
     return f"{chat_id}:{msg_id}"
 
+def content_key(msg) -> str | None:
+    """Адрес контента: file_unique_id медиа или хэш нормализованного текста.
+    Короткие тексты («спасибо», «+») не адресуем: у разных людей они совпадают законно."""
+    media = (msg.photo[-1] if getattr(msg, "photo", None) else
+             getattr(msg, "video", None) or getattr(msg, "document", None))
+    if media is not None and getattr(media, "file_unique_id", None):
+        return f"f:{media.file_unique_id}"
+    text = getattr(msg, "text", None)
+    if text:
+        norm = " ".join(text.casefold().split())
+        if len(norm) < CONTENT_MIN_CHARS:
+            return None
+        return "t:" + hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest()
+    return None
+
+def repeat_of(state, key):
+    """Первая отправка такого контента (в пределах CONTENT_TTL_S от неё) или None.
+    Срок ключа не продлеваем: иначе частый повтор не истечёт никогда."""
+    return state["content_index"].peek(key) if key is not None else None
+
+def remember_content(state, keys, uid, ts):
+    """Запоминаем контент, только когда он дошёл (модчат в CHECK, канал в UNCHECK):
+    иначе повтор автора после сбоя отвергли бы на весь CONTENT_TTL_S."""
+    index = state["content_index"]
+    new = [k for k in keys if k is not None and repeat_of(state, k) is None]
+    for k in new:
+        index.put(k, {"uid": uid, "ts": ts})
+    if new:
+        save_state(state, "content_index")
+
+def note_repeat(key, first, uid, username, full_name):
+    """Повтор не уходит ни в модчат, ни в канал и не учитывается в истории — только строка в дайджесте."""
+    if not CONTENT_DUP_NOTICE:
+        return
+    who = f"@{username}" if username else full_name
+    same = first.get("uid") == uid
+    kind = "альбом" if key == "album" else "файл" if key.startswith("f:") else "текст"
+    mod_relay.add_to_digest(f"Повтор ({kind}) от {who} (ID {uid})"
+                            + ("" if same else f"; впервые прислал ID {first.get('uid')}"))
+
+REPEAT_REPLY = "Такое сообщение уже присылали — повтор не отправлен."
+
 async def send_user_receipt_once(context, state, user_chat_id: int, key: str, *,
                                  size_b: int, speed_bps: float | None,
                                  delivery_seconds: float | None,
                                  rtt_ms: float | None):
-    """Отправить пользователю сводку (со скоростью и энергией) только 1 раз на доставку."""
-    if state["dedup_receipts"].get(key):
+    """Сводка (со скоростью и энергией) — 1 раз на доставку; доставки автора подряд
+    объединяются в одну сводку (см. receipts.py)."""
+    if state["dedup_receipts"].check_and_add(key):
         return
-    state["dedup_receipts"][key] = True
-    save_state(state)
-
-    # энергомодель (auto сеть)
-    energy = estimate_energy(EnergyInput(total_bytes=size_b, duration_s=delivery_seconds, rtt_ms=rtt_ms, network="auto"))
-    net_line = f", сеть: {energy.get('network')}" if energy.get("has_duration") else ""
-    if energy.get("has_duration"):
-        energy_line = f"Энергия (оценка): {energy['total_j']:.2f} Дж (~{(energy['j_per_mb'] or 0):.4f} Дж/MB){net_line}"
-    else:
-        energy_line = f"Энергия: нужна длительность для точной оценки"
+    save_state(state, "dedup_receipts")
+    batch, window, new = receipts.add(user_chat_id, size_b, delivery_seconds, rtt_ms)
+    if window <= 0:
+        await _send_receipt(context, state, user_chat_id)
+    elif new:
+        get_scheduler(context).run_once(flush_receipt, when=window, data={"uid": user_chat_id, "bid": batch.bid})
 
-    text = (
-        "Сводка доставки:\n"
-        f" • Размер: {fmt_size(size_b)}\n"
-        f" • Скорость: {human_speed(speed_bps)}\n"
-        f" • Длительность: {delivery_seconds:.3f}s\n"
-        f" • {energy_line}\n"
-    )
+async def flush_receipt(context: ContextTypes.DEFAULT_TYPE):
+    state = context.application.bot_data["state"]
+    data = context.job.data or {}
+    await _send_receipt(context, state, data.get("uid"), data.get("bid"))
+
+async def _send_receipt(context, state, user_chat_id, bid=None):
+    batch = receipts.take(user_chat_id, bid)
+    if batch is None:
+        return   # уже ушла (досрочно, по размеру пачки); открытая сейчас — другая, со своим таймером
+    text = format_receipt(batch)
 
     # отбивка (если активна)
     bumper = state.get("bumper", {})
     if bumper.get("active") and bumper.get("text"):
         text += f"\n{bumper['text']}"
-        # учёт охвата
-        reach = set(bumper.get("reach_user_ids", []))
-        reach.add(int(user_chat_id))
-        bumper["reach_user_ids"] = list(reach)
-        save_state(state)
-        # обновим закреп (чтобы в модчате росло число)
-        try:
-            await upsert_control_message(context.application, state)
-        except Exception:
-            pass
+        # учёт охвата: O(1); закреп обновляем, только если счётчик мог вырасти
+        if bumper_reach(bumper).add(int(user_chat_id)):
+            save_state(state, "bumper")
+            try:
+                await upsert_control_message(context.application, state)
+            except Exception:
+                pass
 
     try:
         await context.bot.send_message(chat_id=user_chat_id, text=text)
@@ -87,7 +124,7 @@ async def cb_mode_toggle(update, context, state):
     await q.answer()
     new_mode = q.data.split("_",1)[1]
     state["mode"] = new_mode
-    save_state(state)
+    save_state(state, "mode")
     await upsert_control_message(context.application, state)
     try:
         await q.edit_message_reply_markup(reply_markup=None)
@@ -99,43 +136,84 @@ async def handle_private(update, context, state):
     msg = update.effective_message
     if not msg: return
     user = msg.from_user
+    sent_dt = msg.date
+    if sent_dt and sent_dt.tzinfo is None:
+        sent_dt = sent_dt.replace(tzinfo=timezone.utc)  # type: ignore
+    timing = latency.current()
+    trace = tracer.start("private", user.id, sent_dt.timestamp() if sent_dt else None,
+                         timing.recv_wall if timing is not None else None)
+
+    # допуск: личный темп, затем место в общем бюджете конвейера (см. admission.py)
+    if admission.check_rate(user.id, group=getattr(msg, "media_group_id", None)) != Admission.ADMIT:
+        tracer.discard(trace)
+        wait = admission.should_notify(user.id)
+        if wait is not None:
+            try:
+                await msg.reply_text(f"Слишком много сообщений подряд — попробуйте через {max(1, round(wait))} с.")
+            except Exception:
+                pass
+        return
+    if not await admission.acquire():
+        tracer.discard(trace)
+        try:
+            await msg.reply_text("Бот сейчас перегружен — отправьте сообщение чуть позже.")
+        except Exception:
+            pass
+        return
+    trace.mark("admitted")
+    try:
+        await _handle_private(update, context, state, msg, user, trace)
+    finally:
+        admission.release()
+
+async def _handle_private(update, context, state, msg, user, trace):
     uid = str(user.id)
 
+    # точный повтор контента — отсекаем до любых вызовов API (альбом проверяется целиком, при флеше)
+    ckey = content_key(msg)
+    first = None if getattr(msg, "media_group_id", None) else repeat_of(state, ckey)
+    if first is not None:
+        note_repeat(ckey, first, user.id, user.username, user.full_name)
+        tracer.discard(trace)
+        _schedule_digest(context)
+        try:
+            await msg.reply_text(REPEAT_REPLY)
+        except Exception:
+            pass
+        return
+
     # учёт счётчика
     count = int(state["counts"].get(uid, 0)) + 1
     state["counts"][uid] = count
-    save_state(state)
+    save_state(state, "counts")
 
-    # определяем payload + размер
-    payload = {"type":"unknown"}
+    # определяем payload + размер (один разбор сообщения — дальше модель, см. models.py)
+    payload = from_message(msg)
     sent_dt = msg.date  # datetime (naive UTC в PTB), приведём к aware
     if sent_dt and sent_dt.tzinfo is None:
         sent_dt = sent_dt.replace(tzinfo=timezone.utc)  # type: ignore
 
     if getattr(msg, "media_group_id", None):
+        tracer.discard(trace)   # альбом трассируется целиком, от флеша
         mgid = msg.media_group_id
-        item = None
-        if getattr(msg, "photo", None):
-            ph = msg.photo[-1]; item = {"subtype":"photo","file_id":ph.file_id,"file_size":ph.file_size,"caption":msg.caption or ""}
-        elif getattr(msg, "video", None):
-            v = msg.video; item = {"subtype":"video","file_id":v.file_id,"file_size":v.file_size,"caption":msg.caption or ""}
-        elif getattr(msg, "document", None):
-            d = msg.document; item = {"subtype":"document","file_id":d.file_id,"file_size":d.file_size,"caption":msg.caption or ""}
-        else:
-            item = {"subtype":"unknown","file_size":0,"caption":msg.caption or ""}
-
-        item["date"] = sent_dt.isoformat() if sent_dt else None
-        state["media_groups"].setdefault(mgid, []).append(item)
-        save_state(state)
+        item = album_item(payload, sent_dt.timestamp() if sent_dt else None)
+        raw = encode_item(item)
+        timing = latency.current()
+        raw["rx"] = timing.recv_wall if timing is not None else now_utc().timestamp()   # когда пришёл файл
+        raw["ck"] = ckey   # адрес контента: повтор решаем по альбому целиком
+        latency.delivery(item.ts, 0, raw["rx"])   # отрезок network для перцентилей
+        state["media_groups"].setdefault(mgid, []).append(raw)
+        save_state(state, "media_groups")
+        mod_relay.observe()   # файлы альбома тоже нагружают модчат
         # форвард в модчат (без клавы)
         try:
             forwarded = await context.bot.copy_message(chat_id=MOD_GROUP_ID, from_chat_id=msg.chat_id, message_id=msg.message_id)
             state["media_groups_forwarded"].setdefault(mgid, []).append(forwarded.message_id)
-            save_state(state)
+            save_state(state, "media_groups_forwarded")
         except Exception:
             pass
         # планируем флеш альбома
-        context.job_queue.run_once(flush_media_group, when=MEDIA_GROUP_WAIT, data={"mgid": mgid, "user": {"id": user.id, "username": user.username, "full_name": user.full_name}})
+        get_scheduler(context).run_once(flush_media_group, when=MEDIA_GROUP_WAIT, data={"mgid": mgid, "user": {"id": user.id, "username": user.username, "full_name": user.full_name}})
         try:
             await msg.reply_text("Принял альбом — собираю файлы…")
         except Exception:
@@ -143,29 +221,17 @@ async def handle_private(update, context, state):
         return
 
     # одиночные
-    if getattr(msg, "text", None):
-        payload = {"type":"text","text":msg.text}
-    elif getattr(msg, "photo", None):
-        ph = msg.photo[-1]
-        payload = {"type":"photo","file_id":ph.file_id,"file_size":ph.file_size,"caption":msg.caption or ""}
-    elif getattr(msg, "video", None):
-        v = msg.video
-        payload = {"type":"video","file_id":v.file_id,"file_size":v.file_size,"caption":msg.caption or ""}
-    elif getattr(msg, "document", None):
-        d = msg.document
-        payload = {"type":"document","file_id":d.file_id,"file_size":d.file_size,"caption":msg.caption or ""}
-
-    size_b = payload_size_bytes(payload)
-
-    # метрики
+    size_b = payload.size()
+    trace.kind = payload.type
+
+    # метрики: доставка — только отрезок Telegram -> нас, без нашей очереди (см. latency.py)
     now = now_utc()
-    delivery_seconds = (now - sent_dt).total_seconds() if sent_dt else None
-    speed_bps = (size_b / delivery_seconds) if delivery_seconds and delivery_seconds>0 else (float("inf") if delivery_seconds == 0 and size_b>0 else None)
+    delivery_seconds, speed_bps = latency.delivery(sent_dt.timestamp() if sent_dt else None, size_b)
 
     # история пользователя
-    user_hist = state.get("history", {}).get(uid, [])
+    user_hist = state["history"].get(uid)
     stats = compute_stats(user_hist)
-    hist_bytes = sum((e.get("bytes") or 0) for e in user_hist)
+    hist_bytes = user_hist.total_bytes() if user_hist else 0
     total_user_bytes = hist_bytes + size_b
 
     # заголовок в модчат
@@ -188,84 +254,123 @@ async def handle_private(update, context, state):
         ]
     header = "\n".join(lines)
 
-    # всегда шлём в модчат заголовок + оригинал
-    try:
-        await context.bot.send_message(chat_id=MOD_GROUP_ID, text=header)
-        await context.bot.copy_message(chat_id=MOD_GROUP_ID, from_chat_id=msg.chat_id, message_id=msg.message_id)
-    except Exception:
-        pass
+    check = state.get("mode") == "CHECK"
+
+    # почти-дубль свежего текста/подписи (спам-волна) — в CHECK присоединяем к уже
+    # висящему решению по кластеру вместо нового сообщения в модчат
+    cluster = None
+    joined = False
+    text = msg.text or msg.caption or ""
+    if len(text) >= NEARDUP_MIN_CHARS:
+        cluster, sim, size = near_index.add(text)
+        ref = near_index.ref(cluster)
+        if check and ref is not None and ref in state["pending"]:
+            trace.ref = ref
+            trace.mark("joined")
+            state["pending"].get(ref).add_member(PendingMember(user.id, payload, trace.to_dense()))
+            save_state(state, "pending")
+            who = f"@{user.username}" if user.username else user.full_name
+            mod_relay.add_to_digest(f"Похожее ({sim:.0%}) от {who} (ID {user.id}) присоединено к решению "
+                                    f"по сообщению {ref}; в волне {size}")
+            _schedule_digest(context)
+            joined = True   # решение уже висит — ни модчата, ни канала
+
+    if not joined:
+        # в модчат: заголовок + оригинал с кнопками решения на самой копии;
+        # при всплеске заголовок вклеивается в подпись или уходит в дайджест (см. relay.py)
+        mid = await mod_relay.relay(context.bot, msg, header, decision_keyboard() if check else None)
+        _schedule_digest(context)
+        if mid is not None:
+            trace.ref = str(mid)
+            trace.mark("relayed")
 
     # РЕЖИМЫ: CHECK/UNCHECK
-    if state.get("mode") == "CHECK":
-        # кладём в pending с кнопками решения
-        try:
-            kbd = decision_keyboard()
-            sent = await context.bot.send_message(chat_id=MOD_GROUP_ID, text="Решение по сообщению:", reply_markup=kbd)
-            pend_payload = {"type": payload.get("type"), "data": payload}
-            state["pending"][str(sent.message_id)] = {"user_id": user.id, "payload": pend_payload}
-            save_state(state)
-        except Exception:
-            pass
+    if joined:
+        pass
+    elif check:
+        # кладём в pending: ключ — сообщение, на котором висят кнопки
+        if mid is not None:
+            state["pending"].add(mid, user.id, payload, trace=trace.to_dense())
+            save_state(state, "pending")
+            if cluster is not None:
+                near_index.set_ref(cluster, str(mid))
     else:
         # сразу в канал
         try:
-            if payload["type"] == "text":
-                await context.bot.send_message(chat_id=UNCHECK_CHANNEL_ID, text=payload["text"])
-            elif payload["type"] == "photo":
-                await context.bot.send_photo(chat_id=UNCHECK_CHANNEL_ID, photo=payload["file_id"], caption=payload.get("caption",""))
-            elif payload["type"] == "video":
-                await context.bot.send_video(chat_id=UNCHECK_CHANNEL_ID, video=payload["file_id"], caption=payload.get("caption",""))
-            elif payload["type"] == "document":
-                await context.bot.send_document(chat_id=UNCHECK_CHANNEL_ID, document=payload["file_id"], caption=payload.get("caption",""))
+            if await publish_payload(context.bot, UNCHECK_CHANNEL_ID, payload):
+                trace.mark("published")
         except Exception:
             pass
 
+    if joined or (mid is not None if check else trace.has("published")):
+        remember_content(state, [ckey], user.id, int(msg.date.timestamp()) if msg.date else None)
+
     # запись в историю
-    entry = {
-        "bytes": int(size_b or 0),
-        "delivery_seconds": delivery_seconds,
-        "speed_bps": speed_bps,
-        "timestamp": now.isoformat(),
-        "user_id": user.id,
-        "username": user.username,
-        "full_name": user.full_name,
-    }
-    state.setdefault("history", {}).setdefault(uid, []).append(entry)
-    save_state(state)
+    state["history"].record(user.id, user.username, user.full_name, int(now.timestamp()),
+                            int(size_b or 0), delivery_seconds, speed_bps)
+    if state["reach_rollups"].add(user.id, now.timestamp()):
+        save_state(state, "history", "reach_rollups")
+    else:
+        save_state(state, "history")
 
     # отправим пользователю **одну** сводку (с энергией) — dedup по chat_id:msg_id
     key = dedup_key(msg.chat_id, msg.message_id)
     await send_user_receipt_once(context, state, user_chat_id=msg.chat_id, key=key,
                                  size_b=size_b, speed_bps=speed_bps, delivery_seconds=delivery_seconds, rtt_ms=None)
+    trace.mark("receipt")
+    # в CHECK трасса ждёт решения (cb_decision / массовые команды)
+    if not check:
+        tracer.finish(trace, "unchecked" if trace.has("published") else "publish_failed")
+    elif not joined and mid is None:
+        tracer.finish(trace, "relay_failed")
+
+# ====== Дайджест модчата ======
+def _schedule_digest(context):
+    if mod_relay.want_flush_job():
+        get_scheduler(context).run_once(flush_relay_digest, when=RELAY_DIGEST_INTERVAL_S)
+
+async def flush_relay_digest(context: ContextTypes.DEFAULT_TYPE):
+    await mod_relay.flush(context.bot)
 
 # ====== Флеш альбомов ======
 async def flush_media_group(context: ContextTypes.DEFAULT_TYPE):
     job = context.job; data = job.data or {}
     mgid = data.get("mgid"); user = data.get("user") or {}
     state = context.application.bot_data["state"]
-    items = state["media_groups"].pop(mgid, [])
-    save_state(state)
-    if not items: return
+    # флеш идёт из планировщика, мимо процессора апдейтов — берём те же ключи, что у апдейтов
+    # альбома (пользователь + альбом), иначе флеш идёт вперемешку со следующим сообщением автора
+    async with keyed_locks.acquire(("user", user.get("id")) if user.get("id") is not None else None, ("mg", mgid)):
+        await _flush_media_group(context, state, mgid, user)
 
-    now = now_utc()
-    dates = []
-    total_bytes = 0
-    for it in items:
-        if it.get("date"):
-            try:
-                from datetime import datetime
-                dt = datetime.fromisoformat(it["date"])
-                dates.append(dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc))  # type: ignore
-            except Exception:
-                pass
+async def _flush_media_group(context, state, mgid, user):
+    raw = state["media_groups"].pop(mgid, [])
+    save_state(state, "media_groups")
+    if not raw: return
+    album = AlbumPayload([decode_item(it) for it in raw if isinstance(it, dict)])
+    items = album.items
+
+    # повтор — только весь альбом: все его файлы уже присылали. Частичное пересечение —
+    # новый альбом, уходит целиком (отдельные файлы из него не выкидываем)
+    ckeys = [it.get("ck") for it in raw if isinstance(it, dict)]
+    firsts = [repeat_of(state, k) for k in ckeys]
+    if firsts and all(f is not None for f in firsts):
+        note_repeat("album", firsts[0], user.get("id"), user.get("username"), user.get("full_name"))
+        _schedule_digest(context)
         try:
-            total_bytes += int(it.get("file_size") or 0)
+            await context.bot.send_message(chat_id=user.get("id"), text=REPEAT_REPLY)
         except Exception:
             pass
+        return
 
-    earliest = min(dates) if dates else None
-    delivery_seconds = (now - earliest).total_seconds() if earliest else None
-    speed_bps = (total_bytes / delivery_seconds) if delivery_seconds and delivery_seconds>0 else None
+    now = now_utc()
+    stamps = [it.ts for it in items if isinstance(it.ts, (int, float))]
+    received = [it["rx"] for it in raw if isinstance(it, dict) and isinstance(it.get("rx"), (int, float))]
+    total_bytes = album.size()
+
+    # от отправки первого файла до получения последнего — без ожидания сборки (MEDIA_GROUP_WAIT)
+    earliest = min(stamps) if stamps else None
+    delivery_seconds, speed_bps = latency.delivery(earliest, total_bytes, max(received) if received else None,
+                                                   record=False)
 
     # сводка для модчата
     lines = [
@@ -273,104 +378,75 @@ async def flush_media_group(context: ContextTypes.DEFAULT_TYPE):
         f"Файлов: {len(items)}, общий вес: {fmt_size(total_bytes)}",
         f"Доставка: {delivery_seconds:.3f}s; скорость: {human_speed(speed_bps)}" if delivery_seconds is not None else "Доставка: —",
     ]
-    try:
-        await context.bot.send_message(chat_id=MOD_GROUP_ID, text="\n".join(lines))
-    except Exception:
-        pass
+    summary = "\n".join(lines)
+    check = state.get("mode") == "CHECK"
+    trace = tracer.start("album", user.get("id"), earliest, max(received) if received else now.timestamp())
+    anchor = None
+    if mod_relay.digest:
+        # всплеск: в CHECK сводка едет в тексте сообщения с кнопками, иначе — в дайджест
+        if not check:
+            mod_relay.add_to_digest(summary)
+            _schedule_digest(context)
+    else:
+        try:
+            head = await context.bot.send_message(chat_id=MOD_GROUP_ID, text=summary)
+            anchor = head.message_id
+        except Exception:
+            pass
+    trace.mark("relayed")   # файлы в модчате ещё с приёма; тут — сводка (или дайджест)
 
     # режим
-    if state.get("mode") == "CHECK":
+    if check:
         try:
             kbd = decision_keyboard()
-            sent = await context.bot.send_message(chat_id=MOD_GROUP_ID, text="Решение по альбому:", reply_markup=kbd)
-            state["pending"][str(sent.message_id)] = {"user_id": user.get("id"), "payload": {"type":"media_group","items":items}}
-            save_state(state)
+            reply = ReplyParameters(anchor, allow_sending_without_reply=True) if anchor else None
+            text = "Решение по альбому:" if anchor or not mod_relay.digest else summary + "\n\nРешение по альбому:"
+            sent = await context.bot.send_message(chat_id=MOD_GROUP_ID, text=text, reply_markup=kbd,
+                                                  reply_parameters=reply)
+            trace.ref = str(sent.message_id)
+            state["pending"].add(sent.message_id, user.get("id"), album, trace=trace.to_dense())
+            save_state(state, "pending")
         except Exception:
             pass
     else:
         # отправляем в канал
-        media = []
-        docs = []
-        for it in items:
-            if it.get("subtype") == "photo":
-                media.append(InputMediaPhoto(media=it["file_id"], caption=it.get("caption","")))
-            elif it.get("subtype") == "video":
-                media.append(InputMediaVideo(media=it["file_id"], caption=it.get("caption","")))
-            elif it.get("subtype") == "document":
-                docs.append(it)
-        if media:
-            try:
-                await context.bot.send_media_group(chat_id=UNCHECK_CHANNEL_ID, media=media)
-            except Exception:
-                pass
-        for d in docs:
-            try:
-                await context.bot.send_document(chat_id=UNCHECK_CHANNEL_ID, document=d["file_id"], caption=d.get("caption",""))
-            except Exception:
-                pass
+        try:
+            if await publish_payload(context.bot, UNCHECK_CHANNEL_ID, album):
+                trace.mark("published")
+        except Exception:
+            pass
 
     # история
-    uid = str(user.get("id"))
-    entry = {"bytes": int(total_bytes), "delivery_seconds": delivery_seconds, "speed_bps": speed_bps, "timestamp": now.isoformat(),
-             "user_id": user.get("id"), "username": user.get("username"), "full_name": user.get("full_name")}
-    state.setdefault("history", {}).setdefault(uid, []).append(entry)
-    save_state(state)
+    state["history"].record(user.get("id"), user.get("username"), user.get("full_name"), int(now.timestamp()),
+                            int(total_bytes), delivery_seconds, speed_bps)
+    if user.get("id") is not None and state["reach_rollups"].add(user.get("id"), now.timestamp()):
+        save_state(state, "history", "reach_rollups")
+    else:
+        save_state(state, "history")
+
+    if trace.ref is not None if check else trace.has("published"):
+        remember_content(state, ckeys, user.get("id"), int(earliest) if earliest is not None else None)
 
     # сводка пользователю 1 раз
     key = f"album:{mgid}"
     await send_user_receipt_once(context, state, user_chat_id=user.get("id"), key=key,
                                  size_b=total_bytes, speed_bps=speed_bps, delivery_seconds=delivery_seconds, rtt_ms=None)
+    trace.mark("receipt")
+    if not check:
+        tracer.finish(trace, "unchecked" if trace.has("published") else "publish_failed")
+    elif trace.ref is None:
+        tracer.finish(trace, "relay_failed")
 
 # ====== Решения модерации ======
 async def cb_decision(update, context, state):
     q = update.callback_query
     await q.answer()
     msg_id = str(q.message.message_id)
-    entry = state.get("pending", {}).pop(msg_id, None)
-    save_state(state)
+    entry = state["pending"].pop(msg_id)
+    save_state(state, "pending")
     try:
         await context.bot.edit_message_reply_markup(chat_id=q.message.chat_id, message_id=q.message.message_id, reply_markup=None)
     except Exception:
         pass
     if not entry: return
-    allow = (q.data == "allow")
-    user_id = entry.get("user_id")
-    payload = entry.get("payload") or {}
-    try:
-        await context.bot.send_message(chat_id=MOD_GROUP_ID, text=f"Решение: {'допущено' if allow else 'не допущено'}.")
-    except Exception:
-        pass
-    try:
-        await context.bot.send_message(chat_id=user_id, text="Ваша идея одобрена!" if allow else "Ваша идея не прошла модерацию.")
-    except Exception:
-        pass
-    if not allow: return
-
-    # публикация
-    t = payload.get("type")
-    d = (payload.get("data") or {}) if t != "media_group" else {}
-    try:
-        if t == "text":
-            await context.bot.send_message(chat_id=APPROVED_CHANNEL_ID, text=d.get("text",""))
-        elif t == "photo":
-            await context.bot.send_photo(chat_id=APPROVED_CHANNEL_ID, photo=d.get("file_id"), caption=d.get("caption",""))
-        elif t == "video":
-            await context.bot.send_video(chat_id=APPROVED_CHANNEL_ID, video=d.get("file_id"), caption=d.get("caption",""))
-        elif t == "document":
-            await context.bot.send_document(chat_id=APPROVED_CHANNEL_ID, document=d.get("file_id"), caption=d.get("caption",""))
-        elif t == "media_group":
-            items = payload.get("items", [])
-            media, docs = [], []
-            for it in items:
-                if it.get("subtype")=="photo":
-                    media.append(InputMediaPhoto(media=it["file_id"], caption=it.get("caption","")))
-                elif it.get("subtype")=="video":
-                    media.append(InputMediaVideo(media=it["file_id"], caption=it.get("caption","")))
-                elif it.get("subtype")=="document":
-                    docs.append(it)
-            if media:
-                await context.bot.send_media_group(chat_id=APPROVED_CHANNEL_ID, media=media)
-            for d in docs:
-                await context.bot.send_document(chat_id=APPROVED_CHANNEL_ID, document=d["file_id"], caption=d.get("caption",""))
-    except Exception:
-        pass
\ No newline at end of file
+    await apply_decisions(context.bot, [(msg_id, entry)], q.data == "allow", clear_keyboards=False)
@@ -0,0 +1,283 @@
+# history.py
+"""
+Компактная история доставок.
+
+Вместо списка dict-ов на каждую доставку (с повтором user_id/username/full_name
+и ISO-строкой времени) держим:
+  - справочник пользователей: uid -> [username, full_name] (обновляется при смене);
+  - по каждому uid — колонки на array: ts (epoch, int), bytes, duration, speed.
+На диск колонки уходят плотно: base64 от сырых байтов массива (little-endian).
+"""
+import base64
+import heapq
+import math
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+_NAN = float("nan")
+
+
+def _pack(arr: array) -> str:
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return base64.b64encode(arr.tobytes()).decode("ascii")
+
+
+def _unpack(typecode: str, s: str) -> array:
+    arr = array(typecode)
+    if s:
+        arr.frombytes(base64.b64decode(s))
+        if sys.byteorder != "little":
+            arr.byteswap()
+    return arr
+
+
+def _num(v) -> float:
+    """None/мусор -> NaN (в колонках нет None)."""
+    if isinstance(v, (int, float)):
+        return float(v)
+    return _NAN
+
+
+class DeliveryLog:
+    """Доставки одного пользователя в виде параллельных колонок."""
+    __slots__ = ("ts", "sizes", "durations", "speeds")
+
+    def __init__(self):
+        self.ts = array("q")          # epoch seconds (UTC)
+        self.sizes = array("q")       # байты
+        self.durations = array("d")   # delivery_seconds, NaN = неизвестно
+        self.speeds = array("d")      # speed_bps, NaN = неизвестно, inf допустим
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, ts: int, size_b: int, duration_s: float | None, speed_bps: float | None):
+        """Добавляем запись, сохраняя порядок по ts (обычно это просто append в конец)."""
+        ts = int(ts)
+        if not self.ts or ts >= self.ts[-1]:
+            self.ts.append(ts)
+            self.sizes.append(int(size_b or 0))
+            self.durations.append(_num(duration_s))
+            self.speeds.append(_num(speed_bps))
+            return
+        i = bisect_right(self.ts, ts)
+        self.ts.insert(i, ts)
+        self.sizes.insert(i, int(size_b or 0))
+        self.durations.insert(i, _num(duration_s))
+        self.speeds.insert(i, _num(speed_bps))
+
+    def rows(self) -> Iterator[Tuple[int, int, float | None, float | None]]:
+        for t, b, d, s in zip(self.ts, self.sizes, self.durations, self.speeds):
+            yield t, b, (None if math.isnan(d) else d), (None if math.isnan(s) else s)
+
+    def total_bytes(self) -> int:
+        return sum(self.sizes)
+
+    def _keep(self, idx: Iterable[int]):
+        idx = list(idx)
+        self.ts = array("q", (self.ts[i] for i in idx))
+        self.sizes = array("q", (self.sizes[i] for i in idx))
+        self.durations = array("d", (self.durations[i] for i in idx))
+        self.speeds = array("d", (self.speeds[i] for i in idx))
+
+    def prune(self, cutoff_ts: int, max_items: int) -> int:
+        """Удаляем записи старше cutoff_ts и оставляем последние max_items.
+        Колонки отсортированы по ts, так что это один bisect + срез префикса.
+        Возвращает число удалённых записей."""
+        n = bisect_left(self.ts, cutoff_ts)
+        n = max(n, len(self.ts) - max_items)
+        if n > 0:
+            del self.ts[:n]
+            del self.sizes[:n]
+            del self.durations[:n]
+            del self.speeds[:n]
+        return max(n, 0)
+
+    def copy(self) -> "DeliveryLog":
+        c = DeliveryLog()
+        c.ts, c.sizes, c.durations, c.speeds = self.ts[:], self.sizes[:], self.durations[:], self.speeds[:]
+        return c
+
+    def _sort(self):
+        if all(a <= b for a, b in zip(self.ts, self.ts[1:])):
+            return
+        self._keep(sorted(range(len(self.ts)), key=self.ts.__getitem__))
+
+    # ---- сериализация ----
+    def to_dense(self) -> Dict[str, str]:
+        return {"ts": _pack(self.ts), "b": _pack(self.sizes), "d": _pack(self.durations), "s": _pack(self.speeds)}
+
+    @classmethod
+    def from_dense(cls, d: Dict[str, str]) -> "DeliveryLog":
+        log = cls()
+        log.ts = _unpack("q", d.get("ts", ""))
+        log.sizes = _unpack("q", d.get("b", ""))
+        log.durations = _unpack("d", d.get("d", ""))
+        log.speeds = _unpack("d", d.get("s", ""))
+        n = min(len(log.ts), len(log.sizes), len(log.durations), len(log.speeds))
+        if n != len(log.ts) or n != len(log.sizes) or n != len(log.durations) or n != len(log.speeds):
+            # битые колонки — выравниваем по самой короткой
+            log._keep(range(n))
+        log._sort()
+        return log
+
+
+def _legacy_ts(rec: dict) -> int | None:
+    from datetime import datetime, timezone
+    ts = rec.get("timestamp") or rec.get("ts") or rec.get("time")
+    if isinstance(ts, (int, float)):
+        return int(ts)
+    if not isinstance(ts, str):
+        return None
+    try:
+        dt = datetime.fromisoformat(ts)
+    except Exception:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+class HistoryStore:
+    """state["history"]: справочник пользователей + DeliveryLog на каждого.
+
+    Для очистки держим min-кучу (самый старый ts, uid): prune трогает только
+    пользователей, у которых реально есть просроченные записи, плюс тех, кому
+    дописывали с прошлой очистки (лимит per-user). Куча ленивая — устаревшие
+    элементы отбрасываются при извлечении; на диск не пишется.
+    """
+    __slots__ = ("users", "logs", "_heap", "_touched", "sink")
+
+    def __init__(self):
+        self.users: Dict[str, list] = {}        # uid -> [username, full_name]
+        self.logs: Dict[str, DeliveryLog] = {}  # uid -> колонки
+        self._heap: list = []                   # (oldest_ts, uid)
+        self._touched: set = set()              # uid, дописанные с прошлого prune
+        self.sink = None                        # (uid, ts, size, dur, speed) -> None: долгий архив
+
+    def __len__(self):
+        return len(self.logs)
+
+    def __contains__(self, uid):
+        return str(uid) in self.logs
+
+    def get(self, uid, default=None):
+        return self.logs.get(str(uid), default)
+
+    def items(self):
+        return self.logs.items()
+
+    def user(self, uid) -> Tuple[str | None, str | None]:
+        u = self.users.get(str(uid)) or (None, None)
+        return u[0], u[1]
+
+    def record(self, user_id, username, full_name, ts: int,
+               size_b: int, duration_s: float | None, speed_bps: float | None):
+        uid = str(user_id)
+        cur = self.users.get(uid)
+        if cur is None or cur[0] != username or cur[1] != full_name:
+            self.users[uid] = [username, full_name]
+        log = self.logs.get(uid)
+        if log is None:
+            log = self.logs[uid] = DeliveryLog()
+        oldest = log.ts[0] if log.ts else None
+        log.append(ts, size_b, duration_s, speed_bps)
+        if oldest is None or log.ts[0] < oldest:
+            heapq.heappush(self._heap, (log.ts[0], uid))
+        self._touched.add(uid)
+        if self.sink is not None:
+            self.sink(uid, ts, size_b, duration_s, speed_bps)
+
+    def drop_user(self, uid):
+        uid = str(uid)
+        self.logs.pop(uid, None)
+        self.users.pop(uid, None)
+
+    def _rebuild_heap(self):
+        self._heap = [(log.ts[0], uid) for uid, log in self.logs.items() if log.ts]
+        heapq.heapify(self._heap)
+
+    def _prune_one(self, uid: str, cutoff_ts: int, max_per_user: int):
+        log = self.logs.get(uid)
+        if log is None:
+            return
+        log.prune(cutoff_ts, max_per_user)
+        if not len(log):
+            self.drop_user(uid)
+        else:
+            heapq.heappush(self._heap, (log.ts[0], uid))
+
+    def prune(self, cutoff_ts: int, max_per_user: int):
+        heap = self._heap
+        while heap and heap[0][0] < cutoff_ts:
+            ts, uid = heapq.heappop(heap)
+            log = self.logs.get(uid)
+            if log is None or not log.ts or log.ts[0] != ts:
+                continue  # устаревший элемент кучи
+            self._prune_one(uid, cutoff_ts, max_per_user)
+        for uid in self._touched:
+            log = self.logs.get(uid)
+            if log is not None and len(log) > max_per_user:
+                self._prune_one(uid, cutoff_ts, max_per_user)
+        self._touched.clear()
+        # от ленивых дублей куча может распухнуть — иногда пересобираем
+        if len(heap) > 2 * len(self.logs) + 64:
+            self._rebuild_heap()
+
+    def keep_users(self, uids: Iterable[str]):
+        keep = {str(u) for u in uids}
+        for uid in list(self.logs):
+            if uid not in keep:
+                self.drop_user(uid)
+        self._rebuild_heap()
+
+    def copy(self) -> "HistoryStore":
+        """Копия для фоновой записи: колонки копируются memcpy, кучу не берём."""
+        c = HistoryStore()
+        c.users = dict(self.users)   # значения-списки заменяются целиком, не мутируются
+        c.logs = {uid: log.copy() for uid, log in self.logs.items()}
+        return c
+
+    # ---- сериализация ----
+    def to_dense(self) -> Dict[str, Any]:
+        return {
+            "users": self.users,
+            "logs": {uid: log.to_dense() for uid, log in self.logs.items()},
+        }
+
+    @classmethod
+    def from_dense(cls, d, sink=None) -> "HistoryStore":
+        """Понимает и плотный формат, и старый uid -> [ {bytes, timestamp, ...}, ... ].
+        sink — архив: строки, мигрированные из старого формата, уходят в него (один раз —
+        после миграции state пишется уже плотным); плотные строки в архиве уже есть."""
+        store = cls()
+        store.sink = sink
+        if not isinstance(d, dict):
+            return store
+        if "logs" in d and isinstance(d.get("logs"), dict):
+            for uid, u in (d.get("users") or {}).items():
+                if isinstance(u, (list, tuple)) and len(u) == 2:
+                    store.users[str(uid)] = [u[0], u[1]]
+            for uid, dense in d["logs"].items():
+                if isinstance(dense, dict):
+                    store.logs[str(uid)] = DeliveryLog.from_dense(dense)
+            store._rebuild_heap()
+            store._touched.update(store.logs)
+            return store
+        # миграция старого формата
+        for uid, entries in d.items():
+            if not isinstance(entries, list):
+                continue
+            for rec in entries:
+                if not isinstance(rec, dict):
+                    continue
+                ts = _legacy_ts(rec)
+                if ts is None:
+                    continue
+                store.record(uid, rec.get("username"), rec.get("full_name"), ts,
+                             int(rec.get("bytes") or 0), rec.get("delivery_seconds"), rec.get("speed_bps"))
+        return store
@@ -0,0 +1,168 @@
+# latency.py
+"""
+Разложение задержки доставки на отрезки.
+
+Раньше delivery_seconds = now - msg.date: в одном числе смешаны очередь Telegram,
+задержка опроса и наша собственная очередь обработчиков, а msg.date — с точностью
+до секунды. Отсюда «скорости» 44 байта за 19 000 с (апдейты, пролежавшие, пока бот
+был выключен) и бесконечные (та же секунда).
+
+Теперь по монотонным часам отмечаем:
+  received — апдейт пришёл в процессор (KeyedUpdateProcessor, до блокировок);
+  start    — обработчик начал работу (взяты блокировка пользователя и рабочий слот);
+  end      — обработчик закончил;
+  и каждый исходящий вызов Bot API (TimedRequest) — длительность по методу.
+Отрезки:
+  network — msg.date -> received (Telegram + опрос; по настенным часам, шаг 1 с);
+  queue   — received -> start (наш бэклог);
+  handler — start -> end, из них api — в вызовах Bot API, own — остальное.
+
+Скорость для сводок и истории считаем только по network — это единственный
+отрезок, связанный с передачей сообщения. msg.date усечена до секунды, поэтому
+берём середину интервала неопределённости (d - 0.5 с); при d < 1.5 с скорость
+не показываем (ошибка больше половины), при d > LATENCY_MAX_PLAUSIBLE_S
+(апдейт ждал, пока бот не работал) неизвестна и сама доставка.
+
+Перцентили по отрезкам — /latency; кольцо на LATENCY_RING_SIZE значений на отрезок.
+"""
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Dict, List, Tuple
+
+from telegram.request import HTTPXRequest
+
+import clock
+from config import LATENCY_RING_SIZE, LATENCY_MAX_PLAUSIBLE_S, MOD_GROUP_ID
+from utils import percentile
+
+DATE_RESOLUTION_S = 1.0     # msg.date — целые секунды
+MIN_SPEED_SPAN_S = 1.5      # короче — скорость по такой длительности не считаем
+
+
+class UpdateTiming:
+    __slots__ = ("recv_wall", "recv", "start", "end", "api_s", "calls")
+
+    def __init__(self):
+        self.recv_wall = clock.time()      # настенное: сравниваем с msg.date
+        self.recv = time.monotonic()
+        self.start = None
+        self.end = None
+        self.api_s = 0.0
+        self.calls: List[Tuple[str, float]] = []   # (метод, секунд)
+
+
+class LatencyStats:
+    def __init__(self, ring_size: int = LATENCY_RING_SIZE):
+        self.ring_size = max(1, ring_size)
+        self.rings: Dict[str, deque] = {}
+        self.implausible = 0      # доставок с network > LATENCY_MAX_PLAUSIBLE_S
+
+    def add(self, segment: str, seconds: float):
+        ring = self.rings.get(segment)
+        if ring is None:
+            ring = self.rings[segment] = deque(maxlen=self.ring_size)
+        ring.append(max(0.0, seconds))
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        return {s: {"count": len(v), "p50": percentile(v, 0.5), "p90": percentile(v, 0.9),
+                    "p99": percentile(v, 0.99), "max": max(v)} for s, v in self.rings.items() if v}
+
+
+stats = LatencyStats()
+_current: ContextVar[UpdateTiming | None] = ContextVar("update_timing", default=None)
+
+
+# ---- отметки ----
+def received() -> UpdateTiming:
+    """Апдейт пришёл: отметка и привязка к текущей задаче (её видят обработчик и TimedRequest)."""
+    t = UpdateTiming()
+    _current.set(t)
+    return t
+
+
+def current() -> UpdateTiming | None:
+    return _current.get()
+
+
+def started(t: UpdateTiming):
+    t.start = time.monotonic()
+    stats.add("queue", t.start - t.recv)
+
+
+def finished(t: UpdateTiming):
+    t.end = time.monotonic()
+    if t.start is None:
+        return
+    handler = t.end - t.start
+    stats.add("handler", handler)
+    if t.calls:
+        stats.add("handler.api", t.api_s)
+    stats.add("handler.own", handler - t.api_s)
+
+
+def outbound(method: str, seconds: float):
+    stats.add(f"api.{method}", seconds)
+    t = _current.get()
+    if t is not None:
+        t.api_s += seconds
+        t.calls.append((method, seconds))
+
+
+# ---- доставка ----
+def delivery(sent_ts: float | None, size_b: int, recv_wall: float | None = None, record: bool = True):
+    """(delivery_seconds, speed_bps) по отрезку network; None — неизвестно.
+    sent_ts — msg.date (epoch), recv_wall — когда апдейт пришёл (по умолчанию — из текущей отметки)."""
+    if sent_ts is None:
+        return None, None
+    if recv_wall is None:
+        t = _current.get()
+        recv_wall = t.recv_wall if t is not None else clock.time()
+    span = recv_wall - sent_ts
+    if span > LATENCY_MAX_PLAUSIBLE_S or span < -DATE_RESOLUTION_S:
+        stats.implausible += 1
+        return None, None
+    if record:
+        stats.add("network", span)
+    dur = max(0.0, span - DATE_RESOLUTION_S / 2)
+    speed = size_b / dur if span >= MIN_SPEED_SPAN_S and dur > 0 else None
+    return dur, speed
+
+
+# ---- исходящие вызовы ----
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет каждый вызов Bot API (getUpdates — нет: это ожидание, а не работа)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        if name == "getUpdates":
+            return await super().do_request(url, method, *args, **kwargs)
+        t0 = time.monotonic()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            outbound(name, time.monotonic() - t0)
+
+
+# ---- отчёт ----
+ORDER = ("network", "queue", "handler", "handler.api", "handler.own")
+
+
+def format_report(pct: Dict[str, Dict[str, float]], implausible: int = 0) -> str:
+    if not pct:
+        return "Задержки: данных пока нет."
+    keys = [k for k in ORDER if k in pct] + sorted(k for k in pct if k not in ORDER)
+    lines = ["Задержки по отрезкам (p50 / p90 / p99 / max, с; n):"]
+    for k in keys:
+        p = pct[k]
+        lines.append(f"{k}: {p['p50']:.3f} / {p['p90']:.3f} / {p['p99']:.3f} / {p['max']:.3f}; {p['count']}")
+    if implausible:
+        lines.append(f"Доставок с неправдоподобной задержкой (>{LATENCY_MAX_PLAUSIBLE_S:.0f} с, скорость не считалась): {implausible}")
+    return "\n".join(lines)
+
+
+async def cmd_latency(update, context, state):
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    from moderation import is_admin
+    if not await is_admin(context, update.effective_user.id): return
+    await update.message.reply_text(format_report(stats.percentiles(), stats.implausible)[:4096])
@@ -1,8 +1,10 @@
 import asyncio
 import logging
+import signal
 import time
 from types import SimpleNamespace
 
+from telegram.error import NetworkError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -11,18 +13,33 @@ from telegram.ext import (
     filters,
 )
 
+import clock
 from config import (
     BOT_TOKEN, ENABLE_WEATHER, DAILY_ENABLE, DAILY_MORNING, DAILY_EVENING, TIMEZONE,
-    UNCHECK_CHANNEL_ID
+    UNCHECK_CHANNEL_ID, MOD_GROUP_ID, CONCURRENT_UPDATES, DRAIN_TIMEOUT_S, SHUTDOWN_FIRE_WITHIN_S,
+    RESTART_MAX_BACKOFF_S, WEATHER_TICK_S, MODQ_EXPIRE_EVERY_S,
 )
-from state import load_state, save_state
+from state import load_state, save_state, flush_state
 from moderation import (
     upsert_control_message,
+    expire_job,
     cmd_bumper_set,
     cmd_bumper_on,
     cmd_bumper_off,
     cmd_bumper_status,
+    cmd_approve_user,
+    cmd_approve_next,
+    cmd_deny_older,
+    cmd_queue,
+    cmd_archive_stats,
+    cmd_slow,
 )
+from concurrency import KeyedUpdateProcessor
+from statestats import cmd_state_stats
+from export import cmd_export
+from relay import mod_relay
+from latency import TimedRequest, cmd_latency
+from broadcast import broadcaster, cmd_subscribe, cmd_unsubscribe, cmd_broadcast, cmd_broadcast_status, cmd_broadcast_stop
 from handlers import (
     cmd_start,
     cb_mode_toggle,
@@ -32,10 +49,20 @@ from handlers import (
 
 # ========= Мини-планировщик =========
 class MiniJobQueue:
+    """Живёт весь процесс: при тёплом перезапуске транспорта задачи не теряются,
+    а контекст (application/bot) берётся на момент запуска — см. rebind().
+    Сроки и ожидание — по часам процесса (clock.py): в soak.py время виртуальное."""
     def __init__(self, app, logger):
         self.app = app
         self.logger = logger
         self._tasks = set()
+        self._once = {}   # задача run_once -> (срок по monotonic, событие «запустить сейчас»)
+
+    def rebind(self, app):
+        self.app = app
+
+    def _ctx(self, data):
+        return SimpleNamespace(application=self.app, bot=self.app.bot, job=SimpleNamespace(data=data))
 
     def _track(self, coro):
         t = asyncio.create_task(coro)
@@ -44,30 +71,48 @@ class MiniJobQueue:
         return t
 
     def run_once(self, callback, when: float, data=None, name: str | None = None):
+        wake = asyncio.Event()
         async def _runner():
             try:
-                await asyncio.sleep(float(when))
-                ctx = SimpleNamespace(application=self.app, bot=self.app.bot, job=SimpleNamespace(data=data))
-                await callback(ctx)
+                await clock.wait(wake, float(when))
+                await callback(self._ctx(data))
             except Exception:
                 self.logger.exception("MiniJobQueue run_once error")
-        return self._track(_runner())
+        t = self._track(_runner())
+        self._once[t] = (clock.monotonic() + float(when), wake)
+        t.add_done_callback(lambda t: self._once.pop(t, None))
+        return t
 
     def run_repeating(self, callback, interval: float, first: float | int = 0, name: str | None = None, data=None):
         async def _loop():
             try:
-                await asyncio.sleep(float(first or 0))
+                await clock.sleep(float(first or 0))
                 while True:
                     try:
-                        ctx = SimpleNamespace(application=self.app, bot=self.app.bot, job=SimpleNamespace(data=data))
-                        await callback(ctx)
+                        await callback(self._ctx(data))
                     except Exception:
                         self.logger.exception("MiniJobQueue run_repeating tick error")
-                    await asyncio.sleep(float(interval))
+                    await clock.sleep(float(interval))
             except Exception:
                 self.logger.exception("MiniJobQueue run_repeating loop error")
         return self._track(_loop())
 
+    async def drain(self, fire_within: float, timeout: float) -> int:
+        """Остановка: короткие отложенные задачи (до запуска <= fire_within) выполняем сейчас,
+        остальное (повторяющиеся, дальние таймеры) отменяем. Возвращает число выполненных."""
+        now = clock.monotonic()
+        fire = [t for t, (due, _) in list(self._once.items()) if due - now <= fire_within]
+        for t in fire:
+            self._once[t][1].set()
+        for t in list(self._tasks):
+            if t not in fire:
+                t.cancel()
+        if fire:
+            _, late = await asyncio.wait(fire, timeout=timeout)
+            for t in late:
+                t.cancel()
+        return len(fire)
+
 # ========================= Логирование =========================
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger("bot")
@@ -124,14 +169,17 @@ async def cmd_check_title(update, context):
     )
     await update.message.reply_text(text)
 
-# ========================= Точка входа =========================
-async def main():
-    state = load_state()
-
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+# ========================= Сборка приложения =========================
+def build_app(state, scheduler):
+    """Транспорт: Application с обработчиками. Пересобирается при каждом перезапуске,
+    state и планировщик — общие на весь процесс."""
+    # разные пользователи — параллельно, один пользователь/альбом — по очереди
+    # TimedRequest — длительность каждого вызова Bot API (см. latency.py)
+    app = (ApplicationBuilder().token(BOT_TOKEN).request(TimedRequest())
+           .concurrent_updates(KeyedUpdateProcessor(CONCURRENT_UPDATES)).build())
     app.bot_data["state"] = state
-    scheduler = MiniJobQueue(app, logger)
     app.bot_data["scheduler"] = scheduler
+    app.bot_data["supervisor"] = supervisor_stats
 
     # Регистрируем обработчик service-сообщений о смене названия (делать до старта)
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE, delete_new_title_service_message))
@@ -149,66 +197,221 @@ async def main():
     app.add_handler(CommandHandler("bumper_off", lambda u, c: cmd_bumper_off(u, c, app.bot_data["state"])))
     app.add_handler(CommandHandler("bumper_status", lambda u, c: cmd_bumper_status(u, c, app.bot_data["state"])))
 
+    # Очередь модерации: массовые решения
+    app.add_handler(CommandHandler("approve_user", lambda u, c: cmd_approve_user(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("approve_next", lambda u, c: cmd_approve_next(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("deny_older", lambda u, c: cmd_deny_older(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("queue", lambda u, c: cmd_queue(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("archive_stats", lambda u, c: cmd_archive_stats(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("slow", lambda u, c: cmd_slow(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("latency", lambda u, c: cmd_latency(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("state_stats", lambda u, c: cmd_state_stats(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("export", lambda u, c: cmd_export(u, c, app.bot_data["state"])))
+
+    # Рассылки: подписка в личке, запуск и статус — в модчате
+    app.add_handler(CommandHandler("subscribe", lambda u, c: cmd_subscribe(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("unsubscribe", lambda u, c: cmd_unsubscribe(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("broadcast", lambda u, c: cmd_broadcast(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("broadcast_status", lambda u, c: cmd_broadcast_status(u, c, app.bot_data["state"])))
+    app.add_handler(CommandHandler("broadcast_stop", lambda u, c: cmd_broadcast_stop(u, c, app.bot_data["state"])))
+
     # Личные сообщения
     app.add_handler(MessageHandler(filters.ChatType.PRIVATE & (~filters.COMMAND),
                                    lambda u, c: handle_private(u, c, app.bot_data["state"])))
 
-    # Погода и обновление закрепа (если включено)
     if ENABLE_WEATHER:
-        # импортируем здесь, чтобы избежать лишних импортов когда погода отключена
-        from weather import weather_job, cmd_weather_ping
-
-        logger.info("Weather enabled: scheduling weather_job and pin updates.")
-        # Твой тикинг для weather_job (как и раньше)
-        # Прим: интервал=0.1 в примере — вероятно для теста. В реале поставьте 60 или больше.
-        scheduler.run_repeating(weather_job, interval=0.1, first=0.1)
-        # Добавим команду для ручной проверки погоды
+        from weather import cmd_weather_ping
+        # команда для ручной проверки погоды
         app.add_handler(CommandHandler("weather_ping", cmd_weather_ping))
 
     # Ежедневные сообщения
-    from daily import schedule_daily, cmd_daily_on, cmd_daily_off, cmd_daily_status, cmd_daily_set
+    from daily import cmd_daily_on, cmd_daily_off, cmd_daily_status, cmd_daily_set
     app.add_handler(CommandHandler("daily_on", cmd_daily_on))
     app.add_handler(CommandHandler("daily_off", cmd_daily_off))
     app.add_handler(CommandHandler("daily_status", cmd_daily_status))
     app.add_handler(CommandHandler("daily_set", cmd_daily_set))
+    return app
+
+def schedule_jobs(scheduler, state):
+    """Фоновые задачи процесса — один раз, при холодном старте."""
+    # Погода и обновление закрепа (если включено)
+    if ENABLE_WEATHER:
+        # импортируем здесь, чтобы избежать лишних импортов когда погода отключена
+        from weather import weather_job
 
-    await app.initialize()
-    await upsert_control_message(app, state)
+        logger.info("Weather enabled: scheduling weather_job and pin updates.")
+        # Твой тикинг для weather_job (как и раньше)
+        # Прим: интервал=0.1 (WEATHER_TICK_S) — вероятно для теста. В реале поставьте 60 или больше.
+        scheduler.run_repeating(weather_job, interval=WEATHER_TICK_S, first=WEATHER_TICK_S)
+
+    # Очередь модерации: просроченные заявки — с уведомлением авторов и снятием кнопок
+    scheduler.run_repeating(expire_job, interval=MODQ_EXPIRE_EVERY_S, first=MODQ_EXPIRE_EVERY_S)
 
     # Планируем ежедневные только если включено
     if DAILY_ENABLE:
+        from daily import schedule_daily
         logger.info(f"Daily enabled: morning {DAILY_MORNING}, evening {DAILY_EVENING} ({TIMEZONE})")
         schedule_daily(scheduler, TIMEZONE, DAILY_MORNING, DAILY_EVENING)
         state.setdefault("daily", {})["enabled"] = True
     else:
         state.setdefault("daily", {})["enabled"] = False
 
+# ========================= Супервизор транспорта =========================
+# перезапуски, время восстановления (от обнаружения сбоя до возобновления опроса)
+supervisor_stats = {"restarts": 0, "last_recovery_s": None, "max_recovery_s": None, "last_error": None}
+
+async def _stop_transport(app, timeout: float):
+    """Прекращаем опрос и дожидаемся обработчиков уже полученных апдейтов (не дольше timeout)."""
     try:
-        await app.start()
-        # В старых версиях PTB использовался updater; если у вас современная версия — этот вызов может быть лишним.
-        try:
-            await app.updater.start_polling()
-        except Exception:
-            # Игнорируем, если updater отсутствует/не используется
-            pass
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+    except Exception:
+        logger.exception("updater.stop failed")
+    try:
+        if app.running:
+            await asyncio.wait_for(app.stop(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Drain timed out after %.0fs; in-flight handlers are abandoned", timeout)
+    except Exception:
+        logger.exception("app.stop failed")
+
+async def _shutdown_app(app):
+    try:
+        await app.shutdown()
+    except Exception:
+        logger.exception("app.shutdown failed")
+
+async def _serve(app, stop: asyncio.Event) -> str | None:
+    """Опрос до сигнала остановки или отказа транспорта. None — штатная остановка, иначе причина сбоя."""
+    broken = asyncio.Event()
+    reason = {}
 
-        logger.info("Bot is running.")
-        # Блокируем навсегда — процесс останется живым
-        await asyncio.Event().wait()
+    def _polling_error(exc):
+        # сетевые ошибки PTB переживает сам (повторяет запрос); остальное — повод пересобрать транспорт
+        if isinstance(exc, NetworkError):
+            logger.warning("Polling network error: %s", exc)
+            return
+        reason["error"] = repr(exc)
+        broken.set()
+
+    await app.start()
+    await app.updater.start_polling(error_callback=_polling_error)
+    waiters = [asyncio.ensure_future(stop.wait()), asyncio.ensure_future(broken.wait())]
+    try:
+        while not (stop.is_set() or broken.is_set()):
+            await asyncio.wait(waiters, timeout=5, return_when=asyncio.FIRST_COMPLETED)
+            if not stop.is_set() and not (app.running and app.updater.running):
+                reason["error"] = "transport stopped unexpectedly"
+                broken.set()
     finally:
+        for w in waiters:
+            w.cancel()
+    return None if stop.is_set() else reason.get("error", "unknown")
+
+async def _drain(app, state, scheduler):
+    """Штатная остановка: опрос уже остановлен и обработчики дождались; выполняем отложенное
+    (флеш альбомов, дайджест модчата), пока бот ещё жив."""
+    fired = await scheduler.drain(SHUTDOWN_FIRE_WITHIN_S, DRAIN_TIMEOUT_S)
+    # рассылка дописывает текущее окно и сохраняет курсор — продолжится после запуска
+    await broadcaster.stop(DRAIN_TIMEOUT_S)
+    try:
+        await asyncio.wait_for(mod_relay.flush(app.bot), DRAIN_TIMEOUT_S)
+    except Exception:
+        logger.exception("Relay digest flush on shutdown failed")
+    logger.info("Drained: %d deferred jobs run early", fired)
+
+async def main():
+    state = load_state()
+    scheduler = MiniJobQueue(None, logger)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
         try:
-            await app.updater.stop_polling()
-        except Exception:
-            pass
-        try:
-            await app.stop()
-        except Exception:
-            pass
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass   # Windows: останется KeyboardInterrupt
+
+    app = None            # текущий транспорт
+    prev = None           # предыдущий: закрываем, когда новый готов (чтобы задачи было через что слать)
+    cold = True
+    failed_at = None
+    backoff = 1.0
+    try:
+        while not stop.is_set():
+            app = build_app(state, scheduler)
+            try:
+                await app.initialize()
+                scheduler.rebind(app)
+                broadcaster.bind(app, state)
+                if prev is not None:
+                    await _shutdown_app(prev)
+                    prev = None
+                if cold:
+                    await upsert_control_message(app, state)
+                    schedule_jobs(scheduler, state)
+                    broadcaster.kick()   # прерванная прошлым процессом рассылка
+                    cold = False
+                serving = asyncio.ensure_future(_serve(app, stop))
+                # время восстановления: от сбоя до запущенного опроса
+                while failed_at is not None and not serving.done() and not app.updater.running:
+                    await asyncio.sleep(0.05)
+                if failed_at is not None and not serving.done():
+                    recovery = time.monotonic() - failed_at
+                    failed_at = None
+                    backoff = 1.0
+                    supervisor_stats["last_recovery_s"] = recovery
+                    supervisor_stats["max_recovery_s"] = max(recovery, supervisor_stats["max_recovery_s"] or 0.0)
+                    logger.info("Transport recovered in %.2fs (restart #%d)", recovery, supervisor_stats["restarts"])
+                    try:
+                        await app.bot.send_message(chat_id=MOD_GROUP_ID, text=(
+                            f"Связь восстановлена за {recovery:.1f} с (перезапуск №{supervisor_stats['restarts']}); "
+                            f"очередь, state и задачи сохранены."))
+                    except Exception:
+                        pass
+                error = await serving
+            except Exception as e:
+                logger.exception("Transport failed")
+                error = repr(e)
+            if error is None:
+                break
+            # сбой транспорта: state и планировщик остаются, пересобираем только Application
+            if failed_at is None:
+                failed_at = time.monotonic()
+            supervisor_stats["restarts"] += 1
+            supervisor_stats["last_error"] = error
+            logger.warning("Transport restart #%d in %.0fs: %s", supervisor_stats["restarts"], backoff, error)
+            await _stop_transport(app, DRAIN_TIMEOUT_S)
+            if app.bot_data.get("scheduler") is scheduler and scheduler.app is app:
+                prev = app          # задачи планировщика пока шлют через старого бота
+            else:
+                await _shutdown_app(app)
+            app = None
+            save_state(state)
+            try:
+                await asyncio.wait_for(stop.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(RESTART_MAX_BACKOFF_S, backoff * 2)
+    finally:
+        t0 = time.monotonic()
+        live = app or prev
+        if app is not None:
+            await _stop_transport(app, DRAIN_TIMEOUT_S)
+        if live is not None:
+            scheduler.rebind(live)
+            broadcaster.bind(live)
+            await _drain(live, state, scheduler)
+        for a in {id(x): x for x in (app, prev) if x is not None}.values():
+            await _shutdown_app(a)
         save_state(state)
+        # запись идёт в фоновом потоке — дождёмся, чтобы ничего не потерять на выходе
+        flush_state(timeout=30)
+        logger.info("Shutdown complete in %.2fs", time.monotonic() - t0)
 
 
 if __name__ == "__main__":
-    # Небольшой защитный цикл перезапуска — скрипт будет автоматически перезапускаться при падениях.
+    # Последний рубеж: сюда попадаем, только если упал сам супервизор (транспорт он
+    # перезапускает сам, не выходя из процесса) — тогда холодный перезапуск с нуля.
     if not BOT_TOKEN or BOT_TOKEN.strip() == "":
         raise SystemExit("Заполни BOT_TOKEN в .env!")
 
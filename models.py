@@ -0,0 +1,185 @@
+# models.py
+"""
+Типизированные payload-ы и записи очереди модерации.
+
+Один раз разбираем сообщение в модель (from_message), дальше по конвейеру
+ходят объекты со __slots__: меньше памяти на запись pending, поля — атрибуты,
+а не ключи dict, и нет повторных ветвлений по type — публикация выбирает
+отправителя по классу (publish.PUBLISHERS).
+
+На диск — прежний формат (encode_* / decode_*), так что старые state читаются:
+  одиночный: {"type": "photo", "data": {"type", "file_id", "file_size", "caption"}}
+  альбом:    {"type": "media_group", "items": [{"subtype", "file_id", "file_size", "caption", "ts"}]}
+  pending:   {"user_id", "payload", "ts", "trace"?, "members"?: [{"user_id", "payload", "trace"?}]}
+"""
+from dataclasses import dataclass
+from typing import Any, ClassVar, Dict, List
+
+import clock
+
+
+@dataclass(slots=True)
+class TextPayload:
+    text: str
+    type: ClassVar[str] = "text"
+
+    def size(self) -> int:
+        return len(self.text.encode("utf-8"))
+
+
+@dataclass(slots=True)
+class FilePayload:
+    file_id: str
+    file_size: int = 0
+    caption: str = ""
+    type: ClassVar[str] = "file"
+
+    def size(self) -> int:
+        return int(self.file_size or 0)
+
+
+@dataclass(slots=True)
+class PhotoPayload(FilePayload):
+    type: ClassVar[str] = "photo"
+
+
+@dataclass(slots=True)
+class VideoPayload(FilePayload):
+    type: ClassVar[str] = "video"
+
+
+@dataclass(slots=True)
+class DocumentPayload(FilePayload):
+    type: ClassVar[str] = "document"
+
+
+@dataclass(slots=True)
+class UnknownPayload:
+    type: ClassVar[str] = "unknown"
+
+    def size(self) -> int:
+        return 0
+
+
+@dataclass(slots=True)
+class AlbumItem:
+    kind: str                 # photo / video / document / unknown
+    file_id: str | None = None
+    file_size: int = 0
+    caption: str = ""
+    ts: float | None = None   # msg.date файла
+
+
+@dataclass(slots=True)
+class AlbumPayload:
+    items: List[AlbumItem]
+    type: ClassVar[str] = "media_group"
+
+    def size(self) -> int:
+        return sum(int(it.file_size or 0) for it in self.items)
+
+
+Payload = TextPayload | PhotoPayload | VideoPayload | DocumentPayload | AlbumPayload | UnknownPayload
+FILE_TYPES = {c.type: c for c in (PhotoPayload, VideoPayload, DocumentPayload)}
+
+
+@dataclass(slots=True)
+class PendingMember:
+    """Автор почти-дубля, присоединённый к решению по представителю кластера."""
+    user_id: int | None
+    payload: Any
+    trace: Dict[str, Any] | None = None
+
+
+@dataclass(slots=True)
+class PendingEntry:
+    user_id: int | None
+    payload: Any
+    ts: float
+    trace: Dict[str, Any] | None = None
+    members: List[PendingMember] | None = None
+
+    def add_member(self, m: PendingMember):
+        # новый список, а не append: копия для фоновой записи могла взять старый
+        self.members = [*(self.members or ()), m]
+
+    def copy(self) -> "PendingEntry":
+        return PendingEntry(self.user_id, self.payload, self.ts, self.trace, self.members)
+
+
+# ---- из сообщения ----
+def from_message(msg) -> Payload:
+    """Telegram Message -> модель (для альбома — payload отдельного файла)."""
+    if getattr(msg, "text", None):
+        return TextPayload(msg.text)
+    caption = getattr(msg, "caption", None) or ""
+    if getattr(msg, "photo", None):
+        ph = msg.photo[-1]
+        return PhotoPayload(ph.file_id, ph.file_size or 0, caption)
+    for kind in ("video", "document"):
+        f = getattr(msg, kind, None)
+        if f:
+            return FILE_TYPES[kind](f.file_id, f.file_size or 0, caption)
+    return UnknownPayload()
+
+
+def album_item(p: Payload, ts: float | None) -> AlbumItem:
+    if isinstance(p, FilePayload):
+        return AlbumItem(p.type, p.file_id, p.file_size, p.caption, ts)
+    return AlbumItem("unknown", None, 0, getattr(p, "caption", "") or "", ts)
+
+
+# ---- кодеки ----
+def encode_item(it: AlbumItem) -> Dict[str, Any]:
+    return {"subtype": it.kind, "file_id": it.file_id, "file_size": it.file_size, "caption": it.caption, "ts": it.ts}
+
+
+def decode_item(d: Dict[str, Any]) -> AlbumItem:
+    return AlbumItem(d.get("subtype") or "unknown", d.get("file_id"), int(d.get("file_size") or 0),
+                     d.get("caption") or "", d.get("ts"))
+
+
+def encode_payload(p: Payload) -> Dict[str, Any]:
+    if isinstance(p, AlbumPayload):
+        return {"type": p.type, "items": [encode_item(it) for it in p.items]}
+    if isinstance(p, TextPayload):
+        return {"type": p.type, "data": {"type": p.type, "text": p.text}}
+    if isinstance(p, FilePayload):
+        return {"type": p.type, "data": {"type": p.type, "file_id": p.file_id, "file_size": p.file_size,
+                                         "caption": p.caption}}
+    return {"type": "unknown", "data": {"type": "unknown"}}
+
+
+def decode_payload(d) -> Payload:
+    """Понимает оба формата pending и «голый» dict из старых версий handle_private."""
+    if not isinstance(d, dict):
+        return UnknownPayload()
+    t = d.get("type")
+    if t == "media_group":
+        return AlbumPayload([decode_item(it) for it in d.get("items") or () if isinstance(it, dict)])
+    data = d.get("data") if isinstance(d.get("data"), dict) else d
+    if t == "text":
+        return TextPayload(data.get("text") or "")
+    cls = FILE_TYPES.get(t)
+    if cls is not None and data.get("file_id"):
+        return cls(data["file_id"], int(data.get("file_size") or 0), data.get("caption") or "")
+    return UnknownPayload()
+
+
+def encode_entry(e: PendingEntry) -> Dict[str, Any]:
+    out = {"user_id": e.user_id, "payload": encode_payload(e.payload), "ts": e.ts}
+    if e.trace is not None:
+        out["trace"] = e.trace
+    if e.members:
+        out["members"] = [{"user_id": m.user_id, "payload": encode_payload(m.payload), "trace": m.trace}
+                          for m in e.members]
+    return out
+
+
+def decode_entry(d: Dict[str, Any], now: float | None = None) -> PendingEntry:
+    members = [PendingMember(m.get("user_id"), decode_payload(m.get("payload")), m.get("trace"))
+               for m in d.get("members") or () if isinstance(m, dict)]
+    ts = d.get("ts")
+    return PendingEntry(d.get("user_id"), decode_payload(d.get("payload")),
+                        float(ts) if isinstance(ts, (int, float)) else (clock.time() if now is None else now),
+                        d.get("trace"), members or None)
@@ -1,7 +1,18 @@
+import asyncio
+import logging
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from config import MOD_GROUP_ID
-from state import save_state
-from utils import compute_reach_stats
+from config import MOD_GROUP_ID, APPROVED_CHANNEL_ID, ROLLUP_HOURS_WINDOW_DAYS, MODQ_TTL_S
+from state import save_state, get_archive
+from archive import parse_range
+from publish import publish_payload, run_batched
+from utils import fmt_size, human_speed
+from sketch import ReachCounter
+from relay import mod_relay
+from admission import admission
+from tracing import tracer, fmt_trace
+from receipts import receipts
+
+log = logging.getLogger("moderation")
 
 def mode_keyboard(cur: str):
     btn = "UNCHECK" if cur == "CHECK" else "CHECK"
@@ -20,25 +31,104 @@ async def is_admin(context, user_id: int) -> bool:
     except Exception:
         return False
 
+def bumper_reach(bumper) -> ReachCounter:
+    """Счётчик охвата текущей версии отбивки (создаём при первом обращении)."""
+    return bumper.setdefault("reach", {}).setdefault(str(bumper.get("version", 0)), ReachCounter())
+
+def _reach_line(bumper) -> str:
+    cur = bumper_reach(bumper)
+    line = f"Охват с активации: {'' if cur.is_exact else '~'}{cur.count()} чел."
+    versions = bumper.get("reach") or {}
+    if len(versions) > 1:
+        total = ReachCounter.union(versions.values())
+        line += f" (за все версии: {'' if total.is_exact else '~'}{total.count()})"
+    return line
+
+def _fmt_age(sec) -> str:
+    if sec is None: return "—"
+    if sec < 120: return f"{sec:.0f}с"
+    if sec < 7200: return f"{sec/60:.0f}мин"
+    return f"{sec/3600:.1f}ч"
+
+def _queue_line(queue) -> str:
+    if queue is None or not len(queue):
+        return "Очередь модерации: пусто"
+    m = queue.metrics()
+    return (f"Очередь модерации: {m['count']} (от {m['users']} польз.), "
+            f"старейшее {_fmt_age(m['oldest_s'])}, p50 {_fmt_age(m['p50_s'])}, p90 {_fmt_age(m['p90_s'])}")
+
+def _dedup_line(dedup) -> str:
+    if dedup is None:
+        return "Дедуп сводок: —"
+    st = dedup.stats()
+    line = f"Дедуп сводок: ключей {st['keys']}, повторов {st['hits']}, вытеснено {st['evicted']}"
+    if st.get("bloom"):
+        line += f"; Bloom: отсечено {st['bloom_negatives']}, пропущено без попадания {st['bloom_passed_misses']}"
+    return line
+
+def _content_line(index) -> str:
+    if index is None:
+        return "Повторы контента: —"
+    st = index.stats()
+    return f"Повторы контента: отсечено {st['hits']}, в индексе {st['keys']} (вытеснено {st['evicted']})"
+
+def _admission_line() -> str:
+    st = admission.stats()
+    return (f"Допуск: принято {st['admitted']}, отсечено по темпу {st['shed_rate']}, "
+            f"по перегрузке {st['shed_overload']}; в работе {st['inflight']}, ждут {st['waiting']}")
+
+def _relay_line() -> str:
+    st = mod_relay.stats()
+    return (f"Модчат: {'ДАЙДЖЕСТ' if st['digest'] else 'обычный'} режим, {st['rate_per_min']:.0f}/мин; "
+            f"сэкономлено вызовов API: {st['calls_saved']} (вклеено {st['merged']}, сводок {st['digests_sent']})")
+
+def _receipts_line() -> str:
+    st = receipts.stats()
+    return (f"Сводки авторам: {st['sent']} на {st['deliveries']} доставок; сэкономлено вызовов API: "
+            f"{st['api_saved']}, энергии у авторов: ~{st['energy_saved_j']:.0f} Дж")
+
+# апдейты обрабатываются параллельно: без блокировки два одновременных вызова
+# могут оба не найти control_message_id и создать два закрепа
+_control_lock = asyncio.Lock()
+
 async def upsert_control_message(app, state):
     """Создаёт/обновляет закреп с режимом и статистикой + статусом отбивки."""
-    reach = compute_reach_stats(state.get("history", {}))
+    async with _control_lock:
+        await _upsert_control_message(app, state)
+
+def _rollups(state):
+    """Охват берём из предагрегатов; пустые (первый запуск) досеваем из горячей истории."""
+    rollups = state["reach_rollups"]
+    if not len(rollups) and state.get("history"):
+        rollups.add_many((uid, ts) for uid, log in state["history"].items() for ts in log.ts)
+        save_state(state, "reach_rollups")
+    return rollups
+
+async def _upsert_control_message(app, state):
+    rollups = _rollups(state)
     bumper = state.get("bumper", {})
     lines = [
         f"Режим модерации: {state.get('mode')}",
-        f"Уникальных пользователей в истории: {reach['total_unique_users']}",
+        _queue_line(state.get("pending")),
+        f"Уникальных пользователей за {len(rollups)} дн.: {rollups.unique()}",
         "",
         f"Отбивка: {'АКТИВНА' if bumper.get('active') else 'выключена'}",
         f"Текст: {bumper.get('text')!r}" if bumper.get("text") else "Текст: —",
-        f"Охват с активации: {len(set(bumper.get('reach_user_ids', [])))} чел.",
+        _reach_line(bumper),
+        "",
+        _dedup_line(state.get("dedup_receipts")),
+        _content_line(state.get("content_index")),
+        _relay_line(),
+        _admission_line(),
+        _receipts_line(),
         "",
         "Охват по дням (последние):"
     ]
-    for day, cnt in reach["per_day_counts"][:14]:
+    for day, cnt in rollups.per_day(14):
         lines.append(f"{day}: {cnt}")
     lines.append("")
-    lines.append("Охват по часам:")
-    hours = {h:c for h,c in reach["per_hour_counts"]}
+    lines.append(f"Охват по часам (за {ROLLUP_HOURS_WINDOW_DAYS} дн.):")
+    hours = {h:c for h,c in rollups.per_hour(ROLLUP_HOURS_WINDOW_DAYS)}
     for h in range(24):
         lines.append(f"{h:02d}:00 — {hours.get(h,0)}")
 
@@ -55,8 +145,11 @@ async def upsert_control_message(app, state):
                 await app.bot.pin_chat_message(chat_id=MOD_GROUP_ID, message_id=msg.message_id, disable_notification=True)
             except Exception:
                 pass
-            save_state(state)
-    except Exception:
+            save_state(state, "control_message_id")
+    except Exception as e:
+        # текст не изменился — закреп на месте, новый не нужен
+        if "not modified" in str(e).lower():
+            return
         # если не удалось отредактировать (удалён?), создаём новый
         msg = await app.bot.send_message(chat_id=MOD_GROUP_ID, text=text, reply_markup=mode_keyboard(state.get("mode")))
         state["control_message_id"] = msg.message_id
@@ -64,7 +157,7 @@ async def upsert_control_message(app, state):
             await app.bot.pin_chat_message(chat_id=MOD_GROUP_ID, message_id=msg.message_id, disable_notification=True)
         except Exception:
             pass
-        save_state(state)
+        save_state(state, "control_message_id")
 
 # команды отбивки (только админы в модчате)
 async def cmd_bumper_set(update, context, state):
@@ -73,22 +166,225 @@ async def cmd_bumper_set(update, context, state):
     text = " ".join(context.args) if context.args else ""
     state["bumper"]["text"] = (text or "").strip()
     await update.message.reply_text("Текст отбивки установлен." if text else "Текст отбивки очищен.")
-    await upsert_control_message(context.application, state); save_state(state)
+    await upsert_control_message(context.application, state); save_state(state, "bumper")
 
 async def cmd_bumper_on(update, context, state):
     if update.effective_chat.id != MOD_GROUP_ID: return
     if not await is_admin(context, update.effective_user.id): return
-    b = state["bumper"]; b["active"] = True; b["version"] += 1; b["reach_user_ids"] = []
+    b = state["bumper"]; b["active"] = True; b["version"] += 1
+    b.setdefault("reach", {})[str(b["version"])] = ReachCounter()
     await update.message.reply_text("Отбивка активирована.")
-    await upsert_control_message(context.application, state); save_state(state)
+    await upsert_control_message(context.application, state); save_state(state, "bumper")
 
 async def cmd_bumper_off(update, context, state):
     if update.effective_chat.id != MOD_GROUP_ID: return
     if not await is_admin(context, update.effective_user.id): return
     state["bumper"]["active"] = False
     await update.message.reply_text("Отбивка выключена.")
-    await upsert_control_message(context.application, state); save_state(state)
+    await upsert_control_message(context.application, state); save_state(state, "bumper")
 
 async def cmd_bumper_status(update, context, state):
     if update.effective_chat.id != MOD_GROUP_ID: return
-    await upsert_control_message(context.application, state)
\ No newline at end of file
+    await upsert_control_message(context.application, state)
+
+# ====== Решения модерации (одиночные и массовые) ======
+async def apply_decisions(bot, entries, allow: bool, *, clear_keyboards: bool = True):
+    """entries — [(decision_mid, entry)], уже изъятые из очереди.
+    Снимаем кнопки, отчитываемся в модчат, уведомляем авторов и (если allow)
+    публикуем — всё пачками с ограниченной параллельностью. Возвращает (ok, failed) публикаций.
+    Решение по кластеру почти-дублей (entry.members) касается всех его авторов,
+    но публикуется один представитель."""
+    if not entries:
+        return 0, 0
+    authors = {e.user_id for _, e in entries}
+    authors.update(m.user_id for _, e in entries for m in e.members or ())
+    authors.discard(None)
+    # трассы заявок (и присоединённых почти-дублей) — этап решения
+    traces = [tracer.resume(e.trace) for _, e in entries]
+    member_traces = [tracer.resume(m.trace) for _, e in entries for m in e.members or ()]
+    for t in traces + member_traces:
+        if t is not None:
+            t.mark("decided")
+    if clear_keyboards:
+        await run_batched(bot.edit_message_reply_markup(chat_id=MOD_GROUP_ID, message_id=int(mid), reply_markup=None)
+                          for mid, _ in entries)
+    verdict = "допущено" if allow else "не допущено"
+    try:
+        text = f"Решение: {verdict}." if len(entries) == 1 else f"Решение: {verdict} — {len(entries)} шт."
+        members = sum(len(e.members or ()) for _, e in entries)
+        if members:
+            text += f" Вместе с похожими: +{members}."
+        await bot.send_message(chat_id=MOD_GROUP_ID, text=text)
+    except Exception:
+        pass
+    user_text = "Ваша идея одобрена!" if allow else "Ваша идея не прошла модерацию."
+    await run_batched(bot.send_message(chat_id=uid, text=user_text) for uid in authors)
+    for t in traces + member_traces:
+        if t is not None:
+            t.mark("notified")
+    if not allow:
+        for t in traces + member_traces:
+            tracer.finish(t, "denied")
+        return 0, 0
+    ok, failed = await run_batched(_publish_traced(bot, e.payload, t) for (_, e), t in zip(entries, traces))
+    for t in traces:
+        tracer.finish(t, "approved" if t is None or t.has("published") else "publish_failed")
+    for t in member_traces:
+        tracer.finish(t, "approved")   # опубликован представитель кластера
+    if failed:
+        try:
+            await bot.send_message(chat_id=MOD_GROUP_ID, text=f"Не удалось опубликовать: {failed} из {ok + failed}.")
+        except Exception:
+            pass
+    return ok, failed
+
+async def expire_decisions(bot, entries) -> int:
+    """entries — [(decision_mid, entry)], снятые с очереди по MODQ_TTL_S. Как отказ, только
+    причина другая: кнопки снимаем, авторам — «не рассмотрено вовремя», трассы — expired."""
+    if not entries:
+        return 0
+    authors = {e.user_id for _, e in entries}
+    authors.update(m.user_id for _, e in entries for m in e.members or ())
+    authors.discard(None)
+    traces = [tracer.resume(e.trace) for _, e in entries]
+    traces += [tracer.resume(m.trace) for _, e in entries for m in e.members or ()]
+    await run_batched(bot.edit_message_reply_markup(chat_id=MOD_GROUP_ID, message_id=int(mid), reply_markup=None)
+                      for mid, _ in entries)
+    try:
+        await bot.send_message(chat_id=MOD_GROUP_ID,
+                               text=f"Снято с очереди без решения (ждали дольше {MODQ_TTL_S / 3600:.0f} ч): {len(entries)} шт.")
+    except Exception:
+        pass
+    await run_batched(bot.send_message(chat_id=uid, text="Вашу идею не успели рассмотреть — пришлите её снова, если она ещё актуальна.")
+                      for uid in authors)
+    for t in traces:
+        tracer.finish(t, "expired")
+    log.info("moderation queue: %d entries expired (%d authors notified)", len(entries), len(authors))
+    return len(entries)
+
+async def expire_job(context):
+    """Раз в MODQ_EXPIRE_EVERY_S: снимаем с очереди то, что ждёт дольше MODQ_TTL_S."""
+    state = context.application.bot_data["state"]
+    entries = state["pending"].expire(MODQ_TTL_S)
+    if not entries:
+        return
+    save_state(state, "pending")
+    await expire_decisions(context.bot, entries)
+    try:
+        await upsert_control_message(context.application, state)
+    except Exception:
+        pass
+
+async def _publish_traced(bot, payload, trace):
+    if await publish_payload(bot, APPROVED_CHANNEL_ID, payload) and trace is not None:
+        trace.mark("published")
+
+async def _bulk(update, context, state, entries, allow: bool):
+    save_state(state, "pending")
+    if not entries:
+        await update.message.reply_text("Подходящих записей в очереди нет.")
+        return
+    await apply_decisions(context.bot, entries, allow)
+    await upsert_control_message(context.application, state)
+
+# команды массовых решений (только админы в модчате)
+async def cmd_approve_user(update, context, state):
+    """/approve_user <user_id> — допустить всё, что ждёт от пользователя."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    if not await is_admin(context, update.effective_user.id): return
+    try:
+        uid = int(context.args[0])
+    except Exception:
+        await update.message.reply_text("Формат: /approve_user <user_id>")
+        return
+    await _bulk(update, context, state, state["pending"].take_user(uid), True)
+
+async def cmd_approve_next(update, context, state):
+    """/approve_next <N> — допустить N самых ранних."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    if not await is_admin(context, update.effective_user.id): return
+    try:
+        n = int(context.args[0])
+        if n <= 0: raise ValueError
+    except Exception:
+        await update.message.reply_text("Формат: /approve_next <N>")
+        return
+    await _bulk(update, context, state, state["pending"].take_next(n), True)
+
+async def cmd_deny_older(update, context, state):
+    """/deny_older <минуты> — отклонить всё, что ждёт дольше X минут."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    if not await is_admin(context, update.effective_user.id): return
+    try:
+        minutes = float(context.args[0])
+    except Exception:
+        await update.message.reply_text("Формат: /deny_older <минуты>")
+        return
+    await _bulk(update, context, state, state["pending"].take_older_than(minutes * 60), False)
+
+async def cmd_queue(update, context, state):
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    q = state["pending"]
+    m = q.metrics()
+    by_type = ", ".join(f"{t}: {c}" for t, c in sorted(m["by_type"].items())) or "—"
+    await update.message.reply_text(f"{_queue_line(q)}\nПо типам: {by_type}")
+
+async def cmd_slow(update, context, state):
+    """/slow [N] — перцентили задержек по этапам и N самых медленных недавних заявок."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    if not await is_admin(context, update.effective_user.id): return
+    try:
+        n = max(1, min(30, int(context.args[0]))) if context.args else 10
+    except Exception:
+        await update.message.reply_text("Формат: /slow [N]")
+        return
+    st = tracer.stats()
+    if not st["finished"]:
+        await update.message.reply_text(f"Завершённых трасс пока нет (открыто: {st['open']}).")
+        return
+    lines = [f"Трассы: {st['finished']} последних, открыто {st['open']}; "
+             + ", ".join(f"{k}: {v}" for k, v in sorted(st["outcomes"].items())),
+             "", "Этап: p50 / p90 / p99 / max"]
+    for stage, p in tracer.stage_percentiles().items():
+        lines.append(f"{stage}: {p['p50']:.2f}s / {p['p90']:.2f}s / {p['p99']:.2f}s / {p['max']:.2f}s ({p['count']})")
+    lines += ["", f"Самые медленные ({n}):"]
+    lines += [fmt_trace(t) for t in tracer.slowest(n)]
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+async def cmd_archive_stats(update, context, state):
+    """/archive_stats [YYYY-MM-DD [YYYY-MM-DD]] — охват и доставка по долгому архиву."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    if not await is_admin(context, update.effective_user.id): return
+    arch = get_archive()
+    if arch is None:
+        await update.message.reply_text("Архив истории выключен (ARCHIVE_ENABLE=false).")
+        return
+    try:
+        start, end = parse_range(context.args or [])
+    except Exception:
+        await update.message.reply_text("Формат: /archive_stats [YYYY-MM-DD [YYYY-MM-DD]]")
+        return
+
+    def _scan():
+        arch.flush()   # чтобы в отчёт попало и то, что ещё в буфере
+        return arch.reach_stats(start, end), arch.delivery_stats(start, end)
+
+    # чтение архива — поток за потоком, с диска: не на event loop
+    reach, deliv = await asyncio.to_thread(_scan)
+    days = reach["per_day_counts"]
+    lines = [
+        f"Архив: {days[-1][0]} — {days[0][0]}" if days else "Архив: за период записей нет",
+        f"Сообщений: {reach['messages']}, уникальных авторов: ~{reach['total_unique_users']}",
+    ]
+    sz, tm, sp = deliv["sizes"], deliv["times"], deliv["speeds_bps"]
+    if sz:
+        lines.append(f"Объём: {fmt_size(sz['count'] * sz['mean'])}, p50 {fmt_size(sz['p50'])}, p90 {fmt_size(sz['p90'])}")
+    if tm:
+        lines.append(f"Доставка: p50 {tm['p50']:.2f}s, p90 {tm['p90']:.2f}s, max {tm['max']:.2f}s")
+    if sp:
+        lines.append(f"Скорость: p50 {human_speed(sp['p50'])}, p90 {human_speed(sp['p90'])}")
+    if days:
+        lines.append("")
+        lines.append("Авторов по дням (последние):")
+        lines += [f"{d}: ~{n}" for d, n in days[:14]]
+    await update.message.reply_text("\n".join(lines)[:4096])
@@ -0,0 +1,149 @@
+# modqueue.py
+"""
+Очередь модерации (state["pending"]).
+
+Порядок — по времени поступления (dict хранит порядок вставки), плюс индексы
+по user_id и по типу payload. Каждая запись знает время поступления, поэтому
+есть TTL и метрики возраста очереди. Ключ — message_id сообщения с кнопками
+решения в модчате (строкой, как и раньше). Записи — models.PendingEntry.
+"""
+from typing import Any, Dict, Iterable, List, Tuple
+
+import clock
+from utils import percentile
+from models import PendingEntry, encode_entry, decode_entry
+
+Entry = PendingEntry
+
+
+class ModerationQueue:
+    __slots__ = ("_items", "_by_user", "_by_type")
+
+    def __init__(self):
+        self._items: Dict[str, Entry] = {}
+        self._by_user: Dict[int, Dict[str, None]] = {}   # uid -> упорядоченное множество mid
+        self._by_type: Dict[str, Dict[str, None]] = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, mid) -> bool:
+        return str(mid) in self._items
+
+    def get(self, mid, default=None):
+        return self._items.get(str(mid), default)
+
+    def items(self):
+        return self._items.items()
+
+    @staticmethod
+    def _ptype(entry: Entry) -> str:
+        return getattr(entry.payload, "type", "unknown")
+
+    def _index(self, mid: str, entry: Entry):
+        self._by_user.setdefault(entry.user_id, {})[mid] = None
+        self._by_type.setdefault(self._ptype(entry), {})[mid] = None
+
+    def _unindex(self, mid: str, entry: Entry):
+        for idx, key in ((self._by_user, entry.user_id), (self._by_type, self._ptype(entry))):
+            bucket = idx.get(key)
+            if bucket is not None:
+                bucket.pop(mid, None)
+                if not bucket:
+                    idx.pop(key, None)
+
+    def add(self, mid, user_id, payload, ts: float | None = None, trace: Dict[str, Any] | None = None) -> Entry:
+        mid = str(mid)
+        entry = PendingEntry(user_id, payload, clock.time() if ts is None else ts, trace)
+        old = self._items.pop(mid, None)
+        if old is not None:
+            self._unindex(mid, old)
+        self._items[mid] = entry
+        self._index(mid, entry)
+        return entry
+
+    def pop(self, mid, default=None):
+        mid = str(mid)
+        entry = self._items.pop(mid, None)
+        if entry is None:
+            return default
+        self._unindex(mid, entry)
+        return entry
+
+    def _take(self, mids: Iterable[str]) -> List[Tuple[str, Entry]]:
+        out = []
+        for mid in list(mids):
+            entry = self.pop(mid)
+            if entry is not None:
+                out.append((mid, entry))
+        return out
+
+    # ---- выборки для массовых решений (забирают записи из очереди) ----
+    def take_user(self, user_id) -> List[Tuple[str, Entry]]:
+        return self._take(self._by_user.get(user_id, {}))
+
+    def take_type(self, ptype: str) -> List[Tuple[str, Entry]]:
+        return self._take(self._by_type.get(ptype, {}))
+
+    def take_next(self, n: int) -> List[Tuple[str, Entry]]:
+        mids = []
+        for mid in self._items:
+            if len(mids) >= n:
+                break
+            mids.append(mid)
+        return self._take(mids)
+
+    def take_older_than(self, age_s: float, now: float | None = None) -> List[Tuple[str, Entry]]:
+        """Записи идут по времени поступления — идём с головы до первой «молодой»."""
+        now = clock.time() if now is None else now
+        cutoff = now - age_s
+        mids = []
+        for mid, entry in self._items.items():
+            if entry.ts > cutoff:
+                break
+            mids.append(mid)
+        return self._take(mids)
+
+    def expire(self, ttl_s: float, now: float | None = None) -> List[Tuple[str, Entry]]:
+        return self.take_older_than(ttl_s, now)
+
+    # ---- метрики ----
+    def metrics(self, now: float | None = None) -> Dict[str, Any]:
+        now = clock.time() if now is None else now
+        ages = [max(0.0, now - e.ts) for e in self._items.values()]
+        return {
+            "count": len(ages),
+            "oldest_s": max(ages) if ages else None,
+            "p50_s": percentile(ages, 0.5),
+            "p90_s": percentile(ages, 0.9),
+            "users": len(self._by_user),
+            "by_type": {t: len(b) for t, b in self._by_type.items()},
+        }
+
+    def copy(self) -> "ModerationQueue":
+        """Снимок для фоновой записи (без индексов)."""
+        q = ModerationQueue()
+        q._items = {mid: e.copy() for mid, e in self._items.items()}
+        return q
+
+    # ---- сериализация ----
+    def to_dense(self) -> Dict[str, Any]:
+        return {"items": [[mid, encode_entry(e)] for mid, e in self._items.items()]}
+
+    @classmethod
+    def from_dense(cls, d) -> "ModerationQueue":
+        """Понимает {"items": [[mid, entry], ...]} и старый плоский {mid: {user_id, payload}}."""
+        q = cls()
+        if not isinstance(d, dict):
+            return q
+        now = clock.time()
+        if isinstance(d.get("items"), list):
+            pairs = [(p[0], p[1]) for p in d["items"] if isinstance(p, list) and len(p) == 2]
+        else:
+            pairs = list(d.items())
+        for mid, e in pairs:
+            if isinstance(e, dict):
+                mid = str(mid)
+                entry = q._items[mid] = decode_entry(e, now)
+                q._index(mid, entry)
+        return q
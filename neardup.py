@@ -0,0 +1,189 @@
+# neardup.py
+"""
+Поиск почти-дублей текста (спам-волны с вариациями) — MinHash + LSH в памяти.
+
+  - шинглы: символьные k-граммы нормализованного текста (casefold, пробелы схлопнуты);
+  - подпись: one-permutation hashing — каждый шингл хэшируется ОДИН раз и попадает
+    в одну из K корзин (минимум по корзине), пустые корзины заполняются соседними
+    (densification). Итого O(len(text)), а не O(len(text) * K);
+  - LSH: подпись режется на B полос по R строк; документы с совпавшей полосой —
+    кандидаты, для них считаем оценку Жаккара по доле совпавших позиций;
+  - кластер: новый текст присоединяется к кластеру самого свежего похожего
+    кандидата (>= threshold), иначе открывает свой;
+  - память ограничена окном времени и числом документов: старые снимаются
+    с головы OrderedDict вместе с записями в корзинах.
+
+Индекс живёт только в памяти процесса (hash() строк солится на каждый запуск).
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import clock
+from config import (
+    NEARDUP_WINDOW_S, NEARDUP_MAX_DOCS, NEARDUP_THRESHOLD, NEARDUP_PERM,
+    NEARDUP_BANDS, NEARDUP_SHINGLE, NEARDUP_MAX_CANDIDATES,
+)
+
+MASK64 = (1 << 64) - 1
+
+
+def normalize(text: str) -> str:
+    return " ".join((text or "").casefold().split())
+
+
+class MinHasher:
+    __slots__ = ("k", "shingle")
+
+    def __init__(self, k: int = NEARDUP_PERM, shingle: int = NEARDUP_SHINGLE):
+        self.k = int(k)
+        self.shingle = int(shingle)
+
+    def signature(self, norm: str) -> List[int]:
+        k, w = self.k, self.shingle
+        empty = MASK64 + 1
+        sig = [empty] * k
+        n = len(norm)
+        for i in range(max(1, n - w + 1)):
+            h = hash(norm[i:i + w]) & MASK64
+            b = h % k
+            v = h // k
+            if v < sig[b]:
+                sig[b] = v
+        # densification: пустая корзина берёт значение ближайшей непустой справа (по кругу)
+        # со сдвигом на расстояние — иначе все пустые корзины совпадали бы у любых текстов
+        if empty in sig:
+            filled = [i for i in range(k) if sig[i] != empty]
+            if filled:
+                out = list(sig)
+                for i in range(k):
+                    if sig[i] == empty:
+                        d = 1
+                        while sig[(i + d) % k] == empty:
+                            d += 1
+                        out[i] = (sig[(i + d) % k] + d * 0x9E3779B97F4A7C15) & MASK64
+                sig = out
+        return sig
+
+
+class NearDupIndex:
+    def __init__(self, window_s: float = NEARDUP_WINDOW_S, max_docs: int = NEARDUP_MAX_DOCS,
+                 threshold: float = NEARDUP_THRESHOLD, perm: int = NEARDUP_PERM, bands: int = NEARDUP_BANDS,
+                 shingle: int = NEARDUP_SHINGLE, max_candidates: int = NEARDUP_MAX_CANDIDATES):
+        bands = max(1, min(int(bands), int(perm)))
+        self.hasher = MinHasher(perm, shingle)
+        self.rows = max(1, int(perm) // bands)
+        self.bands = bands
+        self.window_s = float(window_s)
+        self.max_docs = int(max_docs)
+        self.threshold = float(threshold)
+        self.max_candidates = int(max_candidates)
+        self._next_id = 0
+        self._docs: "OrderedDict[int, tuple]" = OrderedDict()    # doc -> (ts, sig, band_keys, cluster)
+        self._buckets: Dict[tuple, Dict[int, None]] = {}          # (band, hash) -> упорядоченное множество doc
+        self._clusters: Dict[int, List] = {}                      # cluster -> [size, ref]
+        # счётчики
+        self.adds = 0
+        self.matched = 0
+        self.expired = 0
+        self.add_time_s = 0.0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _band_keys(self, sig: List[int]) -> List[tuple]:
+        r = self.rows
+        return [(b, hash(tuple(sig[b * r:(b + 1) * r]))) for b in range(self.bands)]
+
+    def _similarity(self, a: List[int], b: List[int]) -> float:
+        return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+    def expire(self, now: float | None = None) -> int:
+        now = clock.time() if now is None else now
+        cutoff = now - self.window_s
+        docs = self._docs
+        n = 0
+        while docs:
+            doc, rec = next(iter(docs.items()))
+            if rec[0] > cutoff and len(docs) <= self.max_docs:
+                break
+            docs.popitem(last=False)
+            for bk in rec[2]:
+                bucket = self._buckets.get(bk)
+                if bucket is not None:
+                    bucket.pop(doc, None)
+                    if not bucket:
+                        del self._buckets[bk]
+            cl = self._clusters.get(rec[3])
+            if cl is not None:
+                cl[0] -= 1
+                if cl[0] <= 0:
+                    del self._clusters[rec[3]]
+            n += 1
+        self.expired += n
+        return n
+
+    def add(self, text: str, now: float | None = None) -> Tuple[int, float, int]:
+        """Добавить текст. Возвращает (cluster, похожесть на ближайший, размер кластера);
+        похожесть 0.0 — открыт новый кластер."""
+        t0 = time.perf_counter()
+        now = clock.time() if now is None else now
+        self.expire(now)
+        sig = self.hasher.signature(normalize(text))
+        keys = self._band_keys(sig)
+
+        # кандидаты: от свежих к старым, не больше max_candidates сравнений
+        best, best_sim = None, 0.0
+        checked = set()
+        for bk in keys:
+            bucket = self._buckets.get(bk)
+            if not bucket:
+                continue
+            for doc in reversed(bucket):
+                if doc in checked:
+                    continue
+                checked.add(doc)
+                sim = self._similarity(sig, self._docs[doc][1])
+                if sim >= self.threshold and sim > best_sim:
+                    best, best_sim = doc, sim
+                    break
+                if len(checked) >= self.max_candidates:
+                    break
+            if best is not None or len(checked) >= self.max_candidates:
+                break
+
+        doc = self._next_id
+        self._next_id += 1
+        if best is not None:
+            cluster = self._docs[best][3]
+            self.matched += 1
+        else:
+            cluster, best_sim = doc, 0.0
+        cl = self._clusters.setdefault(cluster, [0, None])
+        cl[0] += 1
+        self._docs[doc] = (now, sig, keys, cluster)
+        for bk in keys:
+            self._buckets.setdefault(bk, {})[doc] = None
+        self.adds += 1
+        self.add_time_s += time.perf_counter() - t0
+        return cluster, best_sim, cl[0]
+
+    # внешняя привязка кластера (например, message_id общего решения в модчате)
+    def ref(self, cluster: int):
+        cl = self._clusters.get(cluster)
+        return cl[1] if cl else None
+
+    def set_ref(self, cluster: int, ref: Any):
+        cl = self._clusters.get(cluster)
+        if cl is not None:
+            cl[1] = ref
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = [c[0] for c in self._clusters.values()]
+        return {"docs": len(self._docs), "clusters": len(sizes), "largest": max(sizes) if sizes else 0,
+                "buckets": len(self._buckets), "adds": self.adds, "matched": self.matched,
+                "expired": self.expired, "avg_add_us": (self.add_time_s / self.adds * 1e6) if self.adds else 0.0}
+
+
+# один на процесс
+near_index = NearDupIndex()
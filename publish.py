@@ -0,0 +1,114 @@
+# publish.py
+"""Публикация payload-ов в канал: одиночная и пачками с ограниченной конкурентностью."""
+import asyncio
+import logging
+from typing import Iterable, List, Tuple
+
+from telegram import InputMediaPhoto, InputMediaVideo
+
+from config import PUBLISH_BATCH_SIZE, PUBLISH_CONCURRENCY
+from models import (TextPayload, PhotoPayload, VideoPayload, DocumentPayload, AlbumPayload,
+                    decode_payload)
+
+log = logging.getLogger("publish")
+
+partial_albums = 0     # альбомов, ушедших в канал не целиком
+
+
+async def _send_text(bot, chat_id, p: TextPayload):
+    await bot.send_message(chat_id=chat_id, text=p.text)
+
+
+async def _send_photo(bot, chat_id, p: PhotoPayload):
+    await bot.send_photo(chat_id=chat_id, photo=p.file_id, caption=p.caption)
+
+
+async def _send_video(bot, chat_id, p: VideoPayload):
+    await bot.send_video(chat_id=chat_id, video=p.file_id, caption=p.caption)
+
+
+async def _send_document(bot, chat_id, p: DocumentPayload):
+    await bot.send_document(chat_id=chat_id, document=p.file_id, caption=p.caption)
+
+
+async def _send_album(bot, chat_id, p: AlbumPayload):
+    media, docs = [], []
+    for it in p.items:
+        if it.kind == "photo":
+            media.append(InputMediaPhoto(media=it.file_id, caption=it.caption))
+        elif it.kind == "video":
+            media.append(InputMediaVideo(media=it.file_id, caption=it.caption))
+        elif it.kind == "document":
+            docs.append(it)
+    # части альбома независимы: ошибка медиагруппы или одного документа не отменяет остальные.
+    # Всё упало — пробрасываем (публикации нет); упала часть — публикация частичная, считаем её.
+    global partial_albums
+    parts = ([lambda: bot.send_media_group(chat_id=chat_id, media=media)] if media else []) + \
+            [lambda d=d: bot.send_document(chat_id=chat_id, document=d.file_id, caption=d.caption) for d in docs]
+    errors = []
+    for send in parts:
+        try:
+            await send()
+        except Exception as e:
+            errors.append(e)
+    if errors and len(errors) == len(parts):
+        raise errors[0]
+    if errors:
+        partial_albums += 1
+        log.warning("album published partially: %d of %d parts failed: %s", len(errors), len(parts), errors[0])
+
+
+# единственное место, где тип payload-а решает, как его отправить
+PUBLISHERS = {
+    TextPayload: _send_text,
+    PhotoPayload: _send_photo,
+    VideoPayload: _send_video,
+    DocumentPayload: _send_document,
+    AlbumPayload: _send_album,
+}
+
+
+async def publish_payload(bot, chat_id: int, payload) -> bool:
+    """payload — модель из models.py (dict старого формата тоже понимаем).
+    False — отправлять нечего (неизвестный тип)."""
+    send = PUBLISHERS.get(type(payload))
+    if send is None:
+        if not isinstance(payload, dict):
+            return False
+        payload = decode_payload(payload)
+        send = PUBLISHERS.get(type(payload))
+        if send is None:
+            return False
+    await send(bot, chat_id, payload)
+    return True
+
+
+async def run_batched(coros: Iterable, *, batch_size: int = PUBLISH_BATCH_SIZE,
+                      concurrency: int = PUBLISH_CONCURRENCY) -> Tuple[int, int]:
+    """Выполняем корутины пачками по batch_size, внутри пачки — не больше concurrency
+    одновременно. Ошибки не прерывают остальные. Возвращает (ok, failed)."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+    ok = failed = 0
+
+    async def _one(c):
+        async with sem:
+            return await c
+
+    batch: List = []
+    async def _flush():
+        nonlocal ok, failed
+        for r in await asyncio.gather(*(_one(c) for c in batch), return_exceptions=True):
+            if isinstance(r, BaseException):
+                failed += 1
+                log.warning("batched send failed: %s", r)
+            else:
+                ok += 1
+        batch.clear()
+
+    for c in coros:
+        batch.append(c)
+        if len(batch) >= batch_size:
+            await _flush()
+    if batch:
+        await _flush()
+    return ok, failed
@@ -0,0 +1,166 @@
+# receipts.py
+"""
+Объединение сводок доставки на пользователя.
+
+Раньше каждая доставка — отдельное сообщение автору: лишний вызов API у нас
+и лишнее пробуждение радио у него (по модели energy.estimate_energy каждое
+пробуждение стоит «хвост» tail_s на половинной мощности радио).
+
+Теперь доставки автора, пришедшие подряд, копятся в пачке и уходят одной
+сводкой (суммарный размер, средняя скорость, энергия). Окно — по темпу автора:
+EWMA интервала между его сообщениями; разовый автор (или давно молчавший)
+получает сводку сразу, пишущий сериями — через ~2 интервала, но не дольше
+RECEIPT_WINDOW_MAX_S. Пачка уходит и досрочно, набрав RECEIPT_MAX_BATCH.
+
+Считаем сэкономленное: сводок не отправлено (= вызовов API) и энергию
+несостоявшихся пробуждений радио.
+"""
+from typing import Any, Dict, List
+
+import clock
+from config import POWER_PROFILES, RECEIPT_WINDOW_MIN_S, RECEIPT_WINDOW_MAX_S, RECEIPT_MAX_BATCH
+from energy import EnergyInput, estimate_energy
+from utils import fmt_size, human_speed
+
+GAP_ALPHA = 0.3          # вес нового интервала в EWMA
+IDLE_FORGET_S = 3600.0   # темп автора, молчащего дольше, забываем
+
+
+def wakeup_j(network: str | None) -> float:
+    """Энергия одного лишнего пробуждения радио (хвост), как в estimate_energy."""
+    prof = POWER_PROFILES.get(network or "lte") or POWER_PROFILES["lte"]
+    return prof["radio_w"] * 0.5 * prof["tail_s"]
+
+
+class Batch:
+    __slots__ = ("bid", "count", "bytes", "dur_sum", "dur_n", "energy_j", "energy_n", "network", "saved_j", "started")
+
+    def __init__(self, now: float, bid: int = 0):
+        self.bid = bid           # номер пачки: таймер флеша знает, какую пачку он ждёт
+        self.count = 0
+        self.bytes = 0
+        self.dur_sum = 0.0
+        self.dur_n = 0
+        self.energy_j = 0.0
+        self.energy_n = 0
+        self.network = None
+        self.saved_j = 0.0       # пробуждения, которых не будет благодаря объединению
+        self.started = now
+
+    def add(self, size_b: int, delivery_seconds: float | None, energy: Dict[str, Any]):
+        if self.count:
+            self.saved_j += wakeup_j(energy.get("network") or self.network)
+        self.count += 1
+        self.bytes += int(size_b or 0)
+        if delivery_seconds is not None and delivery_seconds > 0:
+            self.dur_sum += delivery_seconds
+            self.dur_n += 1
+        if energy.get("has_duration"):
+            self.energy_j += energy["total_j"]
+            self.energy_n += 1
+            self.network = energy.get("network") or self.network
+
+    def speed_bps(self) -> float | None:
+        return self.bytes / self.dur_sum if self.dur_sum > 0 else None
+
+
+class ReceiptBatcher:
+    def __init__(self, window_min_s: float = RECEIPT_WINDOW_MIN_S, window_max_s: float = RECEIPT_WINDOW_MAX_S,
+                 max_batch: int = RECEIPT_MAX_BATCH):
+        self.window_min_s = float(window_min_s)
+        self.window_max_s = float(window_max_s)
+        self.max_batch = max(1, int(max_batch))
+        self._batches: Dict[Any, Batch] = {}
+        self._pace: Dict[Any, List[float]] = {}     # uid -> [последнее сообщение, EWMA интервала или -1]
+        self._last_sweep = 0.0
+        self._seq = 0
+        # счётчики
+        self.deliveries = 0
+        self.sent = 0
+        self.api_saved = 0
+        self.energy_saved_j = 0.0
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < 600:
+            return
+        self._last_sweep = now
+        for uid in [u for u, (last, _) in self._pace.items() if now - last > IDLE_FORGET_S]:
+            del self._pace[uid]
+
+    def window(self, uid, now: float) -> float:
+        """Обновляем темп автора и возвращаем окно для его пачки (0 — слать сразу)."""
+        self._sweep(now)
+        pace = self._pace.get(uid)
+        if pace is None:
+            self._pace[uid] = [now, -1.0]
+            return self.window_min_s
+        gap = now - pace[0]
+        ewma = gap if pace[1] < 0 else GAP_ALPHA * gap + (1 - GAP_ALPHA) * pace[1]
+        pace[0], pace[1] = now, ewma
+        if ewma > self.window_max_s:
+            return self.window_min_s
+        return min(self.window_max_s, max(self.window_min_s, 2 * ewma))
+
+    def add(self, uid, size_b: int, delivery_seconds: float | None, rtt_ms: float | None = None,
+            now: float | None = None):
+        """Доставка в пачку автора. Возвращает (пачка, окно, новая ли пачка):
+        окно 0 или полная пачка — отправлять сейчас (take), иначе — по таймеру."""
+        now = clock.monotonic() if now is None else now
+        energy = estimate_energy(EnergyInput(total_bytes=size_b, duration_s=delivery_seconds, rtt_ms=rtt_ms, network="auto"))
+        win = self.window(uid, now)
+        b = self._batches.get(uid)
+        new = b is None
+        if new:
+            self._seq += 1
+            b = self._batches[uid] = Batch(now, self._seq)
+        b.add(size_b, delivery_seconds, energy)
+        self.deliveries += 1
+        if b.count >= self.max_batch:
+            win = 0.0
+        return b, win, new
+
+    def take(self, uid, bid: int | None = None) -> Batch | None:
+        """Забираем пачку автора; bid — только если открыта именно эта пачка
+        (таймер ушедшей досрочно пачки не должен забрать следующую раньше её окна)."""
+        b = self._batches.get(uid)
+        if b is None or (bid is not None and b.bid != bid):
+            return None
+        del self._batches[uid]
+        if b is not None and b.count:
+            self.sent += 1
+            self.api_saved += b.count - 1
+            self.energy_saved_j += b.saved_j
+        return b
+
+    def stats(self) -> Dict[str, Any]:
+        return {"deliveries": self.deliveries, "sent": self.sent, "api_saved": self.api_saved,
+                "energy_saved_j": self.energy_saved_j, "open": len(self._batches)}
+
+
+def format_receipt(b: Batch) -> str:
+    if b.energy_n:
+        net = f", сеть: {b.network}" if b.network else ""
+        mb = b.bytes / (1024 * 1024)
+        per_mb = f" (~{b.energy_j / mb:.4f} Дж/MB)" if mb > 0 else ""
+        energy_line = f"Энергия (оценка): {b.energy_j:.2f} Дж{per_mb}{net}"
+    else:
+        energy_line = "Энергия: нужна длительность для точной оценки"
+    if b.count == 1:
+        dur = f"{b.dur_sum:.3f}s" if b.dur_n else "—"
+        return ("Сводка доставки:\n"
+                f" • Размер: {fmt_size(b.bytes)}\n"
+                f" • Скорость: {human_speed(b.speed_bps())}\n"
+                f" • Длительность: {dur}\n"
+                f" • {energy_line}\n")
+    dur = f"{b.dur_sum / b.dur_n:.3f}s в среднем" if b.dur_n else "—"
+    saved = f"{b.count - 1} уведомл. (~{b.saved_j:.1f} Дж на вашем устройстве)"
+    return (f"Сводка доставки (сообщений: {b.count}):\n"
+            f" • Размер: {fmt_size(b.bytes)} всего\n"
+            f" • Скорость: {human_speed(b.speed_bps())}\n"
+            f" • Длительность: {dur}\n"
+            f" • {energy_line}\n"
+            f" • Одной сводкой вместо {b.count}: сэкономлено {saved}\n")
+
+
+# один на процесс
+receipts = ReceiptBatcher()
@@ -0,0 +1,219 @@
+# relay.py
+"""
+Пересылка сообщений в модчат с «режимом всплеска».
+
+Обычный режим: заголовок + копия оригинала (копия отвечает на заголовок);
+кнопки решения висят прямо на копии — отдельного «Решение по сообщению» нет.
+
+Режим дайджеста включается сам, когда поток сообщений превышает порог
+(с гистерезисом, чтобы не дребезжать на границе):
+  - заголовок вклеивается в подпись копии (фото/видео/документ/аудио/гиф/голос)
+    или в текст (текстовые сообщения) — одно сообщение вместо двух-трёх;
+  - если вклеить нельзя (стикер, кружок, не влезает в лимит) — копия уходит
+    как есть, а заголовок копится и раз в RELAY_DIGEST_INTERVAL_S уходит
+    одной сводкой.
+"""
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+from telegram import MessageEntity, ReplyParameters
+
+import clock
+from config import (
+    MOD_GROUP_ID, RELAY_DIGEST_ON_PER_MIN, RELAY_DIGEST_OFF_PER_MIN,
+    RELAY_DIGEST_INTERVAL_S, RELAY_WINDOW_S,
+)
+
+CAPTION_LIMIT = 1024
+TEXT_LIMIT = 4096
+CAPTION_KINDS = ("photo", "video", "document", "audio", "animation", "voice")
+
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _shift_entities(entities, shift: int, bot=None) -> List[MessageEntity]:
+    """offset у сущностей — в UTF-16 единицах; сдвигаем на длину вклеенного заголовка."""
+    out = []
+    for e in entities or ():
+        d = e.to_dict()
+        d["offset"] = e.offset + shift
+        out.append(MessageEntity.de_json(d, bot))
+    return out
+
+
+def merge_header(header: str, body: str | None, entities, limit: int, bot=None) -> Tuple[str, list] | None:
+    """header + пустая строка + body; None, если не влезает в лимит."""
+    body = body or ""
+    prefix = header + ("\n\n" if body else "")
+    text = prefix + body
+    if _utf16_len(text) > limit:   # лимиты Telegram — в UTF-16 единицах (эмодзи — две)
+        return None
+    return text, _shift_entities(entities, _utf16_len(prefix), bot)
+
+
+class ModRelay:
+    def __init__(self, on_per_min: float = RELAY_DIGEST_ON_PER_MIN, off_per_min: float = RELAY_DIGEST_OFF_PER_MIN,
+                 window_s: float = RELAY_WINDOW_S, interval_s: float = RELAY_DIGEST_INTERVAL_S):
+        self.on_per_min = float(on_per_min)
+        self.off_per_min = float(min(off_per_min, on_per_min))
+        self.window_s = float(window_s)
+        self.interval_s = float(interval_s)
+        self._times: deque = deque()
+        self.digest = False
+        self._buffer: List[str] = []
+        self._flush_due: float | None = None   # monotonic: к какому сроку запланирован флеш
+        # счётчики
+        self.relayed = 0
+        self.calls = 0
+        self.calls_saved = 0       # против старой схемы: заголовок + копия (+ сообщение с кнопками)
+        self.merged = 0
+        self.digests_sent = 0
+        self.switches = 0
+
+    # ---- темп ----
+    def rate_per_min(self, now: float | None = None) -> float:
+        now = clock.monotonic() if now is None else now
+        times = self._times
+        while times and times[0] <= now - self.window_s:
+            times.popleft()
+        return len(times) * 60.0 / self.window_s
+
+    def observe(self, now: float | None = None) -> bool:
+        """Учесть входящее сообщение; возвращает, включён ли режим дайджеста."""
+        now = clock.monotonic() if now is None else now
+        self._times.append(now)
+        rate = self.rate_per_min(now)
+        if not self.digest and rate >= self.on_per_min:
+            self.digest = True
+            self.switches += 1
+        elif self.digest and rate < self.off_per_min:
+            self.digest = False
+            self.switches += 1
+        return self.digest
+
+    # ---- пересылка ----
+    async def relay(self, bot, msg, header: str, keyboard=None) -> int | None:
+        """Переслать msg в модчат. Возвращает message_id сообщения с кнопками
+        (если keyboard задана) или копии; None — если ничего не ушло."""
+        digest = self.observe()
+        self.relayed += 1
+        baseline = 2 + (1 if keyboard is not None else 0)
+        calls = 0
+        mid = None
+        try:
+            if digest:
+                mid, calls = await self._relay_merged(bot, msg, header, keyboard)
+            if mid is None:
+                mid, c = await self._relay_plain(bot, msg, header, keyboard, with_header=not digest)
+                calls += c
+        finally:
+            self.calls += calls
+            self.calls_saved += max(0, baseline - calls)
+        return mid
+
+    async def _relay_merged(self, bot, msg, header: str, keyboard) -> Tuple[int | None, int]:
+        kind = next((k for k in CAPTION_KINDS if getattr(msg, k, None)), None)
+        try:
+            if kind is not None:
+                merged = merge_header(header, msg.caption, msg.caption_entities, CAPTION_LIMIT, bot)
+                if merged is None:
+                    return None, 0
+                text, ents = merged
+                sent = await bot.copy_message(chat_id=MOD_GROUP_ID, from_chat_id=msg.chat_id, message_id=msg.message_id,
+                                              caption=text, caption_entities=ents, reply_markup=keyboard)
+            elif getattr(msg, "text", None):
+                merged = merge_header(header, msg.text, msg.entities, TEXT_LIMIT, bot)
+                if merged is None:
+                    return None, 0
+                text, ents = merged
+                sent = await bot.send_message(chat_id=MOD_GROUP_ID, text=text, entities=ents, reply_markup=keyboard)
+            else:
+                return None, 0
+        except Exception:
+            return None, 1
+        self.merged += 1
+        return sent.message_id, 1
+
+    async def _relay_plain(self, bot, msg, header: str, keyboard, with_header: bool) -> Tuple[int | None, int]:
+        calls = 0
+        anchor = None
+        if with_header:
+            try:
+                calls += 1
+                head = await bot.send_message(chat_id=MOD_GROUP_ID, text=header)
+                anchor = head.message_id
+            except Exception:
+                pass
+        else:
+            self._buffer.append(header)
+        reply = ReplyParameters(anchor, allow_sending_without_reply=True) if anchor else None
+        try:
+            calls += 1
+            copied = await bot.copy_message(chat_id=MOD_GROUP_ID, from_chat_id=msg.chat_id, message_id=msg.message_id,
+                                            reply_parameters=reply, reply_markup=keyboard)
+            return copied.message_id, calls
+        except Exception:
+            pass
+        if keyboard is None:
+            return None, calls
+        # копия не ушла (тип не копируется и т.п.) — кнопки отдельным сообщением, как раньше
+        try:
+            calls += 1
+            sent = await bot.send_message(chat_id=MOD_GROUP_ID, text="Решение по сообщению:",
+                                          reply_markup=keyboard, reply_parameters=reply)
+            return sent.message_id, calls
+        except Exception:
+            return None, calls
+
+    # ---- дайджест ----
+    def add_to_digest(self, header: str):
+        self._buffer.append(header)
+
+    def want_flush_job(self) -> bool:
+        """True — в буфере что-то есть, а флеш ещё не запланирован (планирует вызывающий).
+        Флеш, не случившийся и через интервал после срока (задачу потеряли, например, при
+        перезапуске транспорта), считаем потерянным и планируем заново."""
+        if not self._buffer:
+            return False
+        now = clock.monotonic()
+        if self._flush_due is not None and now <= self._flush_due + self.interval_s:
+            return False
+        self._flush_due = now + self.interval_s
+        return True
+
+    async def flush(self, bot) -> int:
+        """Отправить накопленные заголовки одной-несколькими сводками."""
+        self._flush_due = None
+        items, self._buffer = self._buffer, []
+        if not items:
+            return 0
+        chunks, cur = [], f"Дайджест модчата: {len(items)} сообщ."
+        for h in items:
+            block = "\n\n" + h
+            if _utf16_len(cur) + _utf16_len(block) > TEXT_LIMIT:
+                chunks.append(cur)
+                cur = h
+            else:
+                cur += block
+        chunks.append(cur)
+        for text in chunks:
+            try:
+                self.calls += 1
+                await bot.send_message(chat_id=MOD_GROUP_ID, text=text)
+                self.digests_sent += 1
+            except Exception:
+                pass
+        # каждый заголовок в старой схеме — отдельный вызов
+        self.calls_saved += max(0, len(items) - len(chunks))
+        return len(items)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"digest": self.digest, "rate_per_min": self.rate_per_min(), "relayed": self.relayed,
+                "calls": self.calls, "calls_saved": self.calls_saved, "merged": self.merged,
+                "digests_sent": self.digests_sent, "buffered": len(self._buffer), "switches": self.switches}
+
+
+# один на процесс: темп считается по всем пользователям сразу
+mod_relay = ModRelay()
@@ -0,0 +1,140 @@
+# rollups.py
+"""
+Предагрегированный охват: на каждый день (UTC) — счётчик уникальных авторов
+за день и по часам суток (ReachCounter: точное множество, затем HLL).
+
+  - обновляется на каждой доставке (add), сырую историю не трогает;
+  - счётчики сливаемы: охват за N дней / по часам за N дней — объединение
+    N (или N*24) счётчиков, O(дней), независимо от числа сообщений;
+  - хранится ROLLUP_DAYS дней (месяцы), сырая история при этом режется как раньше.
+
+Копия для фоновой записи — copy-on-write по дням: copy() отдаёт те же объекты
+дней, а первая запись в такой день после копии сначала его клонирует. Обычно
+меняется только сегодняшний день, поэтому копия дешёвая.
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sketch import ReachCounter
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).date().isoformat()
+
+
+def _clone_day(d: Dict[str, Any]) -> Dict[str, Any]:
+    return {"all": d["all"].copy(), "h": {h: c.copy() for h, c in d["h"].items()}}
+
+
+class ReachRollups:
+    __slots__ = ("days", "_shared", "_version", "_cache")
+
+    def __init__(self):
+        self.days: Dict[str, Dict[str, Any]] = {}    # "YYYY-MM-DD" -> {"all": RC, "h": {час: RC}}
+        self._shared: set = set()                     # дни, отданные копии (менять только через клон)
+        self._version = 0
+        self._cache: Dict[tuple, Any] = {}
+
+    def __len__(self):
+        return len(self.days)
+
+    def _mutable_day(self, day: str) -> Dict[str, Any]:
+        d = self.days.get(day)
+        if d is None:
+            d = self.days[day] = {"all": ReachCounter(), "h": {}}
+        elif day in self._shared:
+            d = self.days[day] = _clone_day(d)
+        self._shared.discard(day)
+        return d
+
+    def add(self, user_id, ts: float) -> bool:
+        day = _day(ts)
+        cur = self.days.get(day)
+        uid = int(user_id)
+        hour = int(ts // 3600) % 24
+        # частый случай — пользователь уже учтён и в дне, и в часе: без клона и без сброса кэша
+        if cur is not None:
+            hc = cur["h"].get(hour)
+            if hc is not None and cur["all"].is_exact and hc.is_exact and uid in cur["all"] and uid in hc:
+                return False
+        d = self._mutable_day(day)
+        changed = d["all"].add(uid)
+        hc = d["h"].get(hour)
+        if hc is None:
+            hc = d["h"][hour] = ReachCounter()
+        changed = hc.add(uid) or changed
+        if changed:
+            self._version += 1
+            self._cache.clear()
+        return changed
+
+    def add_many(self, records: Iterable[Tuple[Any, float]]) -> int:
+        """(user_id, ts) пачкой — например, досев из горячей истории или архива."""
+        n = 0
+        for uid, ts in records:
+            self.add(uid, ts)
+            n += 1
+        return n
+
+    def prune(self, keep_days: int, now: float) -> int:
+        cutoff = _day(now - keep_days * 86400)
+        old = [d for d in self.days if d < cutoff]
+        for d in old:
+            del self.days[d]
+            self._shared.discard(d)
+        if old:
+            self._version += 1
+            self._cache.clear()
+        return len(old)
+
+    # ---- запросы: O(дней) ----
+    def _last_days(self, n: int | None) -> List[str]:
+        days = sorted(self.days, reverse=True)
+        return days if n is None else days[:n]
+
+    def per_day(self, n: int | None = None) -> List[Tuple[str, int]]:
+        """[(день, уникальных)] от свежих к старым."""
+        return [(d, len(self.days[d]["all"])) for d in self._last_days(n)]
+
+    def unique(self, n: int | None = None) -> int:
+        key = ("unique", n, self._version)
+        if key not in self._cache:
+            self._cache[key] = len(ReachCounter.union(self.days[d]["all"] for d in self._last_days(n)))
+        return self._cache[key]
+
+    def per_hour(self, n: int | None = None) -> List[Tuple[int, int]]:
+        """[(час, уникальных за последние n дней)] для часов, где кто-то был."""
+        key = ("hour", n, self._version)
+        if key not in self._cache:
+            hours: Dict[int, ReachCounter] = {}
+            for d in self._last_days(n):
+                for h, c in self.days[d]["h"].items():
+                    acc = hours.get(h)
+                    if acc is None:
+                        hours[h] = c.copy()
+                    else:
+                        acc.merge(c)
+            self._cache[key] = [(h, len(hours[h])) for h in sorted(hours)]
+        return self._cache[key]
+
+    # ---- копия / сериализация ----
+    def copy(self) -> "ReachRollups":
+        c = ReachRollups()
+        c.days = dict(self.days)
+        self._shared = set(self.days)
+        return c
+
+    def to_dense(self) -> Dict[str, Any]:
+        return {day: {"all": d["all"].to_dense(), "h": {str(h): c.to_dense() for h, c in d["h"].items()}}
+                for day, d in self.days.items()}
+
+    @classmethod
+    def from_dense(cls, data) -> "ReachRollups":
+        r = cls()
+        if not isinstance(data, dict):
+            return r
+        for day, d in data.items():
+            if isinstance(d, dict):
+                r.days[str(day)] = {"all": ReachCounter.from_dense(d.get("all")),
+                                    "h": {int(h): ReachCounter.from_dense(c) for h, c in (d.get("h") or {}).items()}}
+        return r
@@ -0,0 +1,187 @@
+# sketch.py
+"""
+Подсчёт уникальных пользователей: точное множество до порога, дальше — HyperLogLog.
+
+ReachCounter.add() — O(1), без пересборки множеств; счётчики одного типа
+сливаются (merge) — например, охват по всем версиям отбивки.
+"""
+import base64
+import math
+from typing import Any, Dict, Iterable
+
+from config import REACH_EXACT_MAX, REACH_HLL_P
+
+_M64 = (1 << 64) - 1
+
+
+def _mix64(x: int) -> int:
+    """splitmix64: быстрый и хорошо перемешивающий хэш для целых id."""
+    x = (x + 0x9E3779B97F4A7C15) & _M64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _M64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog:
+    __slots__ = ("p", "reg")
+
+    def __init__(self, p: int = REACH_HLL_P):
+        self.p = int(p)
+        self.reg = bytearray(1 << self.p)
+
+    def add(self, x: int) -> bool:
+        """Возвращает True, если регистр изменился (оценка могла вырасти)."""
+        p = self.p
+        h = _mix64(int(x) & _M64)
+        idx = h >> (64 - p)
+        rest = h & ((1 << (64 - p)) - 1)
+        rank = (64 - p) - rest.bit_length() + 1
+        if rank > self.reg[idx]:
+            self.reg[idx] = rank
+            return True
+        return False
+
+    def count(self) -> int:
+        m = len(self.reg)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.reg)
+        zeros = self.reg.count(0)
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)
+        return int(round(est))
+
+    def fold(self, p: int) -> "HyperLogLog":
+        """Тот же скетч с меньшей точностью p (стандартное сжатие HLL): младшие биты
+        старого индекса становятся старшими битами остатка, по ним пересчитываем ранг."""
+        if p >= self.p:
+            return self.copy()
+        d = self.p - p
+        out = HyperLogLog(p)
+        low_mask = (1 << d) - 1
+        reg = out.reg
+        for idx, r in enumerate(self.reg):
+            if not r:
+                continue
+            low = idx & low_mask
+            rank = d - low.bit_length() + 1 if low else d + r
+            j = idx >> d
+            if rank > reg[j]:
+                reg[j] = rank
+        return out
+
+    def merge(self, other: "HyperLogLog"):
+        """Слияние на месте; при разных p (REACH_HLL_P меняли между запусками) —
+        к меньшей из точностей."""
+        if other.p > self.p:
+            other = other.fold(self.p)
+        elif other.p < self.p:
+            folded = self.fold(other.p)
+            self.p, self.reg = folded.p, folded.reg
+        a, b = self.reg, other.reg
+        for i, r in enumerate(b):
+            if r > a[i]:
+                a[i] = r
+
+    def copy(self) -> "HyperLogLog":
+        h = HyperLogLog(self.p)
+        h.reg[:] = self.reg
+        return h
+
+
+class ReachCounter:
+    """Уникальные id: set до REACH_EXACT_MAX, затем HyperLogLog."""
+    __slots__ = ("exact", "hll")
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.exact: set | None = set()
+        self.hll: HyperLogLog | None = None
+        for x in ids:
+            self.add(x)
+
+    @property
+    def is_exact(self) -> bool:
+        return self.hll is None
+
+    def add(self, x: int) -> bool:
+        """Возвращает True, если счётчик (потенциально) вырос."""
+        x = int(x)
+        if self.hll is not None:
+            return self.hll.add(x)
+        if x in self.exact:
+            return False
+        self.exact.add(x)
+        if len(self.exact) > REACH_EXACT_MAX:
+            self._promote()
+        return True
+
+    def _promote(self):
+        hll = HyperLogLog()
+        for x in self.exact:
+            hll.add(x)
+        self.hll, self.exact = hll, None
+
+    def count(self) -> int:
+        return len(self.exact) if self.hll is None else self.hll.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, x) -> bool:
+        """Точный ответ только в exact-режиме; в HLL-режиме — False (неизвестно)."""
+        return self.exact is not None and int(x) in self.exact
+
+    def merge(self, other: "ReachCounter") -> "ReachCounter":
+        """Слияние на месте (self |= other)."""
+        if self.hll is None and other.hll is None:
+            self.exact |= other.exact
+            if len(self.exact) > REACH_EXACT_MAX:
+                self._promote()
+            return self
+        if self.hll is None:
+            self._promote()
+        if other.hll is None:
+            for x in other.exact:
+                self.hll.add(x)
+        else:
+            self.hll.merge(other.hll)
+        return self
+
+    def copy(self) -> "ReachCounter":
+        c = ReachCounter()
+        if self.hll is None:
+            c.exact = set(self.exact)
+        else:
+            c.exact, c.hll = None, self.hll.copy()
+        return c
+
+    @classmethod
+    def union(cls, counters: Iterable["ReachCounter"]) -> "ReachCounter":
+        out = cls()
+        for c in counters:
+            out.merge(c)
+        return out
+
+    # ---- сериализация ----
+    def to_dense(self) -> Dict[str, Any]:
+        if self.hll is None:
+            return {"ids": sorted(self.exact)}
+        return {"p": self.hll.p, "hll": base64.b64encode(bytes(self.hll.reg)).decode("ascii")}
+
+    @classmethod
+    def from_dense(cls, d) -> "ReachCounter":
+        """Понимает {"ids": [...]}, {"p", "hll"} и старый список reach_user_ids."""
+        if isinstance(d, list):
+            return cls(d)
+        c = cls()
+        if not isinstance(d, dict):
+            return c
+        if d.get("hll"):
+            hll = HyperLogLog(int(d.get("p") or REACH_HLL_P))
+            raw = base64.b64decode(d["hll"])
+            if len(raw) == len(hll.reg):
+                hll.reg[:] = raw
+                c.exact, c.hll = None, hll
+            return c
+        for x in d.get("ids") or ():
+            c.add(x)
+        return c
@@ -0,0 +1,265 @@
+# snapshot.py
+"""
+Секционный снапшот состояния.
+
+Раскладка на диске (рядом с STATE_FILE):
+  bot_state.snap           — маленький индекс: MAGIC + u32 длина + JSON
+                             {"gen", "dat", "sections": {имя: [offset, length, crc32]}}
+  bot_state.snap.<gen>.dat — append-only блобы секций (zlib от компактного JSON)
+
+Каждая секция кодируется независимо. Изменившаяся секция дописывается в конец
+.dat, индекс атомарно подменяется; неизменившиеся секции не сжимаются и не
+переписываются (crc сравнивается по несжатым байтам), а не загруженные из
+снапшота вообще не кодируются. Когда мусора в .dat
+становится больше, чем живых данных, пишем новый .dat (новый gen), копируя
+неизменившиеся блобы как есть. Чтение — через mmap, только нужных секций.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from typing import Dict, Iterable
+
+MAGIC = b"BSN1"
+COMPACT_SLACK = 1 << 20    # не компактим, пока мусора меньше 1 MB
+
+
+class SnapshotStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.dir = os.path.dirname(path) or "."
+        self.index: Dict = {"gen": 0, "dat": None, "sections": {}}
+        self._fh = None
+        self._mm = None
+        self._pending_delete = None
+        # чтение (ленивая подгрузка на event loop) и запись (фоновый поток) не должны
+        # пересекаться: запись может переоткрыть mmap и удалить старый .dat
+        self._lock = threading.RLock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _dat_path(self, name: str | None = None) -> str | None:
+        name = name or self.index.get("dat")
+        return os.path.join(self.dir, name) if name else None
+
+    # ---- чтение ----
+    def open(self):
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            head = f.read(8)
+            if len(head) != 8 or head[:4] != MAGIC:
+                raise ValueError("snapshot: неверный заголовок индекса")
+            (n,) = struct.unpack("<I", head[4:])
+            self.index = json.loads(f.read(n).decode("utf-8"))
+        self._remap()
+
+    def _close_map(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _remap(self):
+        self._close_map()
+        dat = self._dat_path()
+        if not dat or not os.path.exists(dat) or os.path.getsize(dat) == 0:
+            return
+        self._fh = open(dat, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def sections(self) -> Iterable[str]:
+        return self.index.get("sections", {}).keys()
+
+    def _raw(self, name: str) -> bytes | None:
+        ent = self.index.get("sections", {}).get(name)
+        if not ent:
+            return None
+        off, ln, _ = ent
+        if self._mm is None or off + ln > len(self._mm):
+            self._remap()   # .dat дописали после прошлого mmap
+        if self._mm is None:
+            return None
+        return self._mm[off:off + ln]
+
+    def read(self, name: str) -> bytes | None:
+        """Несжатые байты секции (или None, если секции нет/битая)."""
+        with self._lock:
+            blob = self._raw(name)   # срез mmap — это копия байтов
+            if blob is None:
+                return None
+            crc = self.index["sections"][name][2]
+        raw = zlib.decompress(blob)
+        if zlib.crc32(raw) != crc:
+            raise ValueError(f"snapshot: crc секции {name} не сходится")
+        return raw
+
+    # ---- запись ----
+    def write(self, blobs: Dict[str, bytes]) -> bool:
+        """blobs — несжатые байты загруженных секций. Секции, которых нет в blobs,
+        остаются как есть. Возвращает True, если что-то было записано."""
+        with self._lock:
+            return self._write(blobs)
+
+    def _write(self, blobs: Dict[str, bytes]) -> bool:
+        secs = self.index.setdefault("sections", {})
+        changed = {}
+        for name, raw in blobs.items():
+            crc = zlib.crc32(raw)
+            ent = secs.get(name)
+            if ent and ent[2] == crc:
+                continue
+            changed[name] = (zlib.compress(raw, 1), crc)
+        if not changed and self.index.get("dat"):
+            return False
+
+        dat = self._dat_path()
+        dat_size = os.path.getsize(dat) if dat and os.path.exists(dat) else 0
+        new_bytes = sum(len(c) for c, _ in changed.values())
+        live = sum(ln for n, (_, ln, _) in secs.items() if n not in changed) + new_bytes
+        garbage = dat_size + new_bytes - live
+        if not dat or not os.path.exists(dat) or garbage > live + COMPACT_SLACK:
+            self._compact(changed)
+        else:
+            with open(dat, "ab") as f:
+                off = f.tell()
+                for name, (comp, crc) in changed.items():
+                    f.write(comp)
+                    secs[name] = [off, len(comp), crc]
+                    off += len(comp)
+                f.flush()
+                os.fsync(f.fileno())
+        self._write_index()
+        return True
+
+    def _compact(self, changed: Dict[str, tuple]):
+        """Новый .dat: живые неизменённые блобы копируем сырыми, изменённые — новые."""
+        old_dat = self._dat_path()
+        gen = int(self.index.get("gen", 0)) + 1
+        name = f"{os.path.basename(self.path)}.{gen}.dat"
+        secs = self.index.get("sections", {})
+        new_secs = {}
+        with open(os.path.join(self.dir, name), "wb") as f:
+            for sec in list(secs) + [n for n in changed if n not in secs]:
+                if sec in changed:
+                    blob, crc = changed[sec]
+                else:
+                    blob, crc = self._raw(sec), secs[sec][2]
+                    if blob is None:
+                        continue
+                new_secs[sec] = [f.tell(), len(blob), crc]
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_map()
+        self.index = {"gen": gen, "dat": name, "sections": new_secs}
+        self._pending_delete = old_dat
+
+    def _write_index(self):
+        body = json.dumps(self.index, separators=(",", ":")).encode("utf-8")
+        fd, tmp = tempfile.mkstemp(dir=self.dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC + struct.pack("<I", len(body)) + body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except Exception:
+                    pass
+        old = self._pending_delete
+        if old and old != self._dat_path() and os.path.exists(old):
+            try:
+                os.remove(old)
+            except Exception:
+                pass
+        self._pending_delete = None
+
+
+class SnapshotState(dict):
+    """dict состояния, где часть ключей ещё не прочитана из снапшота.
+    Первый доступ к такому ключу (s[k], get, setdefault, pop) подгружает его;
+    `in` отвечает без подгрузки."""
+
+    def __init__(self, data: Dict, lazy: Dict[str, str], loader):
+        super().__init__(data)
+        self._lazy = dict(lazy)      # key -> section
+        self._loader = loader        # (key, section) -> value
+
+    def is_loaded(self, key) -> bool:
+        return key not in self._lazy
+
+    def lazy_keys(self):
+        return list(self._lazy)
+
+    def _load(self, key):
+        sec = self._lazy.pop(key)
+        value = self._loader(key, sec)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        if key in self._lazy:
+            return self._load(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._lazy:
+            return self._load(key)
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        if key in self._lazy:
+            return self._load(key)
+        return dict.setdefault(self, key, default)
+
+    def __contains__(self, key):
+        return key in self._lazy or dict.__contains__(self, key)
+
+    def __setitem__(self, key, value):
+        self._lazy.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def pop(self, key, *default):
+        if key in self._lazy:
+            self._load(key)
+        return dict.pop(self, key, *default)
+
+    def materialize(self):
+        for key in list(self._lazy):
+            self._load(key)
+
+    # полный обход = всё подгружаем (например, для сохранения в JSON)
+    def keys(self):
+        self.materialize()
+        return dict.keys(self)
+
+    def items(self):
+        self.materialize()
+        return dict.items(self)
+
+    def values(self):
+        self.materialize()
+        return dict.values(self)
+
+    def __iter__(self):
+        self.materialize()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+
+    def loaded_items(self):
+        """Только уже загруженные пары — без подгрузки."""
+        return dict.items(self)
@@ -0,0 +1,328 @@
+# soak.py
+"""
+Soak-тест: неделя работы бота за секунды, на виртуальных часах (clock.VirtualClock).
+
+    python soak.py                       # 7 суток, ~1500 сообщений в сутки
+    python soak.py --days 3 --per-day 4000 --seed 2
+
+Гоняем настоящие обработчики (handle_private через KeyedUpdateProcessor, флеш
+альбомов, сводки, CHECK/UNCHECK, решения модераторов), планировщик из main.py
+(погода, ежедневные рассылки), prune и фоновую запись state — против фейкового
+Bot API (любой метод отвечает сразу) и фейкового провайдера погоды (суточная синусоида).
+
+Окна хранения сжаты (контент, охват, очередь модерации, почасовая погода — до
+1–2 суток), чтобы за неделю каждое успело провернуться несколько раз: рост,
+который не остановился после их оборота, — утечка, а не накопление окна.
+
+Раз в виртуальный час пишем: размер state (компактный JSON по ключам), RSS,
+число задач asyncio, стоимость полного сохранения (снимок + запись). После
+прогрева (--warmup-days) делим ряд на трети; если медиана растёт от трети к
+трети и последняя выше первой больше допуска — рост без предела, выход с кодом 1.
+Так же падаем, если доставки не дошли до замера скорости (см. latency.py).
+"""
+import os
+import sys
+import tempfile
+
+# окружение — до импорта config/state: временный каталог, все подсистемы включены, окна сжаты
+_TMP = tempfile.mkdtemp(prefix="soak-")
+os.environ.update({
+    "STATE_DIR": _TMP,
+    "ARCHIVE_DIR": os.path.join(_TMP, "archive"),
+    "BOT_TOKEN": "soak",
+    "MOD_GROUP_ID": "-1001",
+    "UNCHECK_CHANNEL_ID": "-1002",
+    "BROADCAST_CHANNEL_IDS": "-1002,-1003",
+    "ENABLE_WEATHER": "true",
+    "WEATHER_API_KEY": "soak",
+    "WEATHER_TICK_S": "300",
+    "DAILY_ENABLE": "true",
+    "CONTENT_TTL_S": "86400",
+    "DEDUP_TTL_S": "86400",
+    "MODQ_TTL_S": "86400",
+    "ROLLUP_DAYS": "2",
+    "RECEIPT_WINDOW_MAX_S": "20",
+})
+
+import argparse
+import asyncio
+import gc
+import logging
+import random
+import shutil
+import statistics
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram.error import Forbidden
+
+import clock
+import latency
+import state as state_mod
+import weather
+from state import load_state, save_state, flush_state, encoded_size
+from snapshot import SnapshotState
+from concurrency import KeyedUpdateProcessor
+from handlers import handle_private
+from moderation import apply_decisions
+from broadcast import broadcaster, cmd_subscribe
+from main import MiniJobQueue, schedule_jobs
+
+DAY = 86400.0
+SAMPLE_S = 3600.0
+STEP_S = 300.0              # шаг виртуального времени между передышками для потоков
+TOLERANCE = 0.15            # допуск роста последней трети над первой
+SLACK = {"state_bytes": 64 * 1024, "rss_bytes": 24 * 1024 * 1024, "tasks": 20, "save_ms": 25.0}
+
+
+# ========= фейки =========
+class FakeBot:
+    """Bot API без сети: любой метод успешен и сразу отвечает новым message_id; вызовы считаем."""
+
+    def __init__(self, blocked: set):
+        self.calls = Counter()
+        self.blocked = blocked
+        self._mid = 0
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def call(*args, **kw):
+            self.calls[name] += 1
+            if name == "send_message" and kw.get("chat_id") in self.blocked:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            self._mid += 1
+            return SimpleNamespace(message_id=self._mid, chat_id=kw.get("chat_id"))
+        return call
+
+
+def fake_weather(loc=None):
+    """Суточная синусоида 5..25 °C с шумом — пересекает пороги алёртов дважды в сутки."""
+    import math
+    t = clock.time()
+    phase = (t % DAY) / DAY * 2 * math.pi
+    return {"temp_c": 15 + 10 * math.sin(phase) + random.uniform(-0.5, 0.5),
+            "humidity": 60 + 20 * math.cos(phase), "pressure_mb": 1013.0}
+
+
+# ========= трафик =========
+WORDS = ("привет канал вопрос район сегодня купчино метро погода продам куплю отдам "
+         "кот собака ремонт шум соседи двор парковка магазин скидка концерт").split()
+SPAM = [" ".join(random.Random(i).choices(WORDS, k=12)) for i in range(5)]
+
+
+class Traffic:
+    def __init__(self, app, state, processor, per_day: float, users: int, rnd: random.Random):
+        self.app, self.state, self.processor = app, state, processor
+        self.rate = per_day / DAY
+        self.users = users
+        self.rnd = rnd
+        self.mid = 0
+        self.fid = 0
+        self.sent = 0
+        self.tasks = set()
+
+    def _user(self):
+        # активность по Ципфу: немного активных, длинный хвост
+        uid = 10_000 + int(self.users * self.rnd.random() ** 3)
+        return SimpleNamespace(id=uid, username=f"u{uid}", full_name=f"User {uid}")
+
+    def _message(self, user, kind: str, mgid=None):
+        self.mid += 1
+        rnd = self.rnd
+        sent = clock.time() - rnd.uniform(0.0, 3.0)          # сеть Telegram -> бот
+        m = SimpleNamespace(
+            message_id=self.mid, chat_id=user.id, from_user=user,
+            date=datetime.fromtimestamp(int(sent), timezone.utc),
+            text=None, caption=None, entities=None, caption_entities=None,
+            photo=None, video=None, document=None, audio=None, animation=None, voice=None, sticker=None,
+            media_group_id=mgid)
+        if kind == "text":
+            m.text = rnd.choice(SPAM) if rnd.random() < 0.1 else " ".join(rnd.choices(WORDS, k=rnd.randint(3, 30)))
+        else:
+            self.fid += 1
+            m.photo = [SimpleNamespace(file_id=f"F{self.fid}", file_unique_id=f"U{self.fid}",
+                                       file_size=rnd.randint(30_000, 3_000_000))]
+            m.caption = rnd.choice(WORDS) if rnd.random() < 0.3 else None
+
+        async def reply_text(*a, **kw):
+            self.app.bot.calls["reply_text"] += 1
+        m.reply_text = reply_text
+        return m
+
+    def _deliver(self, user, m):
+        upd = SimpleNamespace(effective_message=m, message=m, effective_user=user,
+                              effective_chat=SimpleNamespace(id=user.id, type="private"))
+        ctx = SimpleNamespace(application=self.app, bot=self.app.bot, job_queue=None, args=[])
+        coro = handle_private(upd, ctx, self.state)
+        t = asyncio.create_task(self.processor.process_update(upd, coro))
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+        self.sent += 1
+        return upd, ctx
+
+    async def run(self):
+        rnd = self.rnd
+        while True:
+            # суточный ритм: ночью втрое тише
+            hour = (clock.time() % DAY) / 3600
+            rate = self.rate * (0.5 if hour < 7 else 1.25)
+            await clock.sleep(rnd.expovariate(rate))
+            user = self._user()
+            r = rnd.random()
+            if r < 0.05:
+                mgid = f"mg{self.mid}"
+                for _ in range(rnd.randint(2, 4)):
+                    self._deliver(user, self._message(user, "photo", mgid))
+            else:
+                upd, ctx = self._deliver(user, self._message(user, "text" if r < 0.8 else "photo"))
+                if rnd.random() < 0.02:   # подписка на рассылку
+                    await cmd_subscribe(upd, ctx, self.state)
+
+
+async def moderator(app, state, rnd: random.Random):
+    """CHECK через день; модератор раз в полчаса разбирает часть очереди, остальное истечёт."""
+    while True:
+        await clock.sleep(1800)
+        state["mode"] = "CHECK" if int(clock.monotonic() // DAY) % 2 else "UNCHECK"
+        entries = state["pending"].take_next(rnd.randint(0, 15))
+        if entries:
+            save_state(state, "pending")
+            await apply_decisions(app.bot, entries, rnd.random() < 0.7)
+
+
+# ========= замеры =========
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sample(state, hour: int) -> dict:
+    items = state.loaded_items() if isinstance(state, SnapshotState) else state.items()
+    keys = {}
+    for k, v in list(items):
+        try:
+            keys[k] = encoded_size(k, v)
+        except Exception:
+            pass
+    t0 = time.perf_counter()
+    save_state(state)
+    flush_state(timeout=60)
+    save_ms = (time.perf_counter() - t0) * 1000
+    gc.collect()
+    return {"hour": hour, "state_bytes": sum(keys.values()), "keys": keys, "rss_bytes": rss_bytes(),
+            "tasks": len(asyncio.all_tasks()), "save_ms": save_ms}
+
+
+def unbounded(values, slack: float) -> tuple:
+    """(растёт?, медианы третей) — рост от трети к трети и последняя выше первой сверх допуска."""
+    n = len(values) // 3
+    if n < 2:
+        return False, ()
+    a, b, c = (statistics.median(values[i * n:(i + 1) * n]) for i in range(3))
+    return (b > a and c > b and c > a * (1 + TOLERANCE) + slack), (a, b, c)
+
+
+# ========= прогон =========
+async def soak(days: float, per_day: float, users: int, seed: int, warmup_days: float) -> int:
+    rnd = random.Random(seed)
+    random.seed(seed)
+    vc = clock.VirtualClock()
+    clock.set_clock(vc)
+    # почасовая погода — константа state.py, не env: сжимаем так же, как остальные окна
+    state_mod.WEATHER_HOURLY_MAX_DAYS = 2
+    weather._get_weather = fake_weather
+
+    state = load_state()
+    blocked = set()
+    bot = FakeBot(blocked)
+    scheduler = MiniJobQueue(None, logging.getLogger("soak"))
+    app = SimpleNamespace(bot=bot, bot_data={"state": state, "scheduler": scheduler}, create_task=asyncio.create_task)
+    scheduler.rebind(app)
+    broadcaster.bind(app, state)
+    broadcaster.interval = broadcaster.user_interval_s = broadcaster.chat_interval_s = 0.0   # темп — реальный, тут не нужен
+    schedule_jobs(scheduler, state)
+
+    processor = KeyedUpdateProcessor(64)
+    traffic = Traffic(app, state, processor, per_day, users, rnd)
+    # часть подписчиков заблокирует бота — рассылка должна их выписать
+    blocked.update(10_000 + i for i in range(0, users, 37))
+    bg = [asyncio.create_task(traffic.run()), asyncio.create_task(moderator(app, state, rnd))]
+
+    samples = []
+    t_real = time.perf_counter()
+    end = days * DAY
+    next_sample = SAMPLE_S
+    while vc.monotonic() < end:
+        await vc.advance(STEP_S)
+        await asyncio.sleep(0.001)   # потоки (погода, запись state) успевают отработать
+        if vc.monotonic() >= next_sample:
+            samples.append(sample(state, int(next_sample // 3600)))
+            next_sample += SAMPLE_S
+    for t in bg:
+        t.cancel()
+    await scheduler.drain(0, 5)
+    await broadcaster.stop(5)
+    await asyncio.gather(*traffic.tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - t_real
+
+    # ---- отчёт ----
+    print(f"soak: {days:g} сут. виртуально за {elapsed:.1f} с; сообщений {traffic.sent}, "
+          f"вызовов Bot API {sum(bot.calls.values())}, каталог {_TMP}")
+    print(f"{'сут':>4} {'state KB':>10} {'RSS MB':>8} {'задач':>6} {'save ms':>8}")
+    for s in samples[23::24] or samples[-1:]:
+        print(f"{s['hour'] / 24:4.0f} {s['state_bytes'] / 1024:10.1f} {s['rss_bytes'] / 2**20:8.1f} "
+              f"{s['tasks']:6d} {s['save_ms']:8.1f}")
+    bc = state["broadcast"]
+    print(f"рассылок {len(bc['done'])} (в очереди {len(bc['jobs'])}), подписчиков {len(bc['subscribers'])}, "
+          f"выписано заблокировавших {broadcaster.blocked}; в очереди модерации {len(state['pending'])}")
+
+    # задержки: msg.date и отметка приёма — с одних (виртуальных) часов, иначе все доставки
+    # «неправдоподобны» и пути скорости/истории/сводок прогоняются вхолостую
+    network = len(latency.stats.rings.get("network") or ())
+    print(f"доставок с замеренной сетью {network}, неправдоподобных {latency.stats.implausible}")
+
+    post = [s for s in samples if s["hour"] >= warmup_days * 24]
+    failed = []
+    if traffic.sent and (not network or latency.stats.implausible > network):
+        failed.append("latency")
+        print("ЗАДЕРЖКИ: большинство доставок отброшено как неправдоподобные — часы приёма и msg.date разошлись")
+    for metric, slack in SLACK.items():
+        grows, thirds = unbounded([s[metric] for s in post], slack)
+        if grows:
+            failed.append(metric)
+            print(f"РОСТ {metric}: медианы третей {', '.join(f'{x:.0f}' for x in thirds)}")
+    if "state_bytes" in failed and post:
+        first, last = post[0]["keys"], post[-1]["keys"]
+        top = sorted(last, key=lambda k: -(last[k] - first.get(k, 0)))[:5]
+        print("  больше всех выросли: " + ", ".join(f"{k} +{(last[k] - first.get(k, 0)) / 1024:.1f} KB" for k in top))
+    print("OK: рост ограничен" if not failed else f"FAIL: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Soak-тест на виртуальных часах")
+    ap.add_argument("--days", type=float, default=7)
+    ap.add_argument("--per-day", type=float, default=1500)
+    ap.add_argument("--users", type=int, default=3000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--warmup-days", type=float, default=2)
+    ap.add_argument("--keep", action="store_true", help="не удалять каталог state после прогона")
+    args = ap.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        return asyncio.run(soak(args.days, args.per_day, args.users, args.seed, args.warmup_days))
+    finally:
+        if not args.keep:
+            shutil.rmtree(_TMP, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
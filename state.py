@@ -2,43 +2,129 @@
 import json
 import os
 import tempfile
+from bisect import bisect_left
 from datetime import datetime, timezone, timedelta
 from typing import Any, Dict
 
+import clock
+from archive import HistoryArchive
+from dedup import DedupCache, TTLCache
+from config import CONTENT_TTL_S, CONTENT_MAX_KEYS, ROLLUP_DAYS, BROADCAST_JOB_TTL_S
+from history import HistoryStore
+from modqueue import ModerationQueue
+from rollups import ReachRollups
+from sketch import ReachCounter
+from snapshot import SnapshotState, SnapshotStore
+from statewriter import StateWriter
+
 # используемые константы — меняй при желании
 STATE_DIR = os.getenv("STATE_DIR", ".")
 STATE_FILE = os.getenv("STATE_FILE", os.path.join(STATE_DIR, "bot_state.json"))
+# snapshot — секционный снапшот (см. snapshot.py); json — прежний единый файл
+STATE_FORMAT = os.getenv("STATE_FORMAT", "snapshot").lower()
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", os.path.splitext(STATE_FILE)[0] + ".snap")
+# кодирование и запись — в фоновом потоке (false — синхронно, прямо в save_state)
+STATE_WRITE_ASYNC = os.getenv("STATE_WRITE_ASYNC", "true").lower() == "true"
+# долгий архив истории (archive.py): в state остаётся только горячее окно
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(STATE_DIR, "archive"))
+ARCHIVE_ENABLE = os.getenv("ARCHIVE_ENABLE", "true").lower() == "true"
 
-HISTORY_MAX_DAYS = 1            # хранить историю не старше N дней
+HISTORY_MAX_DAYS = 1            # хранить историю не старше N дней (дальше — только в архиве)
 HISTORY_MAX_PER_USER = 5     # максимум записей истории на одного user_id
 HOURLY_PRUNE_INTERVAL = 36    # секунды (1 час)
 WEEKLY_PRUNE_INTERVAL = 70  # 7 дней
 DICT_MAX_KEEP = 5000            # если нет timestamp — обрезаем до этого числа записей
+WEATHER_HISTORY_MAX_DAYS = 2    # сэмплы погоды: графику нужны только последние 24 часа
+WEATHER_HOURLY_MAX_DAYS = 30    # почасовые агрегаты погоды по районам
+BROADCAST_DONE_KEEP = 20        # отчётов о завершённых рассылках
 
 DEFAULT_STATE = {
     "mode": "UNCHECK",                    # CHECK / UNCHECK
     "control_message_id": None,           # закреп в модчате
-    "pending": {},                        # ожидание решения модерации
+    "pending": {},                        # ModerationQueue: ожидание решения модерации
     "counts": {},                         # счётчик сообщений на человека
     "media_groups": {},                   # буфер альбомов
-    "history": {},                        # история по user_id -> [entries]
+    "history": {},                        # история: HistoryStore (справочник + колонки по user_id)
     "stats": {},                          # агрегаты
-    "dedup_receipts": {},                 # чтобы сводку с энергией слать 1 раз на доставку
+    "reach_rollups": {},                  # ReachRollups: уникальные авторы по дням и часам (месяцами)
+    "dedup_receipts": {},                 # DedupCache: сводку с энергией шлём 1 раз на доставку
+    "content_index": {},                  # TTLCache: ключ контента -> кто и когда прислал впервые
     "bumper": {                           # конфиг «отбивки» (реклама/сообщение)
         "active": False,
         "text": "",
         "version": 0,
-        "reach_user_ids": [],            # уникальные увидевшие с момента активации
+        "reach": {},                      # версия -> ReachCounter (уникальные увидевшие)
+    },
+    "media_groups_forwarded": {},
+    "broadcast": {                        # рассылки (broadcast.py)
+        "subscribers": {},                # str(user_id) -> ts подписки
+        "jobs": {},                       # id -> рассылка в работе (курсор, счётчики), по порядку
+        "done": [],                       # отчёты о последних завершённых
     },
-    "media_groups_forwarded": {}
 }
 
+def _encode_bumper(b: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(b)
+    out["reach"] = {v: c.to_dense() for v, c in (b.get("reach") or {}).items()}
+    return out
+
+def _decode_bumper(b) -> Dict[str, Any]:
+    b = dict(b) if isinstance(b, dict) else {}
+    b.setdefault("active", False)
+    b.setdefault("text", "")
+    b.setdefault("version", 0)
+    reach = {str(v): ReachCounter.from_dense(c) for v, c in (b.get("reach") or {}).items()}
+    legacy = b.pop("reach_user_ids", None)
+    if legacy:
+        reach.setdefault(str(b["version"]), ReachCounter()).merge(ReachCounter.from_dense(legacy))
+    b["reach"] = reach
+    return b
+
+_archive: HistoryArchive | None = None
+
+def get_archive() -> HistoryArchive | None:
+    global _archive
+    if _archive is None and ARCHIVE_ENABLE:
+        _archive = HistoryArchive(ARCHIVE_DIR)
+    return _archive
+
+def _decode_history(d) -> HistoryStore:
+    arch = get_archive()
+    return HistoryStore.from_dense(d, sink=arch.append if arch is not None else None)
+
+# секции, которые в памяти живут объектами, а на диск уходят плотной формой:
+# имя -> (encode(obj) -> json-совместимое, decode(json) -> obj)
+SECTION_CODECS = {
+    "history": (lambda h: h.to_dense(), _decode_history),
+    "dedup_receipts": (lambda c: c.to_dense(), DedupCache.from_dense),
+    "content_index": (lambda c: c.to_dense(),
+                      lambda d: TTLCache.from_dense(d, ttl=CONTENT_TTL_S, max_keys=CONTENT_MAX_KEYS)),
+    "bumper": (_encode_bumper, _decode_bumper),
+    "pending": (lambda q: q.to_dense(), ModerationQueue.from_dense),
+    "reach_rollups": (lambda r: r.to_dense(), ReachRollups.from_dense),
+}
+
+# секции снапшота: имя секции -> ключ state; всё остальное (mode, control_message_id,
+# метки prune, daily, ...) — в секции "core", которая грузится всегда
+SNAPSHOT_SECTIONS = {
+    "counts": "counts",
+    "history": "history",
+    "pending": "pending",
+    "weather": "weather",
+    "bumper": "bumper",
+    "dedup": "dedup_receipts",
+    "content": "content_index",
+    "rollups": "reach_rollups",
+    "broadcast": "broadcast",
+}
+_SECTION_BY_KEY = {k: sec for sec, k in SNAPSHOT_SECTIONS.items()}
+
 # ---- utilities -------------------------------------------------------------
 def ensure_dir():
     os.makedirs(STATE_DIR, exist_ok=True)
 
 def _now_utc():
-    return datetime.now(timezone.utc)
+    return clock.now(timezone.utc)
 
 def _iso_to_dt(s: str):
     try:
@@ -49,79 +135,73 @@ def _iso_to_dt(s: str):
     except Exception:
         return None
 
+def _loaded(state: Dict[str, Any], key: str) -> bool:
+    """Секция уже в памяти? Не подгруженные из снапшота не трогаем (они не менялись)."""
+    return not isinstance(state, SnapshotState) or state.is_loaded(key)
+
 # ---- pruning helpers ------------------------------------------------------
 def _prune_history(state: Dict[str, Any]):
     """Обрезаем history: удаляем записи старше HISTORY_MAX_DAYS и лимитируем per-user."""
-    if "history" not in state or not isinstance(state["history"], dict):
+    if not _loaded(state, "history"):
         return
-    cutoff = _now_utc() - timedelta(days=HISTORY_MAX_DAYS)
-    new_hist = {}
-    for user_id, entries in state["history"].items():
-        if not isinstance(entries, list):
-            continue
-        pruned = []
-        for rec in entries:
-            # ожидаем, что запись может содержать поле 'ts' с iso-строкой
-            ts = None
-            if isinstance(rec, dict):
-                ts = rec.get("ts") or rec.get("timestamp") or rec.get("time")
-            # если есть ts — фильтруем по дате
-            if isinstance(ts, str):
-                dt = _iso_to_dt(ts)
-                if dt is None:
-                    # непонятный формат — сохраняем (чтобы не потерять данные)
-                    pruned.append(rec)
-                else:
-                    if dt >= cutoff:
-                        pruned.append(rec)
-                    # иначе — отбрасываем
-            else:
-                # нет ts — оставляем (нет возможности отсечь по времени)
-                pruned.append(rec)
-        # обрезаем по количеству (оставляем последние записи)
-        if len(pruned) > HISTORY_MAX_PER_USER:
-            pruned = pruned[-HISTORY_MAX_PER_USER:]
-        if pruned:
-            new_hist[user_id] = pruned
-    state["history"] = new_hist
+    hist = state.get("history")
+    if not isinstance(hist, HistoryStore):
+        return
+    cutoff = int((_now_utc() - timedelta(days=HISTORY_MAX_DAYS)).timestamp())
+    hist.prune(cutoff, HISTORY_MAX_PER_USER)
+
+def _record_ts(v):
+    """Числовой epoch-ts записи: dict с 'ts' или список dict-ов (берём последний)."""
+    if isinstance(v, list) and v:
+        v = v[-1]
+    if isinstance(v, dict):
+        ts = v.get("ts")
+        if isinstance(ts, (int, float)):
+            return ts
+    return None
 
 def _prune_dict_by_ts_or_size(d: Dict, keep_days: int):
     """
-    Для словарей вида id -> record пытаемся удалить записи старше keep_days,
-    если рекорды содержат 'ts'/'time'/'timestamp'. Если нет временных меток — обрезаем по size.
-    Возвращает новый словарь.
+    Для словарей вида id -> record удаляем записи старше keep_days по числовому 'ts'.
+    Записи без ts вытесняются в порядке вставки: остаются последние добавленные,
+    пока общее число не превысит DICT_MAX_KEEP.
+    Возвращает новый словарь (порядок вставки сохраняется).
     """
     if not isinstance(d, dict):
         return {}
-    cutoff = _now_utc() - timedelta(days=keep_days)
-    kept = {}
-    # если значения — не dict/str с ts, соберём пары (k, approx_ts) для сортировки
-    fallback_items = []
+    cutoff = (_now_utc() - timedelta(days=keep_days)).timestamp()
+    keep_ts = {}
+    no_ts = []
     for k, v in d.items():
-        ts = None
-        if isinstance(v, dict):
-            ts = v.get("ts") or v.get("timestamp") or v.get("time")
-        if isinstance(ts, str):
-            dt = _iso_to_dt(ts)
-            if dt is not None and dt >= cutoff:
-                kept[k] = v
-        else:
-            # нет ts — отложим на случай, если окажется мало данных с ts
-            fallback_items.append((k, v))
-    # если мало kept и много fallback — обрежем fallback по количеству
-    if len(kept) < DICT_MAX_KEEP and fallback_items:
-        # добавим последние (по неопределённому порядку) до лимита
-        to_add = DICT_MAX_KEEP - len(kept)
-        for k, v in fallback_items[:to_add]:
-            kept[k] = v
-    return kept
-
-def _truncate_list_if_needed(lst: list, max_items: int):
-    if not isinstance(lst, list):
-        return lst
-    if len(lst) > max_items:
-        return lst[-max_items:]
-    return lst
+        ts = _record_ts(v)
+        if ts is None:
+            no_ts.append(k)
+        elif ts >= cutoff:
+            keep_ts[k] = True
+    room = max(0, DICT_MAX_KEEP - len(keep_ts))
+    keep_no_ts = set(no_ts[max(0, len(no_ts) - room):]) if room else set()
+    return {k: v for k, v in d.items() if k in keep_ts or k in keep_no_ts}
+
+def _prune_sorted_by_ts(hist, cutoff: float):
+    if not isinstance(hist, list) or not hist:
+        return
+    i = bisect_left(hist, cutoff, key=lambda r: r.get("ts", 0))
+    if i:
+        del hist[:i]
+
+def _prune_weather_history(state: Dict[str, Any]):
+    """history/hourly районов упорядочены по ts — отрезаем просроченный префикс через bisect."""
+    if not _loaded(state, "weather"):
+        return
+    w = state.get("weather") or {}
+    now = _now_utc()
+    raw_cutoff = (now - timedelta(days=WEATHER_HISTORY_MAX_DAYS)).timestamp()
+    hourly_cutoff = (now - timedelta(days=WEATHER_HOURLY_MAX_DAYS)).timestamp()
+    _prune_sorted_by_ts(w.get("history"), raw_cutoff)   # старый формат с одним районом
+    for lw in (w.get("locations") or {}).values():
+        if isinstance(lw, dict):
+            _prune_sorted_by_ts(lw.get("history"), raw_cutoff)
+            _prune_sorted_by_ts(lw.get("hourly"), hourly_cutoff)
 
 # ---- top-level prune orchestrator -----------------------------------------
 def _hourly_prune(state: Dict[str, Any]):
@@ -140,59 +220,309 @@ def _hourly_prune(state: Dict[str, Any]):
     except Exception:
         pass
 
+    # 3) dedup_receipts / content_index: снимаем просроченные ключи (только префикс)
+    try:
+        if _loaded(state, "dedup_receipts") and isinstance(state.get("dedup_receipts"), DedupCache):
+            state["dedup_receipts"].prune()
+    except Exception:
+        pass
+
+    try:
+        if _loaded(state, "content_index") and isinstance(state.get("content_index"), TTLCache):
+            state["content_index"].prune()
+    except Exception:
+        pass
+
+    # 4) pending: просроченные заявки снимает moderation.expire_job — им нужны вызовы API
+    #    (снять кнопки, сообщить авторам), а prune синхронный
+
+    # 5) weather: сэмплы районов старше WEATHER_HISTORY_MAX_DAYS, почасовые — WEATHER_HOURLY_MAX_DAYS
+    try:
+        _prune_weather_history(state)
+    except Exception:
+        pass
+
+    # 6) reach_rollups: дни старше ROLLUP_DAYS
+    try:
+        if _loaded(state, "reach_rollups") and isinstance(state.get("reach_rollups"), ReachRollups):
+            state["reach_rollups"].prune(ROLLUP_DAYS, _now_utc().timestamp())
+    except Exception:
+        pass
+
+    # 7) broadcast: зависшие рассылки старше BROADCAST_JOB_TTL_S, хвост отчётов
+    try:
+        if _loaded(state, "broadcast") and isinstance(state.get("broadcast"), dict):
+            b = state["broadcast"]
+            cutoff = _now_utc().timestamp() - BROADCAST_JOB_TTL_S
+            b["jobs"] = {k: j for k, j in (b.get("jobs") or {}).items() if (j.get("created") or 0) >= cutoff}
+            b["done"] = (b.get("done") or [])[-BROADCAST_DONE_KEEP:]
+    except Exception:
+        pass
+
 def _weekly_prune(state: Dict[str, Any]):
     """Глубокая очистка, раз в 7 дней."""
     try:
         # history уже поддерживается hourly; дополнительно — убеждаемся в общем лимите по пользователям
-        if isinstance(state.get("history"), dict):
+        if _loaded(state, "history") and isinstance(state.get("history"), HistoryStore):
             # если пользователей слишком много — оставим только самых активных по количеству записей
             hist = state["history"]
             if len(hist) > DICT_MAX_KEEP:
                 # сортируем по длине записей и оставляем топ DICT_MAX_KEEP
-                items = sorted(hist.items(), key=lambda kv: len(kv[1]) if isinstance(kv[1], list) else 0)
+                items = sorted(hist.items(), key=lambda kv: len(kv[1]))
                 # keep last DICT_MAX_KEEP (самые большие)
-                keep = dict(items[-DICT_MAX_KEEP:])
-                state["history"] = keep
+                hist.keep_users(uid for uid, _ in items[-DICT_MAX_KEEP:])
     except Exception:
         pass
 
     # prune big-ish dict-like structures with 7-day window
-    try:
-        state["dedup_receipts"] = _prune_dict_by_ts_or_size(state.get("dedup_receipts", {}), keep_days=HISTORY_MAX_DAYS)
-    except Exception:
-        pass
     try:
         state["media_groups_forwarded"] = _prune_dict_by_ts_or_size(state.get("media_groups_forwarded", {}), keep_days=HISTORY_MAX_DAYS)
     except Exception:
         pass
 
-    # bumper.reach_user_ids: если очень длинный — обрежем до разумного
-    try:
-        if isinstance(state.get("bumper", {}).get("reach_user_ids"), list):
-            state["bumper"]["reach_user_ids"] = _truncate_list_if_needed(state["bumper"]["reach_user_ids"], max_items=DICT_MAX_KEEP)
-    except Exception:
-        pass
-
 # ---- load/save with atomic write ------------------------------------------
-def load_state() -> Dict[str, Any]:
+def _decode_key(k: str, v):
+    if k in SECTION_CODECS:
+        try:
+            return SECTION_CODECS[k][1](v)
+        except Exception:
+            return SECTION_CODECS[k][1](DEFAULT_STATE.get(k))
+    return v
+
+def _default_value(k: str):
+    # возвращаем копию, чтобы изменения в DEFAULT_STATE не ломали структуру
+    v = DEFAULT_STATE.get(k)
+    v = _structural_copy(v) if isinstance(v, dict) else (v[:] if isinstance(v, list) else v)
+    return _decode_key(k, v)
+
+def _default_state() -> Dict[str, Any]:
+    return {k: _default_value(k) for k in DEFAULT_STATE}
+
+def _decode_sections(d: Dict[str, Any]) -> Dict[str, Any]:
+    for k in SECTION_CODECS:
+        d[k] = _decode_key(k, d.get(k))
+    return d
+
+def _encode_sections(s: Dict[str, Any]) -> Dict[str, Any]:
+    """Поверхностная копия state, где объектные секции заменены плотной формой."""
+    out = dict(s)
+    for k, (encode, _) in SECTION_CODECS.items():
+        if k in out:
+            out[k] = encode(out[k])
+    return out
+
+def _migrate_iso_fields(d: Dict[str, Any]):
+    """Старые ISO-строки времени -> числовой epoch 'ts' (один раз при загрузке)."""
+    def to_epoch(v):
+        if isinstance(v, (int, float)):
+            return v
+        dt = _iso_to_dt(v) if isinstance(v, str) else None
+        return dt.timestamp() if dt else None
+
+    for items in (d.get("media_groups") or {}).values():
+        for it in items if isinstance(items, list) else ():
+            if isinstance(it, dict) and "date" in it:
+                it["ts"] = to_epoch(it.pop("date"))
+    w = d.get("weather")
+    if isinstance(w, dict) and isinstance(w.get("history"), list):
+        hist = []
+        for rec in w["history"]:
+            if isinstance(rec, dict):
+                ts = to_epoch(rec.get("ts"))
+                if ts is not None:
+                    rec["ts"] = ts
+                    hist.append(rec)
+        hist.sort(key=lambda r: r["ts"])
+        w["history"] = hist
+
+_snapshot_store: SnapshotStore | None = None
+
+def _get_store() -> SnapshotStore:
+    global _snapshot_store
+    if _snapshot_store is None or _snapshot_store.path != SNAPSHOT_FILE:
+        _snapshot_store = SnapshotStore(SNAPSHOT_FILE)
+    return _snapshot_store
+
+def _load_snapshot(sections) -> Dict[str, Any]:
+    store = _get_store()
+    store.open()
+    core = json.loads(store.read("core") or b"{}")
+    available = set(store.sections())
+
+    def loader(key, sec):
+        try:
+            raw = store.read(sec)
+        except Exception:
+            raw = None
+        if raw is None:
+            return _default_value(key)
+        return _decode_key(key, json.loads(raw).get(key))
+
+    lazy = {}
+    for sec, key in SNAPSHOT_SECTIONS.items():
+        if sec not in available:
+            if key in DEFAULT_STATE:
+                core[key] = _default_value(key)
+        elif sections is not None and sec in sections:
+            core[key] = loader(key, sec)
+        else:
+            lazy[key] = sec
+    for k in DEFAULT_STATE:
+        if k not in core and k not in lazy:
+            core[k] = _default_value(k)
+    return SnapshotState(core, lazy, loader)
+
+def _encode_section(data: Dict[str, Any]) -> bytes:
+    out = {k: (SECTION_CODECS[k][0](v) if k in SECTION_CODECS else v) for k, v in data.items()}
+    return json.dumps(out, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def load_state(sections=None) -> Dict[str, Any]:
+    """sections — какие секции снапшота прочитать сразу (см. SNAPSHOT_SECTIONS);
+    остальные подгрузятся при первом обращении. None — только core.
+    Если снапшота нет (или STATE_FORMAT=json) — читаем прежний JSON (STATE_FILE)."""
     ensure_dir()
+    if STATE_FORMAT != "json" and os.path.exists(SNAPSHOT_FILE):
+        try:
+            return _load_snapshot(sections)
+        except Exception:
+            pass  # битый снапшот — пробуем JSON
     if not os.path.exists(STATE_FILE):
-        # возвращаем копию, чтобы изменения в DEFAULT_STATE не ломали структуру
-        return {k: (v.copy() if isinstance(v, dict) else (v[:] if isinstance(v, list) else v)) for k, v in DEFAULT_STATE.items()}
+        return _default_state()
     try:
         with open(STATE_FILE, "r", encoding="utf-8") as f:
             d = json.load(f)
     except Exception:
         # если файл битый — возвращаем дефолт (без ошибок)
-        return {k: (v.copy() if isinstance(v, dict) else (v[:] if isinstance(v, list) else v)) for k, v in DEFAULT_STATE.items()}
+        return _default_state()
     # минимальная миграция — ensure keys
     for k, v in DEFAULT_STATE.items():
         d.setdefault(k, v)
-    return d
+    try:
+        _migrate_iso_fields(d)
+    except Exception:
+        pass
+    h = d.get("history")
+    legacy = isinstance(h, dict) and bool(h) and "logs" not in h
+    s = _decode_sections(d)
+    if legacy:
+        # мигрированная история уже ушла в архив — сразу пишем её плотной, чтобы не архивировать повторно
+        save_state(s, "history")
+    return s
+
+# ---- copy-on-write снимок + фоновая запись ---------------------------------
+def _structural_copy(v):
+    """dict копируем рекурсивно, list — поверхностно: элементы списков в state
+    после добавления не мутируются (сэмплы погоды, элементы альбомов, id сообщений)."""
+    if isinstance(v, dict):
+        return {k: _structural_copy(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return list(v)
+    return v
+
+def _copy_bumper(b: Dict[str, Any]) -> Dict[str, Any]:
+    out = _structural_copy({k: v for k, v in b.items() if k != "reach"})
+    out["reach"] = {v: c.copy() for v, c in (b.get("reach") or {}).items()}
+    return out
+
+# объектные секции умеют дёшево копировать себя (memcpy колонок, копия OrderedDict, ...)
+SECTION_COPIERS = {
+    "history": lambda h: h.copy(),
+    "dedup_receipts": lambda c: c.copy(),
+    "content_index": lambda c: c.copy(),
+    "pending": lambda q: q.copy(),
+    "reach_rollups": lambda r: r.copy(),
+    "bumper": _copy_bumper,
+}
+
+def _snapshot_sections(s: Dict[str, Any], keys=None) -> Dict[str, Dict[str, Any]]:
+    """{секция: {ключ: копия}} для секций, где менялись keys (None — все загруженные)."""
+    want = None if keys is None else {_SECTION_BY_KEY.get(k, "core") for k in keys}
+    items = s.loaded_items() if isinstance(s, SnapshotState) else s.items()
+    out: Dict[str, Dict[str, Any]] = {}
+    for k, v in list(items):
+        sec = _SECTION_BY_KEY.get(k, "core")
+        if want is not None and sec not in want:
+            continue
+        out.setdefault(sec, {})[k] = SECTION_COPIERS[k](v) if k in SECTION_COPIERS else _structural_copy(v)
+    return out
+
+def _write_json(data: Dict[str, Any]):
+    # атомарная запись
+    dirpath = os.path.dirname(STATE_FILE) or "."
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmpf:
+            json.dump(_encode_sections(data), tmpf, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, STATE_FILE)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+
+def _write_sections(batch: Dict[str, Dict[str, Any]]):
+    """Выполняется в фоновом потоке: кодируем копии и пишем."""
+    if STATE_FORMAT == "json":
+        merged = {}
+        for data in batch.values():
+            merged.update(data)
+        _write_json(merged)
+    else:
+        _get_store().write({sec: _encode_section(data) for sec, data in batch.items()})
+    # накопленные записи истории — в дневные файлы архива, тем же потоком
+    arch = _archive
+    if arch is not None and arch.pending():
+        try:
+            arch.flush()
+        except Exception:
+            pass
+
+_writer: StateWriter | None = None
+
+def _get_writer() -> StateWriter:
+    global _writer
+    if _writer is None:
+        _writer = StateWriter(_write_sections)
+    return _writer
+
+def flush_state(timeout: float | None = None) -> bool:
+    """Дождаться, пока всё отданное на запись окажется на диске."""
+    return _writer.flush(timeout) if _writer is not None else True
+
+def writer_stats() -> Dict[str, Any]:
+    w = _writer
+    return {"writes": w.writes, "last_write_s": w.last_write_s} if w else {"writes": 0, "last_write_s": 0.0}
+
+# ---- для отчёта /state_stats (statestats.py) --------------------------------
+def copy_value(key: str, value: Any) -> Any:
+    """Копия значения ключа state — такая же, какую получает фоновая запись."""
+    return SECTION_COPIERS[key](value) if key in SECTION_COPIERS else _structural_copy(value)
+
+def encoded_size(key: str, value: Any) -> int:
+    """Размер ключа в сериализованном виде (компактный JSON, байты)."""
+    v = SECTION_CODECS[key][0](value) if key in SECTION_CODECS else value
+    return len(json.dumps(v, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
 
-def save_state(s: Dict[str, Any]) -> None:
+def section_of(key: str) -> str:
+    return _SECTION_BY_KEY.get(key, "core")
+
+def disk_sizes() -> Dict[str, int]:
+    """Секция снапшота -> байты на диске (сжатые); для json — {"json": размер файла}."""
+    if STATE_FORMAT == "json" or not _get_store().exists():
+        return {"json": os.path.getsize(STATE_FILE)} if os.path.exists(STATE_FILE) else {}
+    store = _get_store()
+    if not store.index.get("sections"):
+        store.open()
+    return {sec: ent[1] for sec, ent in list(store.index.get("sections", {}).items())}
+
+def save_state(s: Dict[str, Any], *keys: str) -> None:
+    """keys — какие ключи state менялись (подсказка: копируем только их секции).
+    Без keys, а также когда сработал prune, снимаем все загруженные секции."""
     ensure_dir()
     now_ts = int(_now_utc().timestamp())
+    full = not keys
     # hourly prune if needed
     last_hourly = s.get("_last_prune_hourly", 0)
     if now_ts - int(last_hourly) >= HOURLY_PRUNE_INTERVAL:
@@ -201,6 +531,7 @@ def save_state(s: Dict[str, Any]) -> None:
         except Exception:
             pass
         s["_last_prune_hourly"] = now_ts
+        full = True
 
     # weekly prune if needed
     last_weekly = s.get("_last_prune_weekly", 0)
@@ -210,18 +541,14 @@ def save_state(s: Dict[str, Any]) -> None:
         except Exception:
             pass
         s["_last_prune_weekly"] = now_ts
+        full = True
 
-    # атомарная запись
-    dirpath = os.path.dirname(STATE_FILE) or "."
-    os.makedirs(dirpath, exist_ok=True)
-    fd, tmp_path = tempfile.mkstemp(dir=dirpath)
-    try:
-        with os.fdopen(fd, "w", encoding="utf-8") as tmpf:
-            json.dump(s, tmpf, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, STATE_FILE)
-    finally:
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+    if STATE_FORMAT == "json":
+        if isinstance(s, SnapshotState):
+            s.materialize()
+        full = True   # единый файл — нужен весь state
+    sections = _snapshot_sections(s, None if full else keys)
+    if STATE_WRITE_ASYNC:
+        _get_writer().submit(sections)
+    else:
+        _write_sections(sections)
@@ -0,0 +1,215 @@
+# statestats.py
+"""
+Отчёт /state_stats: кто раздувает state.
+
+По каждому ключу верхнего уровня (history, weather, dedup_receipts, pending, bumper,
+media_groups_forwarded, ...):
+  - число записей (строк истории, ключей, элементов);
+  - размер в сериализованном виде (компактный JSON) и на диске (секция снапшота, сжато);
+  - оценка памяти (рекурсивный sys.getsizeof, с учётом __slots__ и array);
+  - рост с прошлого отчёта (записи и байты в час) — прошлый отчёт лежит в state["state_stats"].
+
+Копии секций снимаются на event loop (так же дёшево, как для фоновой записи),
+а сериализация и обход — в потоке.
+
+/state_stats trace — tracemalloc: первый вызов включает трассировку, следующие
+показывают прирост аллокаций с прошлого снимка, сгруппированный по строкам
+кода бота (первый кадр стека из файлов проекта — обработчики, state, ...).
+/state_stats trace off — выключает (трассировка дорогая: CPU и память на каждую
+аллокацию); пока она включена, об этом напоминает и обычный отчёт.
+"""
+import asyncio
+import os
+import sys
+import tracemalloc
+from array import array
+from typing import Any, Dict, List
+
+import clock
+from config import MOD_GROUP_ID
+from state import save_state, copy_value, encoded_size, section_of, disk_sizes
+from snapshot import SnapshotState
+from utils import fmt_size
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACE_FRAMES = 16
+
+
+def deep_sizeof(obj: Any, seen: set | None = None) -> int:
+    """Оценка памяти объекта вместе со всем, на что он ссылается (без повторов)."""
+    seen = set() if seen is None else seen
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, (str, bytes, bytearray, int, float, bool, type(None), array)):
+            continue   # array: getsizeof уже включает буфер
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            for cls in type(o).__mro__:
+                for name in getattr(cls, "__slots__", ()):
+                    if hasattr(o, name):
+                        stack.append(getattr(o, name))
+            if hasattr(o, "__dict__"):
+                stack.append(o.__dict__)
+    return total
+
+
+def entry_count(key: str, value: Any) -> int:
+    """Сколько «записей» в значении: строки истории, ключи кэша, элементы списков."""
+    if key == "history" and hasattr(value, "logs"):
+        return sum(len(log) for log in value.logs.values())
+    if key == "weather" and isinstance(value, dict):
+        locs = value.get("locations") or {}
+        return len(value.get("history") or ()) + sum(
+            len(lw.get("history") or ()) + len(lw.get("hourly") or ()) for lw in locs.values() if isinstance(lw, dict))
+    if key == "bumper" and isinstance(value, dict):
+        return sum(len(c) for c in (value.get("reach") or {}).values())
+    if key == "broadcast" and isinstance(value, dict):
+        return len(value.get("subscribers") or ()) + len(value.get("jobs") or ())
+    if isinstance(value, (str, bytes)):
+        return 1
+    try:
+        return len(value)
+    except TypeError:
+        return 1
+
+
+def collect(copies: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Тяжёлая часть (в потоке): сериализация и обход копий."""
+    out = {}
+    for key, value in copies.items():
+        try:
+            ser = encoded_size(key, value)
+        except Exception:
+            ser = None
+        out[key] = {"entries": entry_count(key, value), "json_bytes": ser, "mem_bytes": deep_sizeof(value),
+                    "section": section_of(key)}
+    return out
+
+
+def with_growth(report: Dict[str, Dict[str, Any]], prev: Dict[str, Any] | None, now: float):
+    """Добавляем рост (в час) по сравнению с прошлым отчётом."""
+    if not prev or not prev.get("ts"):
+        return None
+    hours = max(1e-9, (now - float(prev["ts"])) / 3600)
+    for key, row in report.items():
+        p = (prev.get("keys") or {}).get(key)
+        if not p:
+            continue
+        row["entries_per_h"] = (row["entries"] - p[0]) / hours
+        if row["json_bytes"] is not None and p[1] is not None:
+            row["bytes_per_h"] = (row["json_bytes"] - p[1]) / hours
+    return hours
+
+
+async def state_stats(state) -> Dict[str, Any]:
+    """API: {"keys": {ключ: {...}}, "disk": {секция: байты}, "since_h": часов с прошлого отчёта}."""
+    items = state.loaded_items() if isinstance(state, SnapshotState) else state.items()
+    lazy = state.lazy_keys() if isinstance(state, SnapshotState) else []
+    copies = {k: copy_value(k, v) for k, v in list(items) if k != "state_stats"}
+    report = await asyncio.to_thread(collect, copies)
+    for k in lazy:
+        report[k] = {"entries": None, "json_bytes": None, "mem_bytes": 0, "section": section_of(k), "lazy": True}
+    now = clock.time()
+    since_h = with_growth(report, state.get("state_stats"), now)
+    try:
+        disk = await asyncio.to_thread(disk_sizes)
+    except Exception:
+        disk = {}
+    state["state_stats"] = {"ts": now, "keys": {k: [r["entries"], r["json_bytes"]] for k, r in report.items()
+                                                if not r.get("lazy")}}
+    save_state(state, "state_stats")
+    return {"keys": report, "disk": disk, "since_h": since_h}
+
+
+def format_report(st: Dict[str, Any]) -> str:
+    rows = sorted(st["keys"].items(), key=lambda kv: -(kv[1]["json_bytes"] or 0))
+    disk = st.get("disk") or {}
+    lines = ["Состояние по ключам (JSON / память / записей):"]
+    for key, r in rows:
+        if r.get("lazy"):
+            lines.append(f"{key}: не загружена; на диске {fmt_size(disk.get(r['section'], 0))}")
+            continue
+        line = (f"{key}: {fmt_size(r['json_bytes']) if r['json_bytes'] is not None else '—'} / "
+                f"{fmt_size(r['mem_bytes'])} / {r['entries']}")
+        if "entries_per_h" in r:
+            line += f"; рост {r['entries_per_h']:+.0f} зап/ч"
+            if "bytes_per_h" in r:
+                line += f", {r['bytes_per_h'] / 1024:+.1f} KB/ч"
+        lines.append(line)
+    if disk:
+        lines.append("")
+        lines.append("На диске (сжато): " + ", ".join(f"{sec} {fmt_size(b)}" for sec, b in sorted(disk.items())))
+    if st.get("since_h") is not None:
+        lines.append(f"Рост — с прошлого отчёта ({st['since_h']:.1f} ч назад).")
+    if tracemalloc.is_tracing():
+        lines.append("tracemalloc включён (замедляет процесс) — /state_stats trace off, чтобы выключить.")
+    return "\n".join(lines)
+
+
+# ---- tracemalloc ----
+_last_snapshot = None
+
+
+def _project_frame(tb) -> str | None:
+    for frame in tb:   # от самого свежего кадра
+        fn = frame.filename
+        if fn.startswith(PROJECT_DIR) and not fn.endswith("statestats.py"):
+            return f"{os.path.relpath(fn, PROJECT_DIR)}:{frame.lineno}"
+    return None
+
+
+def trace_report(limit: int = 12) -> str:
+    """Прирост аллокаций с прошлого снимка по строкам кода бота."""
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+        _last_snapshot = tracemalloc.take_snapshot()
+        return "tracemalloc включён; повторите /state_stats trace позже, чтобы увидеть прирост."
+    snap = tracemalloc.take_snapshot()
+    prev, _last_snapshot = _last_snapshot, snap
+    stats = snap.compare_to(prev, "traceback") if prev is not None else snap.statistics("traceback")
+    by_site: Dict[str, List[int]] = {}
+    for st in stats:
+        site = _project_frame(st.traceback) or "(вне кода бота)"
+        acc = by_site.setdefault(site, [0, 0])
+        acc[0] += getattr(st, "size_diff", st.size)
+        acc[1] += getattr(st, "count_diff", st.count)
+    top = sorted(by_site.items(), key=lambda kv: -kv[1][0])[:limit]
+    cur, peak = tracemalloc.get_traced_memory()
+    lines = [f"tracemalloc: сейчас {fmt_size(cur)}, пик {fmt_size(peak)}; прирост с прошлого снимка:"]
+    lines += [f"{site}: {d / 1024:+.1f} KB ({c:+d} блоков)" for site, (d, c) in top]
+    return "\n".join(lines)
+
+
+def trace_stop() -> str:
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return "tracemalloc и так выключен."
+    tracemalloc.stop()
+    _last_snapshot = None
+    return "tracemalloc выключен."
+
+
+async def cmd_state_stats(update, context, state):
+    """/state_stats — отчёт по секциям; /state_stats trace [off] — tracemalloc по строкам кода."""
+    if update.effective_chat.id != MOD_GROUP_ID: return
+    from moderation import is_admin
+    if not await is_admin(context, update.effective_user.id): return
+    if context.args and context.args[0] == "trace":
+        if len(context.args) > 1 and context.args[1] == "off":
+            text = trace_stop()
+        else:
+            text = await asyncio.to_thread(trace_report)
+    else:
+        text = format_report(await state_stats(state))
+    await update.message.reply_text(text[:4096])
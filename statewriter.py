@@ -0,0 +1,80 @@
+# statewriter.py
+"""
+Фоновая запись состояния.
+
+На event loop save_state только снимает дешёвую копию изменившихся секций
+(см. state.save_state) и кладёт её сюда. Кодирование, запись и rename делает
+один фоновый поток. Слот «последнее побеждает»: пока поток пишет, новые копии
+сливаются по секциям (более свежая копия секции заменяет старую), и следующая
+запись берёт самое новое. Один поток => записи на диск идут строго по порядку.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict
+
+log = logging.getLogger("state")
+
+
+class StateWriter:
+    def __init__(self, write_fn: Callable[[Dict[str, Any]], None], retry_s: float = 1.0):
+        self._write_fn = write_fn       # (sections: {имя: копия}) -> None, вызывается в потоке
+        self._retry_s = retry_s
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Any] = {}
+        self._submitted = 0             # поколение последней отданной копии
+        self._written = 0               # поколение, которое уже на диске
+        self._thread: threading.Thread | None = None
+        self.writes = 0
+        self.last_write_s = 0.0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, sections: Dict[str, Any]) -> int:
+        """Отдать копии секций на запись; возвращает номер поколения."""
+        with self._cond:
+            self._pending.update(sections)
+            self._submitted += 1
+            gen = self._submitted
+            self._ensure_thread()
+            self._cond.notify_all()
+        return gen
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, {}
+                gen = self._submitted
+            t0 = time.perf_counter()
+            try:
+                self._write_fn(batch)
+            except Exception:
+                log.exception("state write failed — повторим")
+                with self._cond:
+                    # то, что успело обновиться, свежее — его не затираем
+                    for k, v in batch.items():
+                        self._pending.setdefault(k, v)
+                time.sleep(self._retry_s)
+                continue
+            with self._cond:
+                self.writes += 1
+                self.last_write_s = time.perf_counter() - t0
+                self._written = gen
+                self._cond.notify_all()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Дождаться, пока на диске окажется всё отданное до этого момента."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._submitted
+            while self._written < target:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
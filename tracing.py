@@ -0,0 +1,130 @@
+# tracing.py
+"""
+Сквозная трассировка заявки: от получения до публикации и сводки автору.
+
+Трасса — id и список отметок (этап, время, epoch). Этапы по порядку, какие были:
+  sent      — msg.date (время отправки по часам Telegram, точность 1 с);
+  received  — апдейт пришёл в процессор (latency.py; для альбома — последний файл);
+  admitted  — прошли допуск (admission);
+  relayed   — копия/сводка в модчате;
+  joined    — присоединено к решению по кластеру почти-дублей (вместо relayed);
+  receipt   — сводка автору отправлена;
+  decided   — решение модератора (CHECK);
+  notified  — авторам сообщили о решении;
+  published — опубликовано в канале.
+Задержка этапа — время от предыдущей отметки.
+
+В CHECK трасса уезжает в запись pending (entry.trace, to_dense) и переживает
+рестарт; пока процесс жив, незавершённая трасса лежит и в памяти (_open), так что
+отметки, сделанные после записи в pending (например receipt), не теряются.
+Завершённые — в кольцевом буфере на TRACE_RING_SIZE: из него перцентили по
+этапам и /slow — самые медленные.
+"""
+import os
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Tuple
+
+import clock
+from config import TRACE_RING_SIZE
+from utils import percentile
+
+
+class Trace:
+    __slots__ = ("id", "kind", "user_id", "marks", "ref", "outcome")
+
+    def __init__(self, kind: str, user_id, tid: str | None = None):
+        self.id = tid or os.urandom(4).hex()
+        self.kind = kind
+        self.user_id = user_id
+        self.marks: List[Tuple[str, float]] = []
+        self.ref = None          # message_id решения в модчате
+        self.outcome = None
+
+    def mark(self, stage: str, ts: float | None = None) -> "Trace":
+        self.marks.append((stage, clock.time() if ts is None else float(ts)))
+        return self
+
+    def has(self, stage: str) -> bool:
+        return any(s == stage for s, _ in self.marks)
+
+    def stages(self) -> List[Tuple[str, float]]:
+        """[(этап, секунд от предыдущей отметки)]."""
+        return [(s, max(0.0, t - self.marks[i][1])) for i, (s, t) in enumerate(self.marks[1:])]
+
+    def total(self) -> float:
+        return self.marks[-1][1] - self.marks[0][1] if len(self.marks) > 1 else 0.0
+
+    def to_dense(self) -> Dict[str, Any]:
+        return {"id": self.id, "kind": self.kind, "uid": self.user_id, "ref": self.ref,
+                "m": [[s, round(t, 3)] for s, t in self.marks]}
+
+    @classmethod
+    def from_dense(cls, d) -> "Trace":
+        t = cls(d.get("kind") or "?", d.get("uid"), d.get("id"))
+        t.ref = d.get("ref")
+        t.marks = [(str(s), float(ts)) for s, ts in d.get("m") or () if isinstance(ts, (int, float))]
+        return t
+
+
+class Tracer:
+    def __init__(self, ring_size: int = TRACE_RING_SIZE, open_max: int | None = None):
+        self.ring: deque = deque(maxlen=max(1, ring_size))
+        self._open: "OrderedDict[str, Trace]" = OrderedDict()
+        self.open_max = open_max or 4 * max(1, ring_size)
+        self.outcomes: Dict[str, int] = {}
+
+    def start(self, kind: str, user_id, sent_ts: float | None = None, received_ts: float | None = None) -> Trace:
+        t = Trace(kind, user_id)
+        if sent_ts is not None:
+            t.mark("sent", sent_ts)
+        t.mark("received", received_ts)
+        self._open[t.id] = t
+        if len(self._open) > self.open_max:
+            self._open.popitem(last=False)   # останется только копия в pending
+        return t
+
+    def resume(self, dense) -> Trace | None:
+        """Трасса из записи pending: живой объект, если процесс его помнит, иначе — восстановленный."""
+        if not isinstance(dense, dict):
+            return None
+        t = self._open.get(dense.get("id"))
+        return t if t is not None else Trace.from_dense(dense)
+
+    def discard(self, t: Trace | None):
+        if t is not None:
+            self._open.pop(t.id, None)
+
+    def finish(self, t: Trace | None, outcome: str):
+        if t is None:
+            return
+        self._open.pop(t.id, None)
+        t.outcome = outcome
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.ring.append(t)
+
+    # ---- отчёты ----
+    def stage_percentiles(self) -> Dict[str, Dict[str, float]]:
+        """{этап: {count, p50, p90, p99, max}} по буферу; "total" — от первой отметки до последней."""
+        per: Dict[str, List[float]] = {}
+        for t in self.ring:
+            for s, dt in t.stages():
+                per.setdefault(s, []).append(dt)
+        per["total"] = [t.total() for t in self.ring]
+        return {s: {"count": len(v), "p50": percentile(v, 0.5), "p90": percentile(v, 0.9),
+                    "p99": percentile(v, 0.99), "max": max(v)} for s, v in per.items()}
+
+    def slowest(self, n: int = 10) -> List[Trace]:
+        return sorted(self.ring, key=lambda t: -t.total())[:n]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"finished": len(self.ring), "open": len(self._open), "outcomes": dict(self.outcomes)}
+
+
+def fmt_trace(t: Trace) -> str:
+    parts = ", ".join(f"{s} {dt:.2f}s" for s, dt in t.stages())
+    ref = f", решение {t.ref}" if t.ref else ""
+    return f"{t.id} {t.kind} ID {t.user_id} [{t.outcome}{ref}]: {t.total():.2f}s — {parts}"
+
+
+# один на процесс
+tracer = Tracer()
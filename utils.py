@@ -1,6 +1,7 @@
 import math, statistics
-from datetime import datetime, timezone
-from collections import defaultdict
+from datetime import timezone
+
+import clock
 
 def fmt_size(b: int) -> str:
     try:
@@ -29,12 +30,13 @@ def percentile(arr, q):
     if f == c: return s[int(k)]
     return s[f]*(c-k) + s[c]*(k-f)
 
-def compute_stats(entries):
+def compute_stats(log):
+    """log — history.DeliveryLog (или None); считаем прямо по колонкам."""
     res = {}
-    if not entries: return {"sizes":{}, "times":{}, "speeds_bps":{}}
-    sizes = [e['bytes'] for e in entries if isinstance(e.get('bytes'), (int,float))]
-    times = [e['delivery_seconds'] for e in entries if isinstance(e.get('delivery_seconds'), (int,float))]
-    speeds = [e['speed_bps'] for e in entries if isinstance(e.get('speed_bps'), (int,float)) and not math.isinf(e['speed_bps'])]
+    if not log: return {"sizes":{}, "times":{}, "speeds_bps":{}}
+    sizes = list(log.sizes)
+    times = [x for x in log.durations if not math.isnan(x)]
+    speeds = [x for x in log.speeds if not (math.isnan(x) or math.isinf(x))]
 
     def pack(arr):
         if not arr: return {'count': 0}
@@ -55,28 +57,4 @@ def compute_stats(entries):
     return res
 
 def now_utc():
-    return datetime.now(timezone.utc)
-
-def compute_reach_stats(history: dict):
-    per_day = defaultdict(set)
-    per_hour = defaultdict(set)
-    all_users = set()
-    for uid, entries in (history or {}).items():
-        for e in entries:
-            all_users.add(int(uid))
-            ts = e.get("timestamp")
-            if not ts: continue
-            try:
-                dt = datetime.fromisoformat(ts)
-            except Exception:
-                continue
-            per_day[dt.date().isoformat()].add(int(uid))
-            per_hour[dt.hour].add(int(uid))
-    days_sorted = sorted(per_day.items(), key=lambda x: x[0], reverse=True)
-    per_day_counts = [(d, len(s)) for d, s in days_sorted]
-    per_hour_counts = [(h, len(s)) for h, s in sorted(per_hour.items())]
-    return {
-        "total_unique_users": len(all_users),
-        "per_day_counts": per_day_counts,
-        "per_hour_counts": per_hour_counts,
-    }
\ No newline at end of file
+    return clock.now(timezone.utc)
@@ -1,20 +1,22 @@
+import asyncio
 import logging
 import io
-from time import monotonic
+import threading
+from bisect import bisect_left
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 
 import requests
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from telegram.error import BadRequest, Forbidden, RetryAfter
 
+import clock
 from config import (
-    UNCHECK_CHANNEL_ID, WEATHER_API_KEY, WEATHER_LAT, WEATHER_LON, WEATHER_CITY_LABEL,
-    WEATHER_MIN_C, WEATHER_MAX_C, TIMEZONE
+    UNCHECK_CHANNEL_ID, WEATHER_API_KEY, WEATHER_LOCATIONS, WEATHER_STAGGER_S, TIMEZONE
 )
 from state import save_state
+from downsample import downsample
 
 log = logging.getLogger("weather")
 
@@ -24,17 +26,37 @@ MIN_TITLE_UPDATE_SECONDS = 0    # разрешаем обновлять заго
 TEMP_EPS = 0.0                  # не используем EPS — обновляем каждый раз
 HUM_EPS = 0.0
 
+# график: сколько точек рисуем (8 дюймов * 160 dpi ≈ 1300 px — ~1000 точек хватает) и чем прореживаем
+CHART_MAX_POINTS = 1000
+CHART_DOWNSAMPLE = "lttb"         # или "minmax"
+
+# поля района, которые раньше лежали прямо в state["weather"] (один район)
+LOCATION_KEYS = ("last_temp", "last_humidity", "last_pressure_mb", "last_fetch_mono", "history", "hourly",
+                 "alert_status", "last_alert_message_id", "last_alert_ts")
+
 def _now_utc():
-    return datetime.now(timezone.utc)
+    return clock.now(timezone.utc)
+
+# сессия на поток: keep-alive к api.weatherapi.com; районы опрашиваются в разных потоках
+# (asyncio.to_thread), а requests.Session между потоками делить небезопасно
+_local = threading.local()
+
+def _get_session() -> requests.Session:
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    return session
 
-def _get_weather():
+def _get_weather(loc: dict | None = None):
     """Возвращает dict с temp_c, humidity и pressure_mb.
     Бросает исключение при проблемах с сетевым запросом.
     """
     if not WEATHER_API_KEY:
         raise RuntimeError("WEATHER_API_KEY пуст — укажи ключ от weatherapi.com в .env")
+    loc = loc or WEATHER_LOCATIONS[0]
     url = "https://api.weatherapi.com/v1/current.json"
-    r = requests.get(url, params={"key": WEATHER_API_KEY, "q": f"{WEATHER_LAT},{WEATHER_LON}", "aqi":"no"}, timeout=10)
+    r = _get_session().get(url, params={"key": WEATHER_API_KEY, "q": f"{loc['lat']},{loc['lon']}", "aqi":"no"}, timeout=10)
     r.raise_for_status()
     j = r.json()
     cur = j.get("current", {})
@@ -45,10 +67,11 @@ def _get_weather():
         "pressure_mb": float(cur.get("pressure_mb", 0.0)),
     }
 
-def _channel_title(temp_c: float, humidity: float) -> str:
+def _channel_title(temp_c: float, humidity: float, label: str | None = None) -> str:
     sign = "+" if temp_c >= 0 else "-"
     # влажность без десятичных — достаточно целых процентов
-    t = f"В 292 ЛЮБЯТ | {sign}{abs(temp_c):.1f} °C · {int(round(humidity))}% {WEATHER_CITY_LABEL}"
+    label = WEATHER_LOCATIONS[0]["label"] if label is None else label
+    t = f"В 292 ЛЮБЯТ | {sign}{abs(temp_c):.1f} °C · {int(round(humidity))}% {label}"
     return t[:128]
 
 async def _set_title_safe(context, title: str):
@@ -73,41 +96,57 @@ async def _set_title_safe(context, title: str):
         log.exception("Не удалось изменить заголовок канала: %s", e)
         return False
 
-def _render_temp_chart(history: list[dict], min_c: float, max_c: float):
-    tz = ZoneInfo(TIMEZONE)
-    now = _now_utc()
-    cutoff = now - timedelta(hours=24)
-    xs, ys = [], []
-    for rec in history or []:
+def _chart_series(history: list[dict], now, tz, points: int | None = None):
+    """Сэмплы за 24 часа, прореженные до points (LTTB — пики сохраняются);
+    в datetime переводим только оставшиеся точки."""
+    cutoff = (now - timedelta(hours=24)).timestamp()
+    hist = history or []
+    # history упорядочен по ts — начало окна через bisect, без прохода по всему списку
+    start = bisect_left(hist, cutoff, key=lambda r: float(r.get("ts", 0)) if isinstance(r, dict) else 0.0)
+    ts, temps = [], []
+    for rec in hist[start:]:
         try:
-            dt = datetime.fromisoformat(rec["ts"])
-            if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
-            if dt < cutoff: continue
-            xs.append(dt.astimezone(tz))
-            ys.append(float(rec["temp_c"]))
+            t = float(rec["ts"])
+            v = float(rec["temp_c"])
         except Exception:
             continue
-    if not xs:
-        xs = [now.astimezone(tz)]
-        ys = [None]
-
-    fig, ax = plt.subplots(figsize=(8, 3))
-    ax.plot(xs, ys, linewidth=2)
-    ax.axhline(min_c, linestyle="--")
-    ax.axhline(max_c, linestyle="--")
-    ax.set_title(f"Температура за 24 часа — {WEATHER_CITY_LABEL}")
-    ax.set_ylabel("°C")
-    ax.grid(True, alpha=0.3)
-    fig.autofmt_xdate()
-
-    buf = io.BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, format="png", dpi=160)
-    plt.close(fig)
-    buf.seek(0)
-    return buf
-
-def _build_alert_caption(temp: float, humidity: float, min_c: float, max_c: float, status: str):
+        if t < cutoff: continue
+        ts.append(t)
+        temps.append(v)
+    if not ts:
+        return [now.astimezone(tz)], [None]
+    ts, temps = downsample(ts, temps, CHART_MAX_POINTS if points is None else points, CHART_DOWNSAMPLE)
+    return [datetime.fromtimestamp(t, timezone.utc).astimezone(tz) for t in ts], temps
+
+def _render_temp_charts(jobs: list[tuple], points: int | None = None):
+    """jobs — [(history, min_c, max_c, label)]; все графики за один проход
+    на одной фигуре (без пересоздания figure/axes на каждый район).
+    Без pyplot: его глобальное состояние не потокобезопасно, а рисуем мы в потоке."""
+    tz = ZoneInfo(TIMEZONE)
+    now = _now_utc()
+    out = []
+    fig = Figure(figsize=(8, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for history, min_c, max_c, label in jobs:
+        ax.clear()
+        xs, ys = _chart_series(history, now, tz, points)
+        ax.plot(xs, ys, linewidth=2)
+        ax.axhline(min_c, linestyle="--")
+        ax.axhline(max_c, linestyle="--")
+        ax.set_title(f"Температура за 24 часа — {label}")
+        ax.set_ylabel("°C")
+        ax.grid(True, alpha=0.3)
+        fig.autofmt_xdate()
+
+        buf = io.BytesIO()
+        fig.tight_layout()
+        fig.savefig(buf, format="png", dpi=160)
+        buf.seek(0)
+        out.append(buf)
+    return out
+
+def _build_alert_caption(temp: float, humidity: float, min_c: float, max_c: float, status: str, area: str = "Купчино"):
     tz = ZoneInfo(TIMEZONE)
     now_local = _now_utc().astimezone(tz)
     if status == "below":
@@ -120,73 +159,139 @@ def _build_alert_caption(temp: float, humidity: float, min_c: float, max_c: floa
         sign = "+"
 
     return (
-        "Метеоуведомление (на территории Купчино)\n"
+        f"Метеоуведомление (на территории {area})\n"
         f"T = {temp:.1f} °C; влажность = {humidity:.0f}% ; диапазон [{min_c:.1f}; {max_c:.1f}] °C; Δ{sign}={delta:.1f} °C\n"
         f"Классификация: {kind}\n"
         f"Время (MSK): {now_local:%Y-%m-%d %H:%M}"
     )
 
+def _locations_state(w: dict) -> dict:
+    """state["weather"]["locations"][id] — своё состояние у каждого района.
+    Старый плоский формат (один район) переезжает в первый район."""
+    locs = w.get("locations")
+    if not isinstance(locs, dict):
+        first = {k: w.pop(k) for k in LOCATION_KEYS if k in w}
+        locs = w["locations"] = {WEATHER_LOCATIONS[0]["id"]: first}
+    for loc in WEATHER_LOCATIONS:
+        locs.setdefault(loc["id"], {})
+    return locs
+
+def _add_sample(lw: dict, ts: float, t: float, h: float):
+    """Два яруса истории района: сырые сэмплы (для графика за сутки) и почасовые
+    агрегаты min/max/среднее (на месяц) — хвост обновляется на месте."""
+    lw.setdefault("history", []).append({"ts": ts, "temp_c": float(t), "humidity": float(h)})
+    hourly = lw.setdefault("hourly", [])
+    hour = int(ts // 3600) * 3600
+    if hourly and hourly[-1].get("ts") == hour:
+        rec = hourly[-1]
+        rec["min"] = min(rec["min"], t); rec["max"] = max(rec["max"], t)
+        rec["sum"] += t; rec["n"] += 1
+    else:
+        hourly.append({"ts": hour, "min": t, "max": t, "sum": t, "n": 1})
+
+async def _fetch_staggered(loc: dict, delay: float):
+    if delay > 0:
+        await clock.sleep(delay)
+    # requests блокирующий — в пул потоков; сессия общая
+    return await asyncio.to_thread(_get_weather, loc)
+
 async def weather_job(context):
     """
     Основная логика:
-      - опрашиваем weatherapi (throttle MIN_FETCH_SECONDS)
-      - сохраняем в history
-      - каждый успешный fetch — пытаемся сразу поменять заголовок (force)
-      - алёрты/графики оставлены
+      - опрашиваем weatherapi по всем районам параллельно (со сдвигом WEATHER_STAGGER_S,
+        throttle MIN_FETCH_SECONDS на район), через одну сессию
+      - сохраняем в history района
+      - каждый успешный fetch первого района — пытаемся сразу поменять заголовок (force)
+      - алёрты по району; графики всех сработавших районов — одним проходом
     """
     state = context.application.bot_data["state"]
     w = state.setdefault("weather", {})
-    now_mono = monotonic()
+    locs_w = _locations_state(w)
+    now_mono = clock.monotonic()
     now = _now_utc()
 
-    last_fetch_mono = w.get("last_fetch_mono")
-
     # 1) fetch throttle
-    need_fetch = (last_fetch_mono is None) or ((now_mono - float(last_fetch_mono)) >= MIN_FETCH_SECONDS)
-    if need_fetch:
-        try:
-            data = _get_weather()
+    due, fetched = [], set()
+    for loc in WEATHER_LOCATIONS:
+        last_fetch_mono = locs_w[loc["id"]].get("last_fetch_mono")
+        if (last_fetch_mono is None) or ((now_mono - float(last_fetch_mono)) >= MIN_FETCH_SECONDS):
+            due.append(loc)
+    if due:
+        results = await asyncio.gather(*(_fetch_staggered(loc, i * WEATHER_STAGGER_S) for i, loc in enumerate(due)),
+                                       return_exceptions=True)
+        for loc, data in zip(due, results):
+            if isinstance(data, BaseException):
+                log.error("Не удалось получить погоду (%s): %s", loc["id"], data)
+                continue
+            lw = locs_w[loc["id"]]
             t = data["temp_c"]
             h = data["humidity"]
             pressure_mb = data.get("pressure_mb", 0.0)
             # обновляем кэш
-            w["last_temp"] = t
-            w["last_humidity"] = h
-            w["last_pressure_mb"] = pressure_mb
-            w["last_fetch_mono"] = now_mono
-            w.setdefault("history", []).append({"ts": now.isoformat(), "temp_c": float(t), "humidity": float(h)})
-            save_state(state)
-            log.info("Погода: %.2f °C, %.0f%% влажность, %.1f mb (обновил кэш)", t, h, pressure_mb)
-        except Exception as e:
-            log.exception("Не удалось получить погоду: %s", e)
-            return
-
-    # если нет данных — выходим
-    if w.get("last_temp") is None:
-        return
+            lw["last_temp"] = t
+            lw["last_humidity"] = h
+            lw["last_pressure_mb"] = pressure_mb
+            lw["last_fetch_mono"] = now_mono
+            _add_sample(lw, now.timestamp(), t, h)
+            fetched.add(loc["id"])
+            log.info("Погода %s: %.2f °C, %.0f%% влажность, %.1f mb (обновил кэш)", loc["id"], t, h, pressure_mb)
+        if fetched:
+            save_state(state, "weather")
+
+    # 2) Принудительная смена заголовка при каждом fetch (без EPS) — по первому району
+    main_loc = WEATHER_LOCATIONS[0]
+    main_w = locs_w[main_loc["id"]]
+    if main_loc["id"] in fetched:
+        temp = float(main_w["last_temp"])
+        humidity = float(main_w.get("last_humidity", 0.0))
+        title = _channel_title(temp, humidity, main_loc["label"])
+        ok = await _set_title_safe(context, title)
+        if ok:
+            # сохраняем метки успешной смены
+            w["last_title_mono"] = now_mono
+            w["last_title_temp"] = temp
+            w["last_title_humidity"] = humidity
+            save_state(state, "weather")
+
+    # 3) детекция выхода за рамки и алёрт — по каждому району
+    to_alert = []
+    for loc in WEATHER_LOCATIONS:
+        lw = locs_w[loc["id"]]
+        # если нет данных — пропускаем
+        if lw.get("last_temp") is None:
+            continue
+        temp = float(lw["last_temp"])
+        status = "ok"
+        if temp < loc["min_c"]: status = "below"
+        elif temp > loc["max_c"]: status = "above"
+
+        prev = lw.get("alert_status") or "ok"
+        if status != "ok" and status != prev:
+            to_alert.append((loc, lw, status))
+        elif status == "ok" and prev != "ok":
+            prev_msg_id = lw.get("last_alert_message_id")
+            if prev_msg_id is not None:
+                try:
+                    await context.bot.delete_message(chat_id=UNCHECK_CHANNEL_ID, message_id=prev_msg_id)
+                    log.info("deleted previous alert message id=%s on recovery (%s)", prev_msg_id, loc["id"])
+                except Exception:
+                    log.warning("could not delete previous alert message id=%s on recovery", prev_msg_id)
+                lw.pop("last_alert_message_id", None)
+            lw["alert_status"] = "ok"
+            save_state(state, "weather")
 
-    temp = float(w["last_temp"])
-    humidity = float(w.get("last_humidity", 0.0))
-
-    # 2) Принудительная смена заголовка при каждом fetch (без EPS)
-    title = _channel_title(temp, humidity)
-    ok = await _set_title_safe(context, title)
-    if ok:
-        # сохраняем метки успешной смены
-        w["last_title_mono"] = now_mono
-        w["last_title_temp"] = temp
-        w["last_title_humidity"] = humidity
-        save_state(state)
-
-    # 3) детекция выхода за рамки и алёрт (как было)
-    status = "ok"
-    if temp < WEATHER_MIN_C: status = "below"
-    elif temp > WEATHER_MAX_C: status = "above"
-
-    prev = w.get("alert_status") or "ok"
-    if status != "ok" and status != prev:
+    if not to_alert:
+        return
+    try:
+        # все графики одним проходом, в потоке — matplotlib не должен держать event loop
+        charts = await asyncio.to_thread(
+            _render_temp_charts, [(lw.get("history", []), loc["min_c"], loc["max_c"], loc["label"]) for loc, lw, _ in to_alert])
+    except Exception:
+        log.exception("Не удалось построить графики погоды")
+        return
+    for (loc, lw, status), chart in zip(to_alert, charts):
         try:
-            prev_msg_id = w.get("last_alert_message_id")
+            prev_msg_id = lw.get("last_alert_message_id")
             if prev_msg_id is not None:
                 try:
                     await context.bot.delete_message(chat_id=UNCHECK_CHANNEL_ID, message_id=prev_msg_id)
@@ -194,37 +299,32 @@ async def weather_job(context):
                 except Exception:
                     log.warning("could not delete previous alert message id=%s", prev_msg_id)
 
-            chart = _render_temp_chart(w.get("history", []), WEATHER_MIN_C, WEATHER_MAX_C)
-            caption = _build_alert_caption(temp, humidity, WEATHER_MIN_C, WEATHER_MAX_C, status)
+            temp = float(lw["last_temp"])
+            humidity = float(lw.get("last_humidity", 0.0))
+            caption = _build_alert_caption(temp, humidity, loc["min_c"], loc["max_c"], status, loc["area"])
             msg = await context.bot.send_photo(chat_id=UNCHECK_CHANNEL_ID, photo=chart, caption=caption)
-            w["last_alert_message_id"] = getattr(msg, "message_id", None)
-            w["alert_status"] = status
-            w["last_alert_ts"] = now.isoformat()
-            save_state(state)
+            lw["last_alert_message_id"] = getattr(msg, "message_id", None)
+            lw["alert_status"] = status
+            lw["last_alert_ts"] = now.isoformat()
+            save_state(state, "weather")
         except Exception:
-            log.exception("Не удалось отправить оповещение с графиком")
-    elif status == "ok" and prev != "ok":
-        prev_msg_id = w.get("last_alert_message_id")
-        if prev_msg_id is not None:
-            try:
-                await context.bot.delete_message(chat_id=UNCHECK_CHANNEL_ID, message_id=prev_msg_id)
-                log.info("deleted previous alert message id=%s on recovery", prev_msg_id)
-            except Exception:
-                log.warning("could not delete previous alert message id=%s on recovery", prev_msg_id)
-            w.pop("last_alert_message_id", None)
-        w["alert_status"] = "ok"
-        save_state(state)
+            log.exception("Не удалось отправить оповещение с графиком (%s)", loc["id"])
 
 # Ручная проверка/диагностика
 async def cmd_weather_ping(update, context):
-    try:
-        data = _get_weather()
+    results = await asyncio.gather(*(_fetch_staggered(loc, i * WEATHER_STAGGER_S) for i, loc in enumerate(WEATHER_LOCATIONS)),
+                                   return_exceptions=True)
+    lines = []
+    for i, (loc, data) in enumerate(zip(WEATHER_LOCATIONS, results)):
+        if isinstance(data, BaseException):
+            lines.append(f"weather_ping {loc['id']} FAIL: {data}")
+            continue
         t = data["temp_c"]
         h = data["humidity"]
         p = data.get("pressure_mb", 0.0)
-        ok = await _set_title_safe(context, _channel_title(t, h))
-        await update.message.reply_text(
-            f"weather_ping: temp={t:.2f} °C; humidity={h:.0f}% ; pressure={p:.1f} mb ; title_update={'OK' if ok else 'FAIL'}"
-        )
-    except Exception as e:
-        await update.message.reply_text(f"weather_ping FAIL: {e}")
+        line = f"weather_ping {loc['id']}: temp={t:.2f} °C; humidity={h:.0f}% ; pressure={p:.1f} mb"
+        if i == 0:
+            ok = await _set_title_safe(context, _channel_title(t, h, loc["label"]))
+            line += f" ; title_update={'OK' if ok else 'FAIL'}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))